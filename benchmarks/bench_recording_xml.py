@@ -0,0 +1,117 @@
+"""
+Benchmark streaming recording XML parsing against loading the whole tree.
+
+Writes a synthetic Prairie View recording XML (by default 100,000 frames with two
+channels, about the size of an hour long T-series) and counts its frames both by
+loading it with beyblade.xml_parser() and by streaming it with summarize_recording().
+It also reads every frame's time with frame_times(). Each runs in its own process so
+the peak memory of each can be reported. The frame counts are checked to agree.
+
+Usage:
+    python benchmarks/bench_recording_xml.py --frames 100000 --cycles 1
+"""
+
+import argparse
+import multiprocessing
+import resource
+import sys
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "docker"))
+
+from beyblade import xml_parser
+from recording_xml import frame_times, summarize_recording
+
+FRAME_PERIOD_SECS = 0.033
+
+
+def write_recording_xml(path: Path, frames: int, cycles: int = 1, channels: int = 2):
+    """Write a recording XML laid out like Prairie View's, with `frames` frames in each cycle."""
+
+    with open(path, "w") as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        f.write('<PVScan version="5.5.64.500" date="1/1/2022 12:00:00 PM" notes="">\n')
+        f.write('  <SystemIDs SystemID="0000" />\n')
+        f.write('  <PVStateShard>\n')
+        f.write('    <PVStateValue key="activeMode" value="ResonantGalvo" />\n')
+        f.write('    <PVStateValue key="framePeriod" value="%s" />\n' % FRAME_PERIOD_SECS)
+        f.write('  </PVStateShard>\n')
+
+        for cycle in range(1, cycles + 1):
+            f.write('  <Sequence type="TSeries Timed Element" cycle="%d" time="12:00:00.0000000">\n' % cycle)
+            for index in range(1, frames + 1):
+                time = (index - 1) * FRAME_PERIOD_SECS
+                f.write('    <Frame relativeTime="%.6f" absoluteTime="%.6f" index="%d" parameterSet="CurrentSettings">\n'
+                        % (time, time + 1.5, index))
+                for channel in range(1, channels + 1):
+                    f.write('      <File channel="%d" channelName="Ch%d" filename="rec_Cycle%05d_Ch%d_%06d.ome.tif" />\n'
+                            % (channel, channel, cycle, channel, index))
+                f.write('      <ExtraParameters lastGoodFrame="0" />\n')
+                f.write('      <PVStateShard>\n')
+                f.write('        <PVStateValue key="framePeriod" value="%s" />\n' % FRAME_PERIOD_SECS)
+                f.write('      </PVStateShard>\n')
+                f.write('    </Frame>\n')
+            f.write('  </Sequence>\n')
+
+        f.write('</PVScan>\n')
+
+
+def peak_rss_mib() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def tree_frames(path: Path):
+    start = perf_counter()
+    root = xml_parser(path)
+    last_index = int(root.xpath("Sequence/Frame[last()]")[0].attrib["index"])
+    return last_index, perf_counter() - start, peak_rss_mib()
+
+
+def streamed_frames(path: Path):
+    start = perf_counter()
+    summary = summarize_recording(path)
+    return summary.sequences[0].last_index, perf_counter() - start, peak_rss_mib()
+
+
+def streamed_times(path: Path):
+    start = perf_counter()
+    times = frame_times(path)
+    return len(times), perf_counter() - start, peak_rss_mib()
+
+
+def run_isolated(function, path: Path):
+    """Run a function in a fresh process so its peak memory isn't shared with the other."""
+
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(function, (path,))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=100000, help="Frames in each cycle")
+    parser.add_argument("--cycles", type=int, default=1, help="Number of cycles (sequences)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "recording.xml"
+        write_recording_xml(path, args.frames, args.cycles)
+        print("Recording XML: %d frames x %d cycles, %.1f MB" % (args.frames, args.cycles, path.stat().st_size / 1e6))
+
+        tree_index, tree_secs, tree_mib = run_isolated(tree_frames, path)
+        stream_index, stream_secs, stream_mib = run_isolated(streamed_frames, path)
+        times_count, times_secs, times_mib = run_isolated(streamed_times, path)
+
+    print("lxml tree:  %6.2f s  peak %7.1f MiB" % (tree_secs, tree_mib))
+    print("iterparse:  %6.2f s  peak %7.1f MiB" % (stream_secs, stream_mib))
+    print("frame times:%6.2f s  peak %7.1f MiB" % (times_secs, times_mib))
+
+    if tree_index != stream_index:
+        sys.exit("Frame counts differ: %d vs %d" % (tree_index, stream_index))
+
+    if times_count != args.frames * args.cycles:
+        sys.exit("Read %d frame times for %d frames" % (times_count, args.frames * args.cycles))
+
+    print("Frame counts agree: %d" % stream_index)
@@ -0,0 +1,126 @@
+"""
+Load test rip.py's watchdog against the fake ripper.
+
+Starts `--rips` copies of rip.py at once, each ripping its own synthetic recording with
+docker/fake_ripper.py standing in for Bruker's ripper, and reports for each rip:
+
+- how long after the last tiff was written rip.py noticed ripping was complete,
+- the CPU time rip.py itself used watching, packing and cleaning up, and
+- how long the whole rip took.
+
+Usage:
+    python benchmarks/bench_rip_watchdog.py --rips 10 --frames 2000 --rate 200 --jitter 0.5
+"""
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter
+
+DOCKER_DIR = Path(__file__).resolve().parents[1] / "docker"
+
+LOG_TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+
+def make_recording(data_root: Path, name: str) -> Path:
+    """Create a raw directory with the files rip.py checks for before ripping."""
+
+    raw_dir = data_root / name
+    raw_dir.mkdir(parents=True)
+    (raw_dir / (name + "_RAWDATA_001")).touch()
+    (raw_dir / (name + "_Filelist.txt")).touch()
+    (raw_dir / (name + ".xml")).write_text("<PVScan />\n")
+
+    return raw_dir
+
+
+def detection_time(log_file: Path) -> float:
+    """Return when rip.py logged that ripping was complete, as a Unix timestamp."""
+
+    for line in log_file.read_text().splitlines():
+        if "Detected ripping is complete" in line:
+            return datetime.strptime(line[:23], LOG_TIME_FORMAT).timestamp()
+
+    raise RuntimeError("%s never detected ripping completing" % log_file)
+
+
+def last_tiff_written(tiff_dir: Path) -> float:
+    return max(entry.stat().st_mtime for entry in os.scandir(tiff_dir) if entry.name.endswith(".ome.tif"))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rips", type=int, default=10, help="Number of rips run at once")
+    parser.add_argument("--frames", type=int, default=2000, help="Frames per channel in each recording")
+    parser.add_argument("--channels", type=int, nargs="+", default=[2], help="Channels in each recording")
+    parser.add_argument("--rate", type=float, default=200, help="Tiffs per second written by each fake ripper")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Random variation of each tiff's delay")
+    parser.add_argument("--stream_channel", type=int, help="Also pack this channel into HDF5 while ripping")
+    args = parser.parse_args()
+
+    num_images = args.frames * len(args.channels)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        data_root, scratch_dir, log_dir = tmp / "data", tmp / "scratch", tmp / "logs"
+        scratch_dir.mkdir()
+        log_dir.mkdir()
+
+        rips = {}
+        start = perf_counter()
+
+        for i in range(args.rips):
+            name = "rec%02d" % i
+            make_recording(data_root, name)
+
+            fake_ripper = [sys.executable, str(DOCKER_DIR / "fake_ripper.py"), "--frames", str(args.frames),
+                           "--channels"] + [str(channel) for channel in args.channels] + [
+                          "--rate", str(args.rate), "--jitter", str(args.jitter), "--seed", str(i)]
+
+            cmd = [sys.executable, str(DOCKER_DIR / "rip.py"), "--directory", name, "--ripper_version", "fake",
+                   "--num_images", str(num_images), "--log_file", name + ".log", "--data_root", str(data_root),
+                   "--scratch_dir", str(scratch_dir), "--log_dir", str(log_dir),
+                   "--ripper_command", " ".join(shlex.quote(part) for part in fake_ripper)]
+            if args.stream_channel is not None:
+                cmd += ["--stream_channel", str(args.stream_channel)]
+
+            with open(log_dir / (name + ".stderr"), "w") as stderr:
+                process = subprocess.Popen(cmd, stderr=stderr)
+            rips[process.pid] = name
+
+        # wait4 gives each rip.py's own resource use
+        results = {}
+        while len(results) < len(rips):
+            pid, status, usage = os.wait4(-1, 0)
+            if pid in rips:
+                exitcode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+                results[rips[pid]] = (exitcode, perf_counter() - start,
+                                      usage.ru_utime + usage.ru_stime)
+
+        total_secs = perf_counter() - start
+
+        print("%d rips of %d tiffs at %.0f tiffs/s each, jitter %.0f%%"
+              % (args.rips, num_images, args.rate, 100 * args.jitter))
+        print("%-8s %6s %10s %14s %12s" % ("rip", "exit", "wall (s)", "latency (ms)", "CPU (s)"))
+
+        latencies = []
+        for name in sorted(results):
+            exitcode, wall, cpu = results[name]
+            if exitcode == 0:
+                latency = 1000 * (detection_time(log_dir / (name + ".log"))
+                                  - last_tiff_written(scratch_dir / (name + "_tiffs")))
+                latencies.append(latency)
+                print("%-8s %6d %10.1f %14.0f %12.2f" % (name, exitcode, wall, latency, cpu))
+            else:
+                print("%-8s %6d %10.1f %14s %12.2f" % (name, exitcode, wall, "-", cpu))
+
+        print("All rips finished in %.1f s (%.0f tiffs/s overall)" % (total_secs, args.rips * num_images / total_secs))
+        if latencies:
+            print("Completion detected %.0f ms after the last tiff on average, %.0f ms at worst"
+                  % (sum(latencies) / len(latencies), max(latencies)))
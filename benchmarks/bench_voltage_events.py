@@ -0,0 +1,88 @@
+"""
+Benchmark vectorized edge detection against the original pandas implementation.
+
+Generates a synthetic voltage recording (by default 1 hour sampled at 10 kHz, like
+the DAQ records during a session) and times turning it into the `*_events.csv`
+table both ways. The two tables are checked to be identical.
+
+Usage:
+    python benchmarks/bench_voltage_events.py --seconds 3600 --rate 10000
+"""
+
+import argparse
+import sys
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "docker"))
+
+from voltage_events import channel_thresholds, detect_edges, edges_to_dataframe
+
+CHANNELS = ["lick", "speaker", "solenoid", "airpuff", "trigger"]
+
+
+def synthetic_recording(seconds: float, rate: int, events_per_sec: float = 2.0, seed: int = 0) -> pd.DataFrame:
+    """Build a voltage recording of square pulses on top of low voltage noise."""
+
+    rng = np.random.default_rng(seed)
+    num_samples = int(seconds * rate)
+
+    times = np.arange(num_samples) * (1000 / rate)
+    data = {}
+    for channel in CHANNELS:
+        toggles = np.zeros(num_samples, dtype=np.int8)
+        toggles[rng.integers(1, num_samples, int(seconds * events_per_sec * 2))] = 1
+        state = np.cumsum(toggles, dtype=np.int64) % 2
+        data[channel] = state * 5.0 + rng.normal(0, 0.05, num_samples)
+
+    return pd.DataFrame(data, index=pd.Index(times, name="Time(ms)"))
+
+
+def legacy_events(raw_behavior_df: pd.DataFrame) -> pd.DataFrame:
+    """The thresholding from rip.get_behavior_timestamps before it was vectorized."""
+
+    raw_behavior_df = raw_behavior_df > 2
+    raw_behavior_df = raw_behavior_df.astype(int).diff().fillna(0)
+
+    clean_behavior_dict = {}
+    for key in raw_behavior_df.columns:
+        clean_behavior_dict["_".join([key, "on"])] = raw_behavior_df.query(key + " == 1").index.tolist()
+        clean_behavior_dict["_".join([key, "off"])] = raw_behavior_df.query(key + " == -1").index.tolist()
+
+    return pd.DataFrame.from_dict(clean_behavior_dict, orient="index").transpose()
+
+
+def vectorized_events(raw_behavior_df: pd.DataFrame) -> pd.DataFrame:
+
+    channels = list(raw_behavior_df.columns)
+    times = raw_behavior_df.index.to_numpy()
+    values = np.ascontiguousarray(raw_behavior_df.to_numpy())
+
+    rising, falling = detect_edges(times, values, channel_thresholds(channels))
+
+    return edges_to_dataframe(channels, rising, falling)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark voltage recording edge detection.")
+    parser.add_argument("--seconds", type=float, default=3600, help="Length of the synthetic recording.")
+    parser.add_argument("--rate", type=int, default=10000, help="Sampling rate in Hz.")
+    args = parser.parse_args()
+
+    recording = synthetic_recording(args.seconds, args.rate)
+    print("Recording: %d samples x %d channels" % recording.shape)
+
+    start = perf_counter()
+    legacy = legacy_events(recording)
+    legacy_secs = perf_counter() - start
+
+    start = perf_counter()
+    vectorized = vectorized_events(recording)
+    vectorized_secs = perf_counter() - start
+
+    print("legacy:     %.2f s" % legacy_secs)
+    print("vectorized: %.2f s (%.1fx)" % (vectorized_secs, legacy_secs / vectorized_secs))
+    print("identical:  %s" % legacy.equals(vectorized))
@@ -1,3 +1,4 @@
 #!/bin/bash
 
-python3.8 docker/beyblade.py
+# Any arguments, such as --watch, are passed on to beyblade.py
+python3.8 docker/beyblade.py "$@"
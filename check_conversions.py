@@ -1,5 +1,11 @@
 from pathlib import Path
 import csv
+import sys
+
+# The frame manifest is written by rip.py, whose modules are in docker/
+sys.path.insert(0, str(Path(__file__).resolve().parent / "docker"))
+
+from frame_manifest import MANIFEST_NAME, FrameManifest
 
 data_dir = Path("/snlkt/data/_DATA/specialk_cs/2p/raw/")
 
@@ -32,6 +38,18 @@ for i in dictionary.keys():
                 break
             else:
                 needs_conversion.append(new)
+        else:
+            # Tiff directories with a frame manifest can be checked for gaps without
+            # listing them. Incomplete ones need ripping again from their raw directory.
+            for tiff_dir in dictionary[i][j]:
+                if not (tiff_dir / MANIFEST_NAME).exists():
+                    continue
+                manifest = FrameManifest.load(tiff_dir)
+                # Every cycle is checked against the frame counts from the recording XML
+                incomplete = [channel for channel in manifest.channels if manifest.missing_frames(channel)]
+                if incomplete:
+                    print("%s is missing frames for channels %s" % (tiff_dir, incomplete))
+                    needs_conversion.append([tiff_dir.with_name(tiff_dir.name[:-len("_tiffs")])])
 
 
 print(len(needs_conversion))
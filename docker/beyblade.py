@@ -1,329 +1,823 @@
-# Jeremy Delahanty January 2022
-# Assistance from Chris Roat, Stanford University Deisseroth Lab August 2021
-# https://github.com/chrisroat
-# https://github.com/deisseroth-lab/two-photon/
-# Adapted for the Tye Lab by Jeremy Delahanty @ Salk Institute
-
-
-from pathlib import Path
-import lxml.etree
-import subprocess
-import re
-import shutil
-import os
-
-# Import Tuple typing for typehints in documentation
-from typing import Union
-
-# The directory with all the different ripping versions is static on our server
-RIPPER_DIRECTORY = Path("/snlkt/data/bruker_pipeline/docker/prairie_view/")
-
-# The directory to look for files requiring conversion/transfer is static and located here
-TRANSFER_DIRECTORY = Path("/snlkt/data/bruker_pipeline/raw_conversion")
-
-# The directory for where executed conversions are stored is static and located here. This
-# is where the raw path .txt file will go after the containers have been started.
-EXECUTED_DIRECTORY = Path("/snlkt/data/bruker_pipeline/executed_conversion")
-
-# TODO: Create something which will check for whether or not the conversion was successful
-# or exited safely from the log files of previously executed. If the conversion failed for
-# some reason, another job should be scheduled for that conversion if possible.
-
-# TODO: Put checks for raw files/if tiffs or H5/zarrs exist already
-
-class RippingError(Exception):
-    """Error raised if problems encountered during data conversion."""
-
-
-def xml_parser(xml_path: Path) -> lxml.etree._ElementTree:
-    """
-    Parse Prairie View's xml with lxml.
-
-    Prairie View's xml that's contained in the .xml and .env files is
-    inconsistent with versioning. Using lxml allows for use of a parser
-    that can escape errors when it finds badly formed xml.
-
-    Args:
-        xml_path:
-            Absolute path to the file needing to be parsed.
-    
-    Returns:
-        Root of xml tree.
-    """
-
-    # Define lxml parser that's used for reading the tree with
-    # recover=True so it can pass badly formed XML lines
-    parser = lxml.etree.XMLParser(recover=True)
-
-    # Get the "root" of the tree for parsing specific elements
-    root = lxml.etree.parse(str(xml_path), parser).getroot()
-    
-    return root
-
-
-def parse_env_file(raw_dir: Path) -> Union[str, int]:
-    """
-    Parse Prairie View .env file by calling xml_parser()
-
-    Prairie View's .env file has a large quantity of metadata available inside
-    that can be used when building NWB files, spawning converters, and for
-    generally helpful information about the recording session. This will
-    parse the environment file for spawning ripping containers later. If a
-    matching ripper version is found by determine_ripper(), the version of the
-    ripper is returned. If no version is found, determine_ripper() will throw an
-    exception.
-
-    Args:
-        raw_dir:
-            Directory to raw data that needs conversion.
-
-    Returns:
-        ripper:
-            Ripper version as in major.minor.64.minor (ie 5.5.64.500).
-        num_channels:
-            Number of channels recorded from during the session.
-    """
-
-    # Generate list of environment files inside the raw directory
-    env_files = [file for file in raw_dir.glob("*.env")]
-
-    # An exception is thrown if more than one environment file is found. Something has gone wrong
-    # if more than one is present.
-    if len(env_files) != 1:
-        raise RippingError("Only expected 1 env file in %s, but found: %s" % (raw_dir, env_files))
-
-    # Get the root of xml tree
-    root = xml_parser(env_files[0])
-
-    # Get the version of the ripper required for file conversion
-    ripper = determine_ripper(root)
-
-    # Get the number of channels used during a recording
-    num_channels = determine_channels(root)
-
-    return ripper, num_channels
-
-
-def determine_ripper(root: lxml.etree._ElementTree) -> str:
-    """
-    Grab the version of Prairie View used for conversion.
-
-    The version of Prairie View that collected the data must
-    be the exact same as the version of ripper and specifically
-    'daq_int.dll' library. This will attempt to find the ripper in
-    the prairie_view directory inside docker/. If it finds a matching
-    version, it will grab the version number for use later. If it fails
-    to find a matching version, an exception is raised.
-
-    Args:
-        root:
-            Root of parsed xml tree
-    
-    Returns:
-        ripper
-    """
-
-    # The version of Prairie View used for recording is found on the top
-    # level of the .env file's xml tree and accessed through the attribute
-    # 'version'
-    version = root.attrib['version']
-
-    # Assemble the full path for the ripper, should it exist
-    ripper = RIPPER_DIRECTORY / f'{version}' / 'Image-BlockRippingUtility.exe'
-
-    # If the path generated returns None, a matching ripper was not found.
-    # Throw an exception.
-    if ripper is None:
-        raise RippingError("Could not find matching ripper!")
-
-    # If the ripper version was found, grab the version number for the
-    # ripping utility which is the parent directory of the executable
-    else:
-        ripper = ripper.parent.name
-
-    return ripper
-
-def determine_channels(root: lxml.etree._ElementTree) -> int:
-    """
-    Determine the number of channels used during a given recording.
-
-    The number of channels used will determine the number of images that
-    come out of the conversion process. This number is used later in the container
-    for killing the ripper when the number of tiffs found equals the number of 
-    expected images. However many number of images were collected is multiplied
-    by the value found here to calculate the total number of images to expect.
-
-    Args:
-        root:
-            Root of parsed xml tree
-    
-    Returns:
-        channels:
-            Number of channels recorded from during an imaging session.
-
-    """
-    
-    # The xpath to the channel attributes in a recording are found here
-    xpath = ".//PVStateValue[@key='channel']"
-
-    # Search the tree for this specific xpath
-    element = root.find(xpath)
-
-    #TODO: If this fails for some reason, an exception should be thrown probably...
-
-    # Bruker doesn't encode boolean values in their XML for these tags, so they must be evaluated
-    # as strings. If the channel was active during the recording, append that channel index to
-    # the list of used channels. Finally, get the length of the number of channels used to determine
-    # the number of channels recorded from during the session.
-    channels = len([channel.attrib["index"] for channel in element if channel.attrib["value"] == "True"])
-
-    return channels
-
-
-def determine_num_images(raw_dir: Path, num_channels: int) -> int:
-    """
-    Determine the number of images the ripper should expect to convert.
-
-    The ripping subprocess will continue to run until the script polling the
-    output directory reaches the number of expected tiffs. So this value is used
-    in a while loop during the ripping process until the conversion is complete.
-    The raw directory is used again in this function because it is the main .xml
-    file that is parsed and not the .env file, which is parsed earlier.
-
-    Args:
-        raw_dir:
-            Directory to raw data that needs conversion.
-        num_channels:
-            Number of channels used during a recording
-    
-    Returns:
-        num_images
-
-    """
-
-    # Prairie View outputs the main .xml file as the name of the recording
-    # Grab the directory's name and append .xml to it.
-    dir_glob_pattern = raw_dir.name + ".xml"
-
-    # Get a list of the xml files matching this pattern 
-    xml_files = [file for file in raw_dir.glob(dir_glob_pattern)]
-
-    # There should be only 1 xml file with this exact name. If there's not just one, something is
-    # wrong. Throw an exception if this happens.
-    if len(xml_files) != 1:
-        raise RippingError("Expected 1 recording XML file in %s, but found: %s" % (raw_dir, xml_files))
-
-    # Get the root of the main .xml file
-    root = xml_parser(xml_files[0])
-
-    # Navigate on the recording's xml root path to the last
-    # frame collected. Using the last() method gets you the
-    # final entry of that particular xpath.
-    last_frame = root.xpath("Sequence/Frame[last()]")
-
-    # Parse the xml element for index of this final frame.
-    # The Sequence/Frame xpath is a tuple, so access the tuple
-    # with [0] and get the index of the last frame. Multiply this
-    # value by the number of channels to get total number of
-    # images that were collected.
-    num_images = int(last_frame[0].attrib["index"]) * num_channels
-
-    return num_images
-
-def get_raw_data(recording_list_dir: Path) -> list:
-    """
-    Get the raw data that needs conversion.
-
-    A .txt file is generated when the file transfer from the local
-    Bruker machine is completed. This contains the paths of the microscopy
-    recordings that were completed for that day. `get_raw_data()` will
-    grab this file and parse it to make a list of directories that needs
-    converting. These will be passed to a subprocess that spawns the
-    containers one by one.
-
-    Args:
-        recording_list_dir:
-            Directory where datasets needing conversion in a txt file are held
-    
-    Returns:
-        raw_dirs
-    """
-
-    # Get text file used for converting the recordings.
-    recordings = [file for file in recording_list_dir.glob("*.txt")]
-
-    # Create empty list to read directories into from the txt file
-    raw_dirs = []
-
-    # Read each text file found in the recordings
-    for file in recordings:
-
-        # Open the files and read each line for the directory needing conversion
-        with open(file, "r") as f:
-            for path in f:
-                # Use rstrip to remove trailing characters at the
-                # end of each path. Creating files for conversion
-                # using text editors/shell scripting yields newlines (\n)
-                # when read into Python's open function it seems...
-                directory = Path(path.rstrip("\n"))
-                raw_dirs.append(directory)
-                
-    return raw_dirs
-
-
-# Main function
-if __name__ == "__main__":
-
-    # Gather the list of directories needing conversion.
-    conversion_list = get_raw_data(TRANSFER_DIRECTORY)
-
-    # For each directory in the list, determine the ripper, number of channels
-    # recorded from, number of images to expect, and the date of the recording session.
-    for directory in conversion_list:
-
-        ripper, num_channels = parse_env_file(directory)
-        num_images = determine_num_images(directory, num_channels)
-        recording_date = directory.parents[0].name
-
-        # Try searching for a plane number. If none exists for some reason,
-        # give the plane number a value of zero.
-        try:
-            plane_number = re.search("plane\d", directory.name).group()
-
-        except AttributeError:
-            
-            plane_number = "0"
-
-        # Generate the name of the container that will be spawned. Each container must have a unique name.
-        # The names generated will be: AnimalName-Plane#-RecordingDateYYYYMMDD-SNLKT-ripper
-        # Example: CSE012-plane1-20211112-SNLKT-ripper
-        container_name = "-".join([directory.parents[1].name, plane_number, recording_date, "SNLKT-ripper"])
-
-        # Create a list of commands and arguments the subprocess will execute. The commmand is build_container.sh.
-        # It has the following arguments:
-        # 1: Animal Name, plane, and date used for the ripper container name
-        # 2: Directory of raw data
-        # 3: Truncated name for appending to /data/ directory in container.
-        # 4: Version of ripper to use
-        # 5: Total number of images the container should expect to find when conversion is finished.
-
-        cmd = ["docker/build_container.sh %s %s %s %s %s" % (container_name, str(directory.parent), directory.name, ripper, num_images)]
-
-        process = subprocess.Popen(cmd, shell=True)
-
-        print("Starting container for:", container_name)
-
-    # Once the containers have been started, move the raw file conversion .txt file to the executed
-    # directory on the server.
-
-    # Get the list of files in the transfer directory
-    # TODO: Should get_raw_data() also return this list? Seems unnecessary to do this again...
-    executed_conversions = os.listdir(TRANSFER_DIRECTORY)
- 
-    # Once the containers have all been started, move the conversion file list to the executed
-    # file directory.
-    for file in executed_conversions:
-
-        # Shutil expects the paths to be converted into strings for transferring it seems, but not
-        # for the path it's supposed to move the files to...
-        shutil.move(str(TRANSFER_DIRECTORY / file), EXECUTED_DIRECTORY)
+# Jeremy Delahanty January 2022
+# Assistance from Chris Roat, Stanford University Deisseroth Lab August 2021
+# https://github.com/chrisroat
+# https://github.com/deisseroth-lab/two-photon/
+# Adapted for the Tye Lab by Jeremy Delahanty @ Salk Institute
+
+
+from pathlib import Path
+import lxml.etree
+import logging
+import argparse
+import re
+import shutil
+import signal
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from executors import EXECUTORS, DockerExecutor, Executor, MultiprocessingExecutor, RipJobSpec, default_log_file
+from job_ledger import COMPLETE_STATES, FAILED, PACKED, QUEUED, RIPPED, RIPPING, JobLedger, fingerprint
+from list_watcher import ListWatcher
+from metadata_cache import default_cache
+from pv_state import PVStateIndex, cached_pv_state
+from recording_xml import cached_recording_summary
+from scheduler import GIB, Job, JobScheduler
+
+# Import Tuple typing for typehints in documentation
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+# The directory with all the different ripping versions is static on our server
+RIPPER_DIRECTORY = Path("/snlkt/data/bruker_pipeline/docker/prairie_view/")
+
+# The directory to look for files requiring conversion/transfer is static and located here
+TRANSFER_DIRECTORY = Path("/snlkt/data/bruker_pipeline/raw_conversion")
+
+# The directory for where executed conversions are stored is static and located here. This
+# is where the raw path .txt file will go after the containers have been started.
+EXECUTED_DIRECTORY = Path("/snlkt/data/bruker_pipeline/executed_conversion")
+
+# The scratch directory on the host that containers rip into, mounted as /temp/ inside them
+SCRATCH_DIRECTORY = Path("/scratch/snlkt2p")
+
+# Containers and local rips write their logs here, mounted as /logs/ in the containers
+LOG_DIRECTORY = Path("/snlkt/data/bruker_pipeline/logs")
+
+# Resources each container is limited to by build_container.sh. The scheduler only starts
+# a container once these are free on the machine.
+CONTAINER_CPUS = 4
+CONTAINER_MEMORY_BYTES = 10 * GIB
+
+# Every conversion's state is kept here so running beyblade again skips recordings that
+# were already converted, retries failed ones and picks up ones that were interrupted.
+LEDGER_PATH = Path("/snlkt/data/bruker_pipeline/job_ledger.sqlite3")
+
+# Directories are checked before any container starts by this many threads at once, since
+# each check mostly waits on the server's filesystem.
+PREFLIGHT_THREADS = 16
+
+# In watch mode, lists still waiting on recordings that failed are read again this often
+# so the recordings are retried once the ledger's backoff allows.
+RETRY_LISTS_SECS = 5 * 60
+
+class RippingError(Exception):
+    """Error raised if problems encountered during data conversion."""
+
+
+def xml_parser(xml_path: Path) -> lxml.etree._ElementTree:
+    """
+    Parse Prairie View's xml with lxml.
+
+    Prairie View's xml that's contained in the .xml and .env files is
+    inconsistent with versioning. Using lxml allows for use of a parser
+    that can escape errors when it finds badly formed xml.
+
+    Args:
+        xml_path:
+            Absolute path to the file needing to be parsed.
+    
+    Returns:
+        Root of xml tree.
+    """
+
+    # Define lxml parser that's used for reading the tree with
+    # recover=True so it can pass badly formed XML lines
+    parser = lxml.etree.XMLParser(recover=True)
+
+    # Get the "root" of the tree for parsing specific elements
+    root = lxml.etree.parse(str(xml_path), parser).getroot()
+    
+    return root
+
+
+def parse_env_file(raw_dir: Path) -> Union[str, int]:
+    """
+    Parse Prairie View .env file with cached_pv_state()
+
+    Prairie View's .env file has a large quantity of metadata available inside
+    that can be used when building NWB files, spawning converters, and for
+    generally helpful information about the recording session. This will
+    parse the environment file for spawning ripping containers later. If a
+    matching ripper version is found by determine_ripper(), the version of the
+    ripper is returned. If no version is found, determine_ripper() will throw an
+    exception.
+
+    Args:
+        raw_dir:
+            Directory to raw data that needs conversion.
+
+    Returns:
+        ripper:
+            Ripper version as in major.minor.64.minor (ie 5.5.64.500).
+        num_channels:
+            Number of channels recorded from during the session.
+    """
+
+    # Generate list of environment files inside the raw directory
+    env_files = [file for file in raw_dir.glob("*.env")]
+
+    # An exception is thrown if more than one environment file is found. Something has gone wrong
+    # if more than one is present.
+    if len(env_files) != 1:
+        raise RippingError("Only expected 1 env file in %s, but found: %s" % (raw_dir, env_files))
+
+    # Every state value in the file is indexed in one pass and kept in the metadata cache,
+    # shared with the NWB utilities, so the .env file is only parsed again once it changes.
+    pv_state = cached_pv_state(env_files[0])
+
+    # Get the version of the ripper required for file conversion
+    ripper = determine_ripper(pv_state)
+
+    # Get the number of channels used during a recording
+    num_channels = determine_channels(pv_state)
+
+    return ripper, num_channels
+
+
+def determine_ripper(pv_state: PVStateIndex) -> str:
+    """
+    Grab the version of Prairie View used for conversion.
+
+    The version of Prairie View that collected the data must
+    be the exact same as the version of ripper and specifically
+    'daq_int.dll' library. This will attempt to find the ripper in
+    the prairie_view directory inside docker/. If it finds a matching
+    version, it will grab the version number for use later. If it fails
+    to find a matching version, an exception is raised.
+
+    Args:
+        pv_state:
+            Index of the .env file's state values
+    
+    Returns:
+        ripper
+    """
+
+    # The version of Prairie View used for recording is found on the top
+    # level of the .env file's xml tree and accessed through the attribute
+    # 'version'
+    version = pv_state.attributes['version']
+
+    # Assemble the full path for the ripper, should it exist
+    ripper = RIPPER_DIRECTORY / f'{version}' / 'Image-BlockRippingUtility.exe'
+
+    # If the path generated doesn't exist, a matching ripper was not found.
+    # Throw an exception.
+    if not ripper.exists():
+        raise RippingError("Could not find matching ripper for Prairie View %s at %s" % (version, ripper))
+
+    # If the ripper version was found, grab the version number for the
+    # ripping utility which is the parent directory of the executable
+    else:
+        ripper = ripper.parent.name
+
+    return ripper
+
+def determine_channels(pv_state: PVStateIndex) -> int:
+    """
+    Determine the number of channels used during a given recording.
+
+    The number of channels used will determine the number of images that
+    come out of the conversion process. This number is used later in the container
+    for killing the ripper when the number of tiffs found equals the number of 
+    expected images. However many number of images were collected is multiplied
+    by the value found here to calculate the total number of images to expect.
+
+    Args:
+        pv_state:
+            Index of the .env file's state values
+    
+    Returns:
+        channels:
+            Number of channels recorded from during an imaging session.
+
+    """
+
+    # The channel state holds one indexed value per channel
+    if "channel" not in pv_state.indexed:
+        raise RippingError("No channel states found in the .env file")
+
+    # Bruker doesn't encode boolean values in their XML for these tags, so they must be evaluated
+    # as strings. If the channel was active during the recording, count that channel. The number
+    # of channels counted is the number of channels recorded from during the session.
+    channels = len([index for index, value in pv_state.indexed["channel"].items() if value == "True"])
+
+    return channels
+
+
+def determine_num_images(raw_dir: Path, num_channels: int) -> int:
+    """
+    Determine the number of images the ripper should expect to convert.
+
+    The ripping subprocess will continue to run until the script polling the
+    output directory reaches the number of expected tiffs. So this value is used
+    in a while loop during the ripping process until the conversion is complete.
+    The raw directory is used again in this function because it is the main .xml
+    file that is parsed and not the .env file, which is parsed earlier.
+
+    Args:
+        raw_dir:
+            Directory to raw data that needs conversion.
+        num_channels:
+            Number of channels used during a recording
+    
+    Returns:
+        num_images
+
+    """
+
+    # Prairie View outputs the main .xml file as the name of the recording
+    # Grab the directory's name and append .xml to it.
+    dir_glob_pattern = raw_dir.name + ".xml"
+
+    # Get a list of the xml files matching this pattern 
+    xml_files = [file for file in raw_dir.glob(dir_glob_pattern)]
+
+    # There should be only 1 xml file with this exact name. If there's not just one, something is
+    # wrong. Throw an exception if this happens.
+    if len(xml_files) != 1:
+        raise RippingError("Expected 1 recording XML file in %s, but found: %s" % (raw_dir, xml_files))
+
+    # Recording XMLs have an element for every frame and can be hundreds of MB, so
+    # they're streamed through rather than loaded into a tree, and only once for every
+    # version of the file.
+    summary = cached_recording_summary(xml_files[0])
+
+    if not summary.sequences:
+        raise RippingError("No sequences found in %s" % xml_files[0])
+
+    # Use the index of the final frame in the first sequence. Multiply this
+    # value by the number of channels to get total number of images that
+    # were collected.
+    num_images = summary.sequences[0].last_index * num_channels
+
+    return num_images
+
+
+def get_conversion_lists(recording_list_dir: Path) -> Dict[Path, List[Path]]:
+    """
+    Read every conversion .txt file and the directories each one lists.
+
+    Args:
+        recording_list_dir:
+            Directory where datasets needing conversion in a txt file are held
+
+    Returns:
+        Dictionary of each .txt file to the raw directories listed in it.
+    """
+
+    return {file: read_conversion_list(file) for file in recording_list_dir.glob("*.txt")}
+
+
+def read_conversion_list(file: Path) -> List[Path]:
+    """
+    Read the raw directories listed in a conversion .txt file.
+
+    Args:
+        file:
+            Conversion .txt file with one raw directory per line
+
+    Returns:
+        raw_dirs
+    """
+
+    # Use rstrip to remove trailing characters at the end of each path. Creating files
+    # for conversion using text editors/shell scripting yields newlines (\n).
+    with open(file, "r") as f:
+        return [Path(path.rstrip("\n")) for path in f if path.strip()]
+
+
+def get_raw_data(recording_list_dir: Path) -> list:
+    """
+    Get the raw data that needs conversion.
+
+    A .txt file is generated when the file transfer from the local
+    Bruker machine is completed. This contains the paths of the microscopy
+    recordings that were completed for that day. `get_raw_data()` will
+    grab this file and parse it to make a list of directories that needs
+    converting. These will be passed to a subprocess that spawns the
+    containers one by one.
+
+    Args:
+        recording_list_dir:
+            Directory where datasets needing conversion in a txt file are held
+    
+    Returns:
+        raw_dirs
+    """
+
+    return [directory for raw_dirs in get_conversion_lists(recording_list_dir).values() for directory in raw_dirs]
+
+
+def estimate_scratch_bytes(raw_dir: Path) -> int:
+    """
+    Estimate how much scratch space ripping a recording will take.
+
+    The tiffs the ripper writes are uncompressed, so together they are about the size
+    of the raw data they come from.
+
+    Args:
+        raw_dir:
+            Directory to raw data that needs conversion.
+
+    Returns:
+        scratch_bytes
+    """
+
+    return sum(path.stat().st_size for path in raw_dir.glob("*RAWDATA*"))
+
+
+def conversion_state(raw_dir: Path) -> Optional[str]:
+    """
+    Work out how far a recording's conversion got from what's on scratch.
+
+    rip.py renames its output directory to end in _tiffs only once every tiff has been
+    ripped, and writes an HDF5 file next to it when it packs frames as they're ripped.
+
+    Args:
+        raw_dir:
+            Directory to raw data that needs conversion.
+
+    Returns:
+        The ledger state of a finished conversion, or None if it didn't finish.
+    """
+
+    if not (SCRATCH_DIRECTORY / (raw_dir.name + "_tiffs")).is_dir():
+        return None
+
+    if (SCRATCH_DIRECTORY / (raw_dir.name + ".hdf5")).is_file():
+        return PACKED
+
+    return RIPPED
+
+
+def container_name(raw_dir: Path) -> str:
+    """
+    Generate the name of the container that will rip a recording.
+
+    Each container must have a unique name. The names generated will be:
+    AnimalName-Plane#-RecordingDateYYYYMMDD-SNLKT-ripper, for example
+    CSE012-plane1-20211112-SNLKT-ripper.
+
+    Args:
+        raw_dir:
+            Directory to raw data that needs conversion.
+
+    Returns:
+        container_name
+    """
+
+    recording_date = raw_dir.parents[0].name
+
+    # Try searching for a plane number. If none exists for some reason,
+    # give the plane number a value of zero.
+    try:
+        plane_number = re.search(r"plane\d", raw_dir.name).group()
+
+    except AttributeError:
+
+        plane_number = "0"
+
+    return "-".join([raw_dir.parents[1].name, plane_number, recording_date, "SNLKT-ripper"])
+
+
+@dataclass
+class PlannedConversion:
+    """A directory from the conversion lists and what preflight found out about it."""
+
+    raw_dir: Path
+    container_name: str = ""
+    ripper: Optional[str] = None
+    num_images: int = 0
+    scratch_bytes: int = 0
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+
+@dataclass
+class ConversionPlan:
+    """Every directory's preflight result, in the order they were listed."""
+
+    conversions: List[PlannedConversion] = field(default_factory=list)
+    seconds: float = 0.0
+
+    @property
+    def ready(self) -> List[PlannedConversion]:
+        return [conversion for conversion in self.conversions if conversion.ok]
+
+    @property
+    def failed(self) -> List[PlannedConversion]:
+        return [conversion for conversion in self.conversions if not conversion.ok]
+
+    def log(self):
+        """Log the plan, with every problem found in each directory."""
+
+        logging.info("Preflight checked %d directories in %.1f seconds: %d ready, %d with errors",
+                     len(self.conversions), self.seconds, len(self.ready), len(self.failed))
+
+        for conversion in self.conversions:
+            if conversion.ok:
+                logging.info("  %s: %d images with ripper %s", conversion.raw_dir, conversion.num_images, conversion.ripper)
+            else:
+                logging.error("  %s: %s", conversion.raw_dir, "; ".join(conversion.errors))
+
+
+def _contains_tiffs(directory: Path) -> bool:
+
+    try:
+        with os.scandir(directory) as entries:
+            return any(entry.name.endswith(".ome.tif") for entry in entries)
+    except FileNotFoundError:
+        return False
+
+
+def check_directory(raw_dir: Path) -> PlannedConversion:
+    """
+    Check a directory is ready to be ripped and work out what ripping it involves.
+
+    Every check is run, rather than stopping at the first problem, so a directory's
+    errors can all be fixed at once.
+
+    Args:
+        raw_dir:
+            Directory to raw data that needs conversion.
+
+    Returns:
+        The planned conversion, with any errors found.
+    """
+
+    conversion = PlannedConversion(raw_dir)
+
+    if not raw_dir.is_dir():
+        conversion.errors.append("directory does not exist")
+        return conversion
+
+    conversion.container_name = container_name(raw_dir)
+
+    try:
+        conversion.ripper, num_channels = parse_env_file(raw_dir)
+    except RippingError as err:
+        conversion.errors.append(str(err))
+        num_channels = None
+
+    if num_channels is not None:
+        try:
+            conversion.num_images = determine_num_images(raw_dir, num_channels)
+            if conversion.num_images == 0:
+                conversion.errors.append("recording XML has no frames")
+        except RippingError as err:
+            conversion.errors.append(str(err))
+
+    if not any(raw_dir.glob("*RAWDATA*")):
+        conversion.errors.append("no RAWDATA files")
+    if not any(raw_dir.glob("*Filelist.txt")):
+        conversion.errors.append("no Filelist.txt")
+
+    # The ripper won't write over tiffs that are already there, and a finished rip of the
+    # recording would be overwritten when this one finished.
+    scratch_dir = SCRATCH_DIRECTORY / raw_dir.name
+    if _contains_tiffs(raw_dir):
+        conversion.errors.append("raw directory already contains tiffs")
+    if _contains_tiffs(scratch_dir):
+        conversion.errors.append("tiffs already in %s" % scratch_dir)
+    if Path(str(scratch_dir) + "_tiffs").exists():
+        conversion.errors.append("already ripped to %s_tiffs" % scratch_dir)
+
+    conversion.scratch_bytes = estimate_scratch_bytes(raw_dir)
+
+    return conversion
+
+
+def preflight(raw_dirs: Iterable[Path], threads: int = PREFLIGHT_THREADS) -> ConversionPlan:
+    """
+    Check every directory in the conversion lists before any container starts.
+
+    The directories are checked concurrently, since each check spends its time waiting
+    on the server: the .env file and a matching ripper, the recording XML's frame count,
+    the RAWDATA and Filelist files, and that no tiffs exist yet. A problem with one
+    directory is recorded in the plan rather than stopping the others.
+
+    Args:
+        raw_dirs:
+            Directories to raw data that need conversion.
+        threads:
+            Number of directories checked at once.
+
+    Returns:
+        Plan of every directory's expected images and errors.
+    """
+
+    start = time.perf_counter()
+
+    def check(raw_dir: Path) -> PlannedConversion:
+        try:
+            return check_directory(raw_dir)
+        except Exception as err:
+            return PlannedConversion(raw_dir, errors=["preflight failed: %s" % err])
+
+    # Everything parsed is saved to the metadata cache once at the end, not once per file
+    with default_cache().batch(), ThreadPoolExecutor(threads) as pool:
+        conversions = list(pool.map(check, raw_dirs))
+
+    return ConversionPlan(conversions, time.perf_counter() - start)
+
+
+class ConversionRunner:
+    """
+    Plans conversions, hands them to the scheduler and records them in the job ledger.
+
+    Conversion lists can be added at any time, all at once for a single run or one by one
+    as they're written in watch mode. Directories already queued or running are never
+    submitted twice, and the directories the ledger says are finished, waiting on a
+    retry or given up on are skipped.
+
+    Args:
+        ledger:
+            Ledger every conversion's state is recorded in.
+        scheduler:
+            Scheduler the containers are run by. Its start and finish callbacks are set
+            to update the ledger.
+        executor:
+            Backend that runs each conversion, usually in a Docker container.
+        rip_options:
+            RipJobSpec fields given to every conversion, such as stream_channel or
+            stall_secs, on top of the ones worked out for each recording.
+    """
+
+    def __init__(self, ledger: JobLedger, scheduler: JobScheduler, executor: Executor,
+                 rip_options: Optional[Dict[str, Any]] = None):
+        self.ledger = ledger
+        self.scheduler = scheduler
+        self.executor = executor
+        self.rip_options = rip_options or {}
+        scheduler.on_start = self._job_started
+        scheduler.on_finish = self._job_finished
+
+        # Lists that haven't been moved to the executed directory yet, and the fingerprint
+        # each of their directories was converted under.
+        self.conversion_lists: Dict[Path, List[Path]] = {}
+        self.fingerprints: Dict[Path, str] = {}
+
+        # Each submitted container's raw directory and fingerprint, so the ledger can be
+        # updated when the scheduler starts and finishes it.
+        self.submitted: Dict[str, tuple] = {}
+        self.active = set()
+
+    def add_lists(self, conversion_lists: Dict[Path, List[Path]]):
+        """Preflight the directories in the lists that need converting and submit them."""
+
+        self.conversion_lists.update(conversion_lists)
+
+        # Each directory is only converted once, even if it's in more than one list.
+        directories = list(dict.fromkeys(directory for raw_dirs in conversion_lists.values()
+                                         for directory in raw_dirs if directory not in self.active))
+
+        with ThreadPoolExecutor(PREFLIGHT_THREADS) as pool:
+            self.fingerprints.update(zip(directories, pool.map(fingerprint, directories)))
+
+        # Decide which directories need converting from the ledger.
+        to_convert = []
+        for directory in directories:
+
+            directory_fingerprint = self.fingerprints[directory]
+            run, reason = self.ledger.should_run(directory, directory_fingerprint)
+
+            # A conversion left queued or ripping was interrupted, but its container may have
+            # finished the tiffs before beyblade stopped. Don't rip those again.
+            job = self.ledger.get(directory, directory_fingerprint)
+            if run and job is not None and job["state"] in (QUEUED, RIPPING):
+                state = conversion_state(directory)
+                if state is not None:
+                    self.ledger.mark(directory, directory_fingerprint, state)
+                    run, reason = False, "interrupted after the tiffs were finished"
+
+            if not run:
+                logging.info("Skipping %s: %s", directory, reason)
+                continue
+
+            logging.info("Converting %s: %s", directory, reason)
+            to_convert.append(directory)
+
+        if not to_convert:
+            return
+
+        # For each directory to convert, determine the ripper, number of channels recorded
+        # from and number of images to expect, and check it's ready to rip, before starting
+        # anything.
+        plan = preflight(to_convert)
+        plan.log()
+
+        for conversion in plan.failed:
+            self.ledger.mark(conversion.raw_dir, self.fingerprints[conversion.raw_dir], FAILED,
+                             "; ".join(conversion.errors))
+
+        for conversion in plan.ready:
+            self._submit(conversion)
+
+    def _submit(self, conversion: PlannedConversion):
+
+        directory = conversion.raw_dir
+
+        spec = RipJobSpec(
+            name=conversion.container_name,
+            raw_dir=directory,
+            ripper_version=conversion.ripper,
+            num_images=conversion.num_images,
+            log_file=default_log_file(conversion.container_name),
+            **self.rip_options
+        )
+
+        self.submitted[conversion.container_name] = (directory, self.fingerprints[directory])
+        self.active.add(directory)
+        self.ledger.mark(directory, self.fingerprints[directory], QUEUED)
+
+        self.scheduler.submit(self.executor.job(
+            spec,
+            cpus=CONTAINER_CPUS,
+            memory_bytes=CONTAINER_MEMORY_BYTES,
+            scratch_bytes=conversion.scratch_bytes
+        ))
+
+    def _job_started(self, job: Job):
+        self.ledger.mark(*self.submitted[job.name], RIPPING)
+
+    def _job_finished(self, job: Job):
+
+        directory, directory_fingerprint = self.submitted.pop(job.name)
+        self.active.discard(directory)
+
+        state = conversion_state(directory) if job.succeeded else None
+
+        if state is not None:
+            self.ledger.mark(directory, directory_fingerprint, state)
+        elif job.succeeded:
+            self.ledger.mark(directory, directory_fingerprint, FAILED, "container exited without finishing the tiffs")
+        else:
+            message = job.message or "container exited with status %d" % job.returncode
+            self.ledger.mark(directory, directory_fingerprint, FAILED, message)
+
+    def move_finished_lists(self, warn: bool = False):
+        """
+        Move each list whose recordings have all been converted to the executed directory.
+
+        Lists with recordings that haven't been converted stay behind so they're retried.
+
+        Args:
+            warn:
+                Log a warning for every list left behind.
+        """
+
+        for file, raw_dirs in list(self.conversion_lists.items()):
+
+            states = [self.ledger.get(directory, self.fingerprints.get(directory, "")) for directory in raw_dirs]
+
+            if all(job is not None and job["state"] in COMPLETE_STATES for job in states):
+
+                # A list with the same name may have been executed before, so keep both
+                destination = EXECUTED_DIRECTORY / file.name
+                if destination.exists():
+                    destination = destination.with_name("%s_%s%s" % (file.stem, time.strftime("%Y%m%d%H%M%S"),
+                                                                      file.suffix))
+
+                try:
+                    # Shutil expects the paths to be converted into strings for transferring it seems
+                    shutil.move(str(file), str(destination))
+                except OSError as err:
+                    logging.error("Could not move %s to %s: %s", file.name, EXECUTED_DIRECTORY, err)
+                    continue
+
+                del self.conversion_lists[file]
+                logging.info("Moved %s to %s", file.name, destination)
+
+            elif warn:
+                logging.warning("Leaving %s in %s until all of its recordings are converted", file.name, file.parent)
+
+
+def watch_conversions(runner: ConversionRunner, recording_list_dir: Path):
+    """
+    Convert recordings as soon as their conversion lists are written.
+
+    Runs until SIGTERM or SIGINT is received, then stops starting containers and waits
+    for the running ones to finish. A second signal stops beyblade without waiting.
+    Lists with recordings that failed stay in the directory and are read again every
+    RETRY_LISTS_SECS, so their recordings are retried once the ledger's backoff allows.
+
+    Args:
+        runner:
+            Runner the lists' recordings are converted by.
+        recording_list_dir:
+            Directory where datasets needing conversion in a txt file are held
+    """
+
+    stopping = []
+
+    def stop(signum, frame):
+        logging.info("Received %s, finishing the running conversions", signal.Signals(signum).name)
+        stopping.append(signum)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    last_retry = time.monotonic()
+
+    with ListWatcher(recording_list_dir, poll_secs=runner.scheduler.poll_secs) as lists:
+
+        while not stopping:
+
+            conversion_lists = {}
+
+            # Lists that are still here after a while are read again for retries
+            if time.monotonic() - last_retry >= RETRY_LISTS_SECS:
+                last_retry = time.monotonic()
+                conversion_lists.update((file, raw_dirs) for file, raw_dirs in runner.conversion_lists.items()
+                                        if file.exists())
+
+            for file in lists.wait(runner.scheduler.poll_secs):
+                try:
+                    conversion_lists[file] = read_conversion_list(file)
+                except FileNotFoundError:
+                    continue
+                logging.info("Found conversion list %s", file.name)
+
+            if conversion_lists:
+                runner.add_lists(conversion_lists)
+
+            runner.scheduler.poll()
+            runner.move_finished_lists()
+
+    runner.scheduler.drain()
+    runner.move_finished_lists(warn=True)
+
+
+# Main function
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Rip Bruker recordings listed in %s to tiffs" % TRANSFER_DIRECTORY)
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep running and convert recordings as soon as their lists are written")
+    parser.add_argument("--executor", choices=sorted(EXECUTORS), default=DockerExecutor.name,
+                        help="Run each conversion in a Docker container, a local rip.py process or a worker process")
+    parser.add_argument("--stream_channel", type=int,
+                        help="Channel to pack into an HDF5 file while ripping")
+    parser.add_argument("--chunksize", type=int, default=128,
+                        help="Number of frames per HDF5 chunk when streaming")
+    parser.add_argument("--delete_packed", action="store_true",
+                        help="Delete tiffs once they have been packed into the HDF5 file")
+    parser.add_argument("--stall_secs", type=float,
+                        help="Kill the ripper if no new tiffs appear for this many seconds")
+    parser.add_argument("--checksum_manifest", action="store_true",
+                        help="Record the crc32 of every tiff in the frame manifest")
+    parser.add_argument("--decode_verify", action="store_true",
+                        help="Fully decode every tiff when verifying them after ripping")
+    parser.add_argument("--ripper_command",
+                        help="Command to run in place of the ripper, such as \"python fake_ripper.py --rate 50\"")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    ledger = JobLedger(LEDGER_PATH)
+
+    # Containers are started as cores, memory and scratch space become free rather than all
+    # at once, and each one is waited on until it exits. In watch mode they're kept out of
+    # reach of a Ctrl-C so they can finish while beyblade shuts down.
+    scheduler = JobScheduler(SCRATCH_DIRECTORY, new_session=args.watch)
+
+    if args.executor == MultiprocessingExecutor.name:
+        executor = MultiprocessingExecutor(SCRATCH_DIRECTORY, RIPPER_DIRECTORY, LOG_DIRECTORY, new_session=args.watch)
+    else:
+        executor = EXECUTORS[args.executor](SCRATCH_DIRECTORY, RIPPER_DIRECTORY, LOG_DIRECTORY)
+
+    # Passed on to rip.py for every conversion
+    rip_options = {
+        "stream_channel": args.stream_channel,
+        "chunksize": args.chunksize,
+        "delete_packed": args.delete_packed,
+        "stall_secs": args.stall_secs,
+        "checksum_manifest": args.checksum_manifest,
+        "decode_verify": args.decode_verify,
+        "ripper_command": args.ripper_command,
+    }
+
+    runner = ConversionRunner(ledger, scheduler, executor, rip_options)
+
+    if args.watch:
+        watch_conversions(runner, TRANSFER_DIRECTORY)
+
+    else:
+        # Gather the lists of directories needing conversion and convert them all.
+        runner.add_lists(get_conversion_lists(TRANSFER_DIRECTORY))
+        scheduler.run()
+
+        # Once the containers have finished, move each conversion .txt file whose recordings
+        # have all been converted to the executed directory on the server.
+        runner.move_finished_lists(warn=True)
+
+    ledger.close()
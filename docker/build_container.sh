@@ -15,6 +15,7 @@ log_filename="$log_identifier".log
 # 3. Truncated path for mounting data directory in container
 # 4. Version of ripper to use
 # 5. Total number of images to be converted
+# Any further arguments are passed through to rip.py, ie --stream_channel 2
 echo $1 >> logs/$log_filename
 echo $2 >> logs/$log_filename
 echo $3 >> logs/$log_filename
@@ -37,4 +38,4 @@ sudo docker run \
        --memory=10g \
        --name=$1 \
        snlkt-bruker-ripper:latest \
-       /apps/runscript.sh $3 $4 $log_filename $5
+       /apps/runscript.sh $3 $4 $log_filename $5 "${@:6}"
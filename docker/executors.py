@@ -0,0 +1,237 @@
+"""Backends that run a ripping job: in a Docker container, as a local process or in a worker process."""
+
+import logging
+import multiprocessing
+import os
+import shlex
+import sys
+from dataclasses import dataclass
+from datetime import date
+from pathlib import Path
+from typing import List, Optional
+
+from scheduler import Job
+
+# rip.py sits next to this module, and is run directly by the local backend
+RIP_SCRIPT = Path(__file__).resolve().parent / "rip.py"
+
+# build_container.sh is run from the root of the repository, like beyblade.sh does
+BUILD_CONTAINER_SCRIPT = "docker/build_container.sh"
+
+
+def default_log_file(name: str) -> str:
+    """Name a job's log file after the job and today's date, like build_container.sh does."""
+
+    return "%s-%s.log" % (name, date.today().strftime("%Y%m%d"))
+
+
+@dataclass
+class RipJobSpec:
+    """Everything needed to rip one recording, whichever backend runs it."""
+
+    name: str
+    raw_dir: Path
+    ripper_version: str
+    num_images: int
+    log_file: str
+
+    stream_channel: Optional[int] = None
+    chunksize: int = 128
+    delete_packed: bool = False
+    stall_secs: Optional[float] = None
+    ripper_command: Optional[str] = None
+    checksum_manifest: bool = False
+    decode_verify: bool = False
+
+    def rip_args(self) -> List[str]:
+        """The options for rip.py beyond the ones every backend passes."""
+
+        args = []
+        if self.stream_channel is not None:
+            args += ["--stream_channel", str(self.stream_channel), "--chunksize", str(self.chunksize)]
+            if self.delete_packed:
+                args.append("--delete_packed")
+        if self.stall_secs is not None:
+            args += ["--stall_secs", str(self.stall_secs)]
+        if self.ripper_command is not None:
+            args += ["--ripper_command", self.ripper_command]
+        if self.checksum_manifest:
+            args.append("--checksum_manifest")
+        if self.decode_verify:
+            args.append("--decode_verify")
+
+        return args
+
+
+class Executor:
+    """
+    Turns job specs into scheduler jobs that run them.
+
+    Args:
+        scratch_dir:
+            Directory recordings are ripped into on this machine.
+        ripper_dir:
+            Directory holding a directory of each ripper version on this machine.
+        log_dir:
+            Directory the jobs' log files are written to.
+    """
+
+    name = ""
+
+    def __init__(self, scratch_dir: Path, ripper_dir: Path, log_dir: Path):
+        self.scratch_dir = Path(scratch_dir)
+        self.ripper_dir = Path(ripper_dir)
+        self.log_dir = Path(log_dir)
+
+    def job(self, spec: RipJobSpec, cpus: float, memory_bytes: int, scratch_bytes: int) -> Job:
+        return Job(name=spec.name, cmd=self.command(spec), cpus=cpus, memory_bytes=memory_bytes,
+                   scratch_bytes=scratch_bytes)
+
+    def command(self, spec: RipJobSpec) -> List[str]:
+        raise NotImplementedError
+
+
+class DockerExecutor(Executor):
+    """
+    Rips in a container started by build_container.sh, the way the pipeline runs on the servers.
+
+    The container's mounts for scratch, the rippers and logs, its resource limits and its
+    log file name are set by build_container.sh, so the paths given here aren't used.
+    """
+
+    name = "docker"
+
+    def command(self, spec: RipJobSpec) -> List[str]:
+
+        # build_container.sh has the following arguments:
+        # 1: Animal Name, plane, and date used for the ripper container name
+        # 2: Directory of raw data
+        # 3: Truncated name for appending to /data/ directory in container.
+        # 4: Version of ripper to use
+        # 5: Total number of images the container should expect to find when conversion is finished.
+        # Any further arguments are passed through to rip.py
+        return [BUILD_CONTAINER_SCRIPT, spec.name, str(spec.raw_dir.parent), spec.raw_dir.name,
+                spec.ripper_version, str(spec.num_images)] + spec.rip_args()
+
+
+class LocalExecutor(Executor):
+    """
+    Rips by running rip.py as a process on this machine, without Docker.
+
+    The ripper is still a Windows program, so on Linux Wine has to be installed. The
+    Python environment running rip.py needs the packages in environment.yml.
+
+    Args:
+        python:
+            Python interpreter rip.py is run with. Defaults to the one running beyblade.
+    """
+
+    name = "local"
+
+    def __init__(self, scratch_dir: Path, ripper_dir: Path, log_dir: Path, python: str = sys.executable):
+        super().__init__(scratch_dir, ripper_dir, log_dir)
+        self.python = python
+
+    def command(self, spec: RipJobSpec) -> List[str]:
+        return [
+            self.python, str(RIP_SCRIPT),
+            "--directory", spec.raw_dir.name,
+            "--ripper_version", spec.ripper_version,
+            "--num_images", str(spec.num_images),
+            "--log_file", spec.log_file,
+            "--data_root", str(spec.raw_dir.parent),
+            "--scratch_dir", str(self.scratch_dir),
+            "--ripper_dir", str(self.ripper_dir),
+            "--log_dir", str(self.log_dir),
+        ] + spec.rip_args()
+
+
+class _ProcessHandle:
+    """Gives a multiprocessing.Process the poll() the scheduler expects of a Popen."""
+
+    def __init__(self, process: multiprocessing.Process):
+        self.process = process
+
+    def poll(self) -> Optional[int]:
+        if self.process.is_alive():
+            return None
+
+        self.process.join()
+        return self.process.exitcode
+
+    def kill(self):
+        self.process.kill()
+
+
+def _rip_in_process(spec: RipJobSpec, scratch_dir: Path, ripper_dir: Path, log_dir: Path, new_session: bool):
+
+    if new_session:
+        os.setsid()
+
+    logging.basicConfig(level=logging.INFO,
+                        filename=str(log_dir / spec.log_file),
+                        format='%(asctime)s.%(msecs)03d %(module)s:%(lineno)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        force=True)
+
+    # Imported here so the scheduler's process doesn't need the ripping dependencies
+    from rip import raw_to_tiff
+
+    logging.info("Worker process starting for %s" % spec.raw_dir)
+
+    options = {}
+    if spec.stall_secs is not None:
+        options["stall_secs"] = spec.stall_secs
+    if spec.ripper_command is not None:
+        options["ripper_command"] = shlex.split(spec.ripper_command)
+    if spec.checksum_manifest:
+        options["checksum_manifest"] = True
+    if spec.decode_verify:
+        options["decode_verify"] = True
+
+    try:
+        raw_to_tiff(spec.raw_dir.name, spec.ripper_version, spec.num_images, spec.stream_channel,
+                    spec.chunksize, spec.delete_packed, data_root=spec.raw_dir.parent,
+                    scratch_dir=scratch_dir, ripper_dir=ripper_dir, **options)
+    except Exception:
+        logging.exception("Ripping %s failed", spec.raw_dir)
+        sys.exit(1)
+
+
+class MultiprocessingExecutor(Executor):
+    """
+    Rips in a worker process started with multiprocessing, calling raw_to_tiff() directly.
+
+    This skips starting a container for every job, which makes it the quickest way to
+    run the pipeline's Python stages on a workstation. Workers are started with the
+    spawn method, so they don't inherit the scheduler's threads or database connection.
+
+    Args:
+        new_session:
+            Start each worker in its own session, so a Ctrl-C in the terminal doesn't
+            reach it.
+    """
+
+    name = "multiprocessing"
+
+    def __init__(self, scratch_dir: Path, ripper_dir: Path, log_dir: Path, new_session: bool = False):
+        super().__init__(scratch_dir, ripper_dir, log_dir)
+        self.new_session = new_session
+        self._context = multiprocessing.get_context("spawn")
+
+    def job(self, spec: RipJobSpec, cpus: float, memory_bytes: int, scratch_bytes: int) -> Job:
+
+        def launch() -> _ProcessHandle:
+            process = self._context.Process(
+                target=_rip_in_process,
+                args=(spec, self.scratch_dir, self.ripper_dir, self.log_dir, self.new_session),
+                name=spec.name,
+            )
+            process.start()
+            return _ProcessHandle(process)
+
+        return Job(name=spec.name, launch=launch, cpus=cpus, memory_bytes=memory_bytes,
+                   scratch_bytes=scratch_bytes)
+
+
+EXECUTORS = {executor.name: executor for executor in (DockerExecutor, LocalExecutor, MultiprocessingExecutor)}
@@ -0,0 +1,184 @@
+"""
+Stand-in for Bruker's Image-BlockRippingUtility for exercising rip.py without Wine or real data.
+
+Accepts the same command line rip.py gives the ripper and behaves the way the ripper
+does as far as rip.py can tell: the metadata files and a References directory are
+copied into the output directory, the voltage recording is written out as a csv, the
+tiffs follow one by one and the process never exits on its own. Its pace and the ways
+it can misbehave are set with the options given before the ripper's arguments, e.g.
+
+    python fake_ripper.py --frames 1000 --rate 200 --jitter 0.5 --hang_after 900 \
+        -KeepRaw -DoNotRipToInputDirectory -IncludeSubFolders \
+        -AddRawFileWithSubFolders /data/recording -SetOutputDirectory /temp/ -Convert
+
+rip.py runs it in place of the ripper with `--ripper_command "python fake_ripper.py ..."`.
+"""
+
+import argparse
+import logging
+import random
+import shutil
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CSV_CHANNELS = ["lick", "speaker", "solenoid", "airpuff", "trigger"]
+
+
+def tiff_bytes(image: np.ndarray) -> bytes:
+    """Encode a 2D uint16 image as a minimal uncompressed single strip TIFF."""
+
+    height, width = image.shape
+    pixels = image.astype("<u2").tobytes()
+
+    # Header, then the pixel data, then the image file directory
+    ifd_offset = 8 + len(pixels)
+    tags = [
+        (256, 3, 1, width),  # ImageWidth
+        (257, 3, 1, height),  # ImageLength
+        (258, 3, 1, 16),  # BitsPerSample
+        (259, 3, 1, 1),  # Compression: none
+        (262, 3, 1, 1),  # PhotometricInterpretation: black is zero
+        (273, 4, 1, 8),  # StripOffsets
+        (277, 3, 1, 1),  # SamplesPerPixel
+        (278, 3, 1, height),  # RowsPerStrip
+        (279, 4, 1, len(pixels)),  # StripByteCounts
+    ]
+
+    ifd = struct.pack("<H", len(tags))
+    for tag, type_, count, value in tags:
+        if type_ == 3:
+            ifd += struct.pack("<HHIHH", tag, type_, count, value, 0)
+        else:
+            ifd += struct.pack("<HHII", tag, type_, count, value)
+    ifd += struct.pack("<I", 0)
+
+    return b"II*\x00" + struct.pack("<I", ifd_offset) + pixels + ifd
+
+
+def parse_ripper_args(argv: List[str]) -> Tuple[Path, Path]:
+    """Pull the raw data and output directories out of the ripper's own arguments."""
+
+    try:
+        data_dir = Path(argv[argv.index("-AddRawFileWithSubFolders") + 1])
+        output_root = Path(argv[argv.index("-SetOutputDirectory") + 1])
+    except (ValueError, IndexError):
+        raise SystemExit("Expected -AddRawFileWithSubFolders <dir> and -SetOutputDirectory <dir>")
+
+    return data_dir, output_root
+
+
+def write_voltage_csv(path: Path, seconds: float, rate: int, rng: np.random.Generator, rows_per_write: int):
+    """Write a voltage recording of square pulses, a block of rows at a time like the ripper."""
+
+    num_samples = int(seconds * rate)
+
+    with open(path, "w") as f:
+        f.write(",".join(["Time(ms)"] + CSV_CHANNELS) + "\n")
+
+        for start in range(0, num_samples, rows_per_write):
+            stop = min(start + rows_per_write, num_samples)
+            times = np.arange(start, stop) * (1000 / rate)
+            data = np.column_stack([times] + [(rng.random(stop - start) < 0.01) * 5.0 for _ in CSV_CHANNELS])
+            np.savetxt(f, data, fmt="%.4f", delimiter=",")
+            f.flush()
+
+
+def emulate(args: argparse.Namespace, data_dir: Path, output_root: Path):
+
+    rng = np.random.default_rng(args.seed)
+    jitter = random.Random(args.seed)
+
+    # Like the ripper, the output goes into a directory named after the recording
+    output_dir = output_root / data_dir.name
+    output_dir.mkdir(parents=True, exist_ok=True)
+    logger.info("Emulating ripper: %s -> %s", data_dir, output_dir)
+
+    for pattern in ("*.xml", "*.env"):
+        for metadata in data_dir.glob(pattern):
+            shutil.copy2(metadata, output_dir)
+    (output_dir / "References").mkdir(exist_ok=True)
+
+    if args.csv_seconds > 0:
+        csv = output_dir / ("%s_Cycle00001_VoltageRecording_001.csv" % data_dir.name)
+        write_voltage_csv(csv, args.csv_seconds, args.csv_rate, rng, args.csv_rows_per_write)
+
+    height, width = args.frame_shape
+    image = rng.integers(0, 8192, size=(height, width), dtype=np.uint16)
+
+    written = 0
+    for frame in range(1, args.frames + 1):
+        for channel in args.channels:
+
+            if args.hang_after is not None and written >= args.hang_after:
+                logger.info("Hanging after %d tiffs", written)
+                while True:
+                    time.sleep(60)
+
+            # Sleep for this tiff's share of the rate, give or take the jitter
+            if args.rate > 0:
+                delay = 1 / args.rate
+                time.sleep(max(delay * (1 + jitter.uniform(-args.jitter, args.jitter)), 0))
+
+            name = "%s_Cycle00001_Ch%d_%06d.ome.tif" % (data_dir.name, channel, frame)
+            contents = tiff_bytes(image + frame)
+
+            with open(output_dir / name, "wb") as f:
+                if args.partial_write_secs > 0:
+                    # Leave the file half written for a while, as a slow network write would
+                    f.write(contents[:len(contents) // 2])
+                    f.flush()
+                    time.sleep(args.partial_write_secs)
+                    f.write(contents[len(contents) // 2:])
+                else:
+                    f.write(contents)
+
+            written += 1
+
+    logger.info("Wrote %d tiffs", written)
+
+    if args.exit_cleanly:
+        return
+
+    # The real ripper never exits once it's done, rip.py has to kill it
+    while True:
+        time.sleep(60)
+
+
+def build_parser() -> argparse.ArgumentParser:
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=100, help="Frames written for each channel")
+    parser.add_argument("--channels", type=int, nargs="+", default=[2], help="Channels written for each frame")
+    parser.add_argument("--frame_shape", type=int, nargs=2, default=[64, 64], help="Height and width of each frame")
+    parser.add_argument("--rate", type=float, default=100, help="Tiffs written per second, 0 for as fast as possible")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random variation of each tiff's delay, as a fraction")
+    parser.add_argument("--hang_after", type=int, help="Stop writing, without exiting, after this many tiffs")
+    parser.add_argument("--partial_write_secs", type=float, default=0.0,
+                        help="Time each tiff is left half written before it's finished")
+    parser.add_argument("--csv_seconds", type=float, default=10.0,
+                        help="Length of the voltage recording, 0 to skip the csv")
+    parser.add_argument("--csv_rate", type=int, default=1000, help="Samples per second of the voltage recording")
+    parser.add_argument("--csv_rows_per_write", type=int, default=10000, help="Rows written to the csv at a time")
+    parser.add_argument("--exit_cleanly", action="store_true", help="Exit once done instead of running forever")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the data and the jitter")
+
+    return parser
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format='%(asctime)s.%(msecs)03d fake_ripper %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    # Options for the emulator come first, the ripper's own single dash arguments after
+    args, ripper_args = build_parser().parse_known_args()
+
+    emulate(args, *parse_ripper_args(ripper_args))
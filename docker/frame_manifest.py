@@ -0,0 +1,358 @@
+"""Manifest of the frames in a ripped tiff directory, so later stages don't have to list it."""
+
+import logging
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from recording_xml import summarize_recording
+from tiff_index import parse_tiff_name
+
+logger = logging.getLogger(__name__)
+
+# Written into the tiff directory itself, so it's renamed and copied along with the tiffs.
+MANIFEST_NAME = "frame_manifest.npz"
+
+# stat and reading for checksums are round trips to the server on network storage, so
+# files are handled by a pool of threads. zlib releases the GIL while checksumming.
+MANIFEST_THREADS = 8
+
+# One row per tiff, sorted by cycle, channel and frame. A crc32 of 0 means no checksum
+# was computed. Packed is 1 for tiffs deleted once their frame was packed into the
+# recording's HDF5 file. The name field is sized to the longest name, see manifest_dtype().
+MANIFEST_FIELDS = [
+    ("cycle", "<u4"),
+    ("channel", "<u2"),
+    ("frame", "<u4"),
+    ("size", "<u8"),
+    ("crc32", "<u4"),
+    ("packed", "u1"),
+]
+
+# One row per channel and cycle, with the number of frames the recording XML lists for it.
+EXPECTED_DTYPE = np.dtype([
+    ("cycle", "<u4"),
+    ("channel", "<u2"),
+    ("frames", "<u4"),
+])
+
+
+def manifest_dtype(names: Iterable[bytes]) -> np.dtype:
+    """Dtype of the manifest's rows, with a name field long enough for every name."""
+
+    width = max((len(name) for name in names), default=1)
+
+    return np.dtype(MANIFEST_FIELDS + [("name", "S%d" % max(width, 1))])
+
+
+def expected_frames(recording_xml: Optional[Path], channels: Iterable[int]) -> Optional[np.ndarray]:
+    """
+    Number of frames every channel should have in each cycle, from the recording's .xml file.
+
+    Returns:
+        EXPECTED_DTYPE rows, or None if there's no .xml or it lists no frames.
+    """
+
+    if recording_xml is None:
+        return None
+
+    sequences = summarize_recording(recording_xml).sequences
+    if not sequences:
+        logger.warning("No frames listed in %s, expected frame counts are unknown" % recording_xml)
+        return None
+
+    rows = [(sequence.cycle, channel, sequence.num_frames)
+            for sequence in sequences for channel in sorted(channels)]
+
+    return np.sort(np.array(rows, dtype=EXPECTED_DTYPE), order=["cycle", "channel"])
+
+
+def find_recording_xml(tiff_dir: Path) -> Optional[Path]:
+    """
+    Find the recording's .xml next to a tiff directory.
+
+    Once ripping is finished the metadata is back in the raw directory, which has the tiff
+    directory's name without "_tiffs". Prairie View names the .xml after the recording.
+    """
+
+    tiff_dir = Path(tiff_dir)
+    raw_dir = tiff_dir.with_name(tiff_dir.name[:-len("_tiffs")]) if tiff_dir.name.endswith("_tiffs") else tiff_dir
+    recording_xml = raw_dir / (raw_dir.name + ".xml")
+
+    return recording_xml if recording_xml.exists() else None
+
+
+def file_crc32(path: Path) -> int:
+    """Return the crc32 of a file's contents."""
+
+    with open(path, "rb") as f:
+        return zlib.crc32(f.read())
+
+
+def _describe(directory: Path, name: str, checksum: bool, packed: Dict[str, int]):
+
+    path = directory / name
+    try:
+        size = os.stat(path).st_size
+        crc = file_crc32(path) if checksum else 0
+    except FileNotFoundError:
+        # Tiffs deleted after streaming them into HDF5 are kept with the size they had,
+        # others that have gone missing are left out
+        if name in packed:
+            return packed[name], 0, 1
+        return None
+
+    return size, crc, 0
+
+
+def write_manifest(directory: Path, names: Iterable[str], checksum: bool = False,
+                   threads: int = MANIFEST_THREADS, recording_xml: Optional[Path] = None,
+                   packed: Optional[Dict[str, int]] = None) -> "FrameManifest":
+    """
+    Write the manifest of a directory's tiffs.
+
+    Names are taken from the caller, typically the index the watcher kept while ripping,
+    so the directory isn't listed again. Tiffs that don't follow Prairie View's naming or
+    no longer exist are left out, except those deleted once they were packed into HDF5,
+    which are kept and marked as packed. The number of frames each cycle should have is read
+    from the recording XML and stored for every channel, so missing frames at the end of
+    a cycle, or whole cycles, can be found later.
+
+    Args:
+        directory:
+            Directory containing the tiffs.
+        names:
+            File names of the tiffs, without their directory.
+        checksum:
+            Also record the crc32 of every tiff, which means reading all of them.
+        threads:
+            Number of files handled at once.
+        recording_xml:
+            The recording's .xml file. Without it, no expected frame counts are stored.
+        packed:
+            Size of each tiff deleted after being packed into HDF5, by name. Their
+            checksums can't be computed any more, so they're recorded as 0.
+
+    Returns:
+        The manifest that was written.
+    """
+
+    directory = Path(directory)
+
+    parsed = []
+    for name in names:
+        numbers = parse_tiff_name(name)
+        if numbers is None:
+            logger.warning("Leaving %s out of the manifest, it doesn't follow Prairie View's naming" % name)
+        else:
+            parsed.append((numbers, name))
+    parsed.sort()
+
+    with ThreadPoolExecutor(threads) as pool:
+        described = list(pool.map(lambda item: _describe(directory, item[1], checksum, packed or {}), parsed))
+
+    rows = [numbers + described_ + (name.encode(),)
+            for (numbers, name), described_ in zip(parsed, described) if described_ is not None]
+    frames = np.array(rows, dtype=manifest_dtype(row[-1] for row in rows))
+
+    manifest = FrameManifest(directory, frames, expected_frames(recording_xml, np.unique(frames["channel"])))
+    manifest.save()
+
+    return manifest
+
+
+class FrameManifest:
+    """
+    The cycle, channel, frame number, size and optionally crc32 of every tiff in a directory.
+
+    Rows are kept in a structured numpy array sorted by cycle, channel and frame, so a
+    channel's tiffs can be picked out in order, a range of frames sliced and gaps in the
+    frame numbers found without touching the directory. Alongside them is the number of
+    frames every channel's cycles should have, which the gaps are checked against.
+
+    Args:
+        directory:
+            Directory containing the tiffs.
+        frames:
+            Structured array of manifest_dtype() rows.
+        expected:
+            Structured array of EXPECTED_DTYPE rows, or None if the counts aren't known.
+    """
+
+    def __init__(self, directory: Path, frames: np.ndarray, expected: Optional[np.ndarray] = None):
+        self.directory = Path(directory)
+        self.frames = frames
+        self.expected = expected
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    @classmethod
+    def load(cls, directory: Path) -> "FrameManifest":
+        """Read the manifest written into a tiff directory."""
+
+        directory = Path(directory)
+        with np.load(directory / MANIFEST_NAME, allow_pickle=False) as saved:
+            expected = saved["expected"] if "expected" in saved.files else None
+            return cls(directory, saved["frames"], expected)
+
+    @classmethod
+    def from_directory(cls, directory: Path, recording_xml: Optional[Path] = None) -> "FrameManifest":
+        """
+        Build a manifest by listing the directory, for tiffs ripped before manifests were written.
+
+        The expected frame counts are read from `recording_xml`, or from the .xml in the raw
+        directory next to the tiffs if it can be found.
+        """
+
+        directory = Path(directory)
+        with os.scandir(directory) as entries:
+            names = [entry.name for entry in entries if entry.name.endswith(".ome.tif")]
+
+        frames = []
+        for name in names:
+            numbers = parse_tiff_name(name)
+            if numbers is not None:
+                frames.append(numbers + (0, 0, 0, name.encode()))
+        frames.sort()
+        frames = np.array(frames, dtype=manifest_dtype(frame[-1] for frame in frames))
+
+        expected = expected_frames(recording_xml or find_recording_xml(directory), np.unique(frames["channel"]))
+
+        return cls(directory, frames, expected)
+
+    @classmethod
+    def open(cls, directory: Path, recording_xml: Optional[Path] = None) -> "FrameManifest":
+        """Read the directory's manifest, or build one by listing it if there isn't one."""
+
+        if (Path(directory) / MANIFEST_NAME).exists():
+            return cls.load(directory)
+
+        logger.info("No frame manifest in %s, listing the directory" % directory)
+        return cls.from_directory(directory, recording_xml)
+
+    def save(self):
+        """Write the manifest into the tiff directory, replacing any previous one."""
+
+        path = self.directory / MANIFEST_NAME
+        partial = self.directory / ("." + MANIFEST_NAME + ".partial")
+
+        arrays = {"frames": self.frames}
+        if self.expected is not None:
+            arrays["expected"] = self.expected
+
+        with open(partial, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(partial, path)
+
+    @property
+    def channels(self) -> List[int]:
+        return sorted(int(channel) for channel in np.unique(self.frames["channel"]))
+
+    @property
+    def cycles(self) -> List[int]:
+        return sorted(int(cycle) for cycle in np.unique(self.frames["cycle"]))
+
+    def select(self, channel: Optional[int] = None, cycle: Optional[int] = None,
+               start: Optional[int] = None, stop: Optional[int] = None) -> np.ndarray:
+        """
+        Rows for one channel and/or cycle, optionally only frames numbered from `start` up to `stop`.
+        """
+
+        mask = np.ones(len(self.frames), dtype=bool)
+        if channel is not None:
+            mask &= self.frames["channel"] == channel
+        if cycle is not None:
+            mask &= self.frames["cycle"] == cycle
+        if start is not None:
+            mask &= self.frames["frame"] >= start
+        if stop is not None:
+            mask &= self.frames["frame"] < stop
+
+        return self.frames[mask]
+
+    def paths(self, channel: Optional[int] = None, cycle: Optional[int] = None,
+              start: Optional[int] = None, stop: Optional[int] = None) -> List[Path]:
+        """Paths of the selected tiffs, in cycle then frame order."""
+
+        return [self.directory / name.decode() for name in self.select(channel, cycle, start, stop)["name"]]
+
+    def is_packed(self, channel: int) -> bool:
+        """Whether any of a channel's tiffs were deleted once packed into the recording's HDF5 file."""
+
+        return bool(self.select(channel)["packed"].any())
+
+    def expected_count(self, channel: int, cycle: int) -> Optional[int]:
+        """Number of frames a channel's cycle should have, or None if it isn't known."""
+
+        if self.expected is None:
+            return None
+
+        rows = self.expected[(self.expected["channel"] == channel) & (self.expected["cycle"] == cycle)]
+
+        return int(rows["frames"][0]) if len(rows) else None
+
+    def missing_frames(self, channel: int) -> Dict[int, List[int]]:
+        """
+        Frame numbers missing from each of a channel's cycles.
+
+        Every cycle the recording XML lists is checked against the number of frames it
+        should have, so frames cut off at the end of a cycle and cycles without any tiffs
+        are found too. Without expected counts, only gaps before the highest frame number
+        present in each cycle can be found.
+
+        Args:
+            channel:
+                Channel to check.
+
+        Returns:
+            Missing frame numbers by cycle, for the cycles missing any.
+        """
+
+        if self.expected is not None:
+            cycles = sorted(int(cycle) for cycle in self.expected["cycle"][self.expected["channel"] == channel])
+        else:
+            cycles = self.cycles
+
+        missing = {}
+        for cycle in cycles:
+            present = self.select(channel, cycle)["frame"]
+            last = self.expected_count(channel, cycle)
+            if last is None:
+                last = int(present.max()) if len(present) else 0
+
+            frames = [int(frame) for frame in np.setdiff1d(np.arange(1, last + 1), present)]
+            if frames:
+                missing[cycle] = frames
+
+        return missing
+
+    def verify(self) -> List[str]:
+        """
+        Check every tiff still has the recorded size, and the recorded crc32 if one was computed.
+
+        Tiffs deleted once packed into HDF5 aren't checked.
+
+        Returns:
+            Names of the tiffs that are missing or don't match.
+        """
+
+        def check(row) -> bool:
+            path = self.directory / row["name"].decode()
+            try:
+                if os.stat(path).st_size != row["size"]:
+                    return False
+                return row["crc32"] == 0 or file_crc32(path) == row["crc32"]
+            except FileNotFoundError:
+                return False
+
+        present = self.frames[self.frames["packed"] == 0]
+
+        with ThreadPoolExecutor(MANIFEST_THREADS) as pool:
+            ok = list(pool.map(check, present))
+
+        return [row["name"].decode() for row, ok_ in zip(present, ok) if not ok_]
@@ -14,13 +14,16 @@ from pathlib import Path
 from time import perf_counter
 import h5py
 
+from frame_manifest import FrameManifest
+
 
 def tiff2hdf5(
     hdf5file: Path,
     tifffiles: Path,
     dataset_name: str = "2p",
     chunksize: int = 128,
-    compression: str = None):
+    compression: str = None,
+    channel: int = 2):
     """
     Write images from TIFF files to chunked dataset in HDF5 file.
 
@@ -44,6 +47,8 @@ def tiff2hdf5(
             writing to H5
         compression:
             What compressor to use from the numcodecs library
+        channel:
+            Channel whose frames are written to the dataset
     """
 
     # Define imread function to use with tifffile that relies upon the libtiff
@@ -55,22 +60,18 @@ def tiff2hdf5(
             data = fh.read()
         return tiff_decode(data)
 
-    # The image paths from globbing will be appended into this list.
-    # TODO: Have an argument in the function that can receive how many
-    # channels are expected for processing data into the H5 datasets
-    # and create a dictionary where each channel is a key and each
-    # value is it's list of paths something like this maybe:
-    # image_paths = {"ch#": sorted([path for path in tifffiles.glob(f"*{key}*.tif")])}
-    # Currently the only channel we image from is Channel 2, so that's hardcoded for now,
-    # but in the future we will definitely have multiple channels.
-    image_paths = [path for path in tifffiles.glob("*Ch2*.tif")]
-
-    # When the list above is generated, the elements of the list will be
-    # populated however the os happens to fetch each filename for you. This
-    # means that things will be out of order most likely! You could wrap the
-    # list comprehension above in sorted() to do the same thing, but
-    # maybe writing it this way can help people understand it a little better
-    sorted_paths = sorted(image_paths)
+    # The frame manifest rip.py writes into the tiff directory lists every tiff
+    # by channel and in frame order, so the directory doesn't have to be globbed
+    # and sorted. Directories ripped before manifests existed are listed once instead.
+    manifest = FrameManifest.open(tifffiles)
+    if manifest.is_packed(channel):
+        raise FileNotFoundError("Channel %d of %s was already packed into HDF5 and its tiffs deleted"
+                                % (channel, tifffiles))
+    sorted_paths = manifest.paths(channel=channel)
+
+    for cycle, missing in manifest.missing_frames(channel).items():
+        print("Channel %d cycle %d is missing %d frames, first missing is %d"
+              % (channel, cycle, len(missing), missing[0]))
 
     # Now that things are sorted correctly, you can tell tifffile to read in
     # all the tiffs and decode them into a temporary chunked zarr store
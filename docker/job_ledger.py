@@ -0,0 +1,151 @@
+"""SQLite ledger of conversion jobs so beyblade can skip, retry and resume work."""
+
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional, Tuple
+
+# States a conversion moves through. A job is queued when beyblade picks it up, ripping
+# while its container runs, and ripped or packed once the tiffs (and HDF5 file when
+# streaming) have been written. Failed jobs are retried after a backoff.
+QUEUED = "queued"
+RIPPING = "ripping"
+RIPPED = "ripped"
+PACKED = "packed"
+FAILED = "failed"
+
+STATES = (QUEUED, RIPPING, RIPPED, PACKED, FAILED)
+COMPLETE_STATES = (RIPPED, PACKED)
+
+# Failed jobs wait RETRY_BASE_SECS before their first retry, doubling every attempt up to
+# RETRY_MAX_SECS, and are given up on after MAX_ATTEMPTS.
+RETRY_BASE_SECS = 15 * 60
+RETRY_MAX_SECS = 24 * 60 * 60
+MAX_ATTEMPTS = 5
+
+# Files whose names and sizes identify a recording's contents. The .xml and .env files
+# are left out, as ripping moves them out of the raw directory and back, and modification
+# times aren't used as copies between devices don't always keep them.
+FINGERPRINT_PATTERNS = ("*RAWDATA*", "*Filelist.txt")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    raw_dir TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    updated REAL NOT NULL,
+    message TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (raw_dir, fingerprint)
+)
+"""
+
+
+def fingerprint(raw_dir: Path) -> str:
+    """
+    Fingerprint a raw directory's contents without reading its data.
+
+    The names and sizes of the raw data files and file list are hashed, so a recording
+    whose data changes gets a new fingerprint and is converted again, while moving its
+    metadata around during ripping leaves the fingerprint as it was.
+
+    Args:
+        raw_dir:
+            Directory to raw data that needs conversion.
+
+    Returns:
+        Hex digest identifying the directory's contents.
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+
+    paths = sorted({path for pattern in FINGERPRINT_PATTERNS for path in raw_dir.glob(pattern)})
+    for path in paths:
+        digest.update(("%s\0%d\n" % (path.name, path.stat().st_size)).encode())
+
+    return digest.hexdigest()
+
+
+class JobLedger:
+    """
+    Persistent record of every conversion job, keyed by raw directory and fingerprint.
+
+    Args:
+        db_path:
+            Path of the SQLite database, created if it doesn't exist.
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._db = sqlite3.connect(str(self.db_path), timeout=30)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute(_SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def get(self, raw_dir: Path, fingerprint: str) -> Optional[sqlite3.Row]:
+        """Return the job's row, or None if it has never been seen."""
+
+        return self._db.execute(
+            "SELECT * FROM jobs WHERE raw_dir = ? AND fingerprint = ?", (str(raw_dir), fingerprint)
+        ).fetchone()
+
+    def should_run(self, raw_dir: Path, fingerprint: str, now: Optional[float] = None) -> Tuple[bool, str]:
+        """
+        Decide whether a job needs to run.
+
+        Returns:
+            Whether to run the job and why.
+        """
+
+        now = time.time() if now is None else now
+        job = self.get(raw_dir, fingerprint)
+
+        if job is None:
+            return True, "new"
+
+        if job["state"] in COMPLETE_STATES:
+            return False, "already %s" % job["state"]
+
+        if job["state"] == FAILED:
+            if job["attempts"] >= MAX_ATTEMPTS:
+                return False, "gave up after %d attempts: %s" % (job["attempts"], job["message"])
+            if now < job["next_attempt"]:
+                return False, "retrying in %.0f seconds" % (job["next_attempt"] - now)
+            return True, "retry %d of %d" % (job["attempts"] + 1, MAX_ATTEMPTS)
+
+        # Queued or ripping means an earlier run stopped before the job finished
+        return True, "resuming job left %s" % job["state"]
+
+    def mark(self, raw_dir: Path, fingerprint: str, state: str, message: str = ""):
+        """
+        Record a job's new state.
+
+        Moving to failed counts an attempt and schedules the next one with exponential
+        backoff. Completing a job resets its attempts.
+        """
+
+        if state not in STATES:
+            raise ValueError("Unknown job state: %s" % state)
+
+        now = time.time()
+        job = self.get(raw_dir, fingerprint)
+        attempts = job["attempts"] if job is not None else 0
+        next_attempt = 0.0
+
+        if state == FAILED:
+            attempts += 1
+            next_attempt = now + min(RETRY_BASE_SECS * 2 ** (attempts - 1), RETRY_MAX_SECS)
+        elif state in COMPLETE_STATES:
+            attempts = 0
+
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (raw_dir, fingerprint, state, attempts, next_attempt, updated, message)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (str(raw_dir), fingerprint, state, attempts, next_attempt, now, message),
+            )
@@ -0,0 +1,148 @@
+"""Watch the conversion directory for new lists of recordings to convert."""
+
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from watcher import IN_CLOSE_WRITE, IN_CREATE, IN_MOVED_TO, IN_Q_OVERFLOW, Inotify
+
+logger = logging.getLogger(__name__)
+
+# A list file is only read once its size and modification time haven't changed for this
+# long, so a list that's still being written isn't picked up half finished.
+LIST_SETTLE_SECS = 5
+
+# How often the directory is scanned when no events arrive. Lists are written over the
+# network by the transfer from the Bruker machine, which inotify doesn't see, so this
+# scan is also what finds most of them.
+LIST_POLL_SECS = 5
+
+
+class ListWatcher:
+    """
+    Reports conversion list files once they've been completely written.
+
+    The directory is watched with inotify when available, which wakes the watcher as
+    soon as a list is written locally, and scanned every `poll_secs` regardless. Each
+    list is reported once it has settled, and again whenever it changes.
+
+    Args:
+        directory:
+            Directory the conversion lists are written to.
+        pattern:
+            Glob pattern of the list files.
+        settle_secs:
+            Time a list's size and modification time must stay the same before it's read.
+        poll_secs:
+            Longest time between scans of the directory.
+        use_inotify:
+            Use inotify if available. Set False to only scan.
+    """
+
+    def __init__(self, directory: Path, pattern: str = "*.txt", settle_secs: float = LIST_SETTLE_SECS,
+                 poll_secs: float = LIST_POLL_SECS, use_inotify: bool = True):
+        self.directory = Path(directory)
+        self.pattern = pattern
+        self.settle_secs = settle_secs
+        self.poll_secs = poll_secs
+
+        # Signature of each list when it was last reported, and of lists still settling
+        # along with when that signature was first seen.
+        self._reported: Dict[Path, Tuple[int, int]] = {}
+        self._settling: Dict[Path, Tuple[Tuple[int, int], float]] = {}
+
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = Inotify()
+            except (OSError, AttributeError) as err:
+                logger.warning("inotify unavailable, falling back to scanning: %s", err)
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self._inotify is not None
+
+    def start(self):
+        if self.uses_inotify:
+            self._inotify.add_watch(self.directory, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+
+        logger.info("Watching %s for conversion lists (%s)", self.directory,
+                    "inotify" if self.uses_inotify else "scanning")
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def wait(self, timeout: float) -> List[Path]:
+        """
+        Wait up to `timeout` seconds for lists to be written.
+
+        Returns early, with an empty list, as soon as something in the directory
+        changes, or with the lists that have settled once they have.
+
+        Returns:
+            Lists that are new or have changed since they were last reported.
+        """
+
+        # Don't sleep past the moment a settling list is due to be read
+        now = time.monotonic()
+        for _, first_seen in self._settling.values():
+            timeout = min(timeout, first_seen + self.settle_secs - now)
+
+        timeout = max(min(timeout, self.poll_secs), 0)
+
+        if self.uses_inotify:
+            for _, mask, name in self._inotify.read_events(timeout):
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning("inotify queue overflowed, rescanning %s", self.directory)
+        else:
+            time.sleep(timeout)
+
+        return self.scan()
+
+    def scan(self) -> List[Path]:
+        """Scan the directory, returning lists that have settled since they were last reported."""
+
+        now = time.monotonic()
+        ready = []
+        present = set()
+
+        for path in self.directory.glob(self.pattern):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            present.add(path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+
+            if self._reported.get(path) == signature:
+                self._settling.pop(path, None)
+                continue
+
+            settling = self._settling.get(path)
+            if settling is None or settling[0] != signature:
+                self._settling[path] = (signature, now)
+                continue
+
+            if now - settling[1] >= self.settle_secs:
+                del self._settling[path]
+                self._reported[path] = signature
+                ready.append(path)
+
+        # Forget lists that have been moved away
+        for path in set(self._reported) - present:
+            del self._reported[path]
+        for path in set(self._settling) - present:
+            del self._settling[path]
+
+        return sorted(ready)
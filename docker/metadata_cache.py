@@ -0,0 +1,191 @@
+"""Local index of values already extracted from Prairie View .env and .xml files."""
+
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# The index lives on the local disk of whichever machine runs the pipeline so reading
+# it never goes over the network like the metadata files themselves do.
+METADATA_CACHE_PATH = Path.home() / ".cache" / "bruker_pipeline" / "metadata_index.json"
+
+
+class MetadataCache:
+    """
+    Values extracted from metadata files, kept until the files change.
+
+    Each entry is keyed by the file's absolute path and remembers the file's modification
+    time and size. Values are looked up by the file and a `kind` naming what was
+    extracted from it, so beyblade and the NWB utilities can keep different values for
+    the same .env file. A file whose modification time or size has changed since its
+    values were stored is parsed again, and its old values are dropped.
+
+    The cache can be shared by threads and by processes. Files are parsed outside its
+    lock, so different files are parsed at the same time. Processes take a lock on the
+    index file while saving and merge in the entries other processes saved since the
+    index was read, so no process's entries are lost. Within batch(), new values are
+    only saved once at the end, rather than the index being merged and rewritten for
+    every file parsed.
+
+    Values must be JSON serializable. Dates and other parsed types should be stored as
+    the strings found in the file and converted after they're looked up.
+
+    Args:
+        path:
+            Path of the JSON index file, created when the first values are stored.
+    """
+
+    def __init__(self, path: Path = METADATA_CACHE_PATH):
+        self.path = Path(path)
+        self._entries = None
+        self._lock = threading.Lock()
+
+        # Number of batch() blocks open, and whether values stored during them are unsaved
+        self._batches = 0
+        self._dirty = False
+
+    def get(self, file: Path, kind: str, extract: Callable[[Path], dict]) -> dict:
+        """
+        Look up the values extracted from a file, extracting and storing them if needed.
+
+        Args:
+            file:
+                Metadata file the values come from.
+            kind:
+                Name for the set of values `extract` returns.
+            extract:
+                Function that parses the file and returns its values.
+
+        Returns:
+            Dictionary of the extracted values.
+        """
+
+        key = str(Path(file).resolve())
+        stat = os.stat(key)
+
+        with self._lock:
+            entry = self._load().get(key)
+            if entry is not None and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                if kind in entry["values"]:
+                    return entry["values"][kind]
+
+        values = extract(Path(file))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["mtime_ns"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+                entry = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "values": {}}
+                self._entries[key] = entry
+
+            entry["values"][kind] = values
+            if self._batches:
+                self._dirty = True
+            else:
+                self._save()
+
+        return values
+
+    @contextmanager
+    def batch(self):
+        """
+        Save the values stored inside the block once when it ends, instead of after each one.
+
+        Looking up many files at once, such as preflighting every directory in the
+        conversion lists, would otherwise lock, merge and rewrite the whole index once per
+        file. Blocks can be nested and opened by several threads, the values are saved when
+        the last one ends.
+        """
+
+        with self._lock:
+            self._batches += 1
+
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batches -= 1
+                if not self._batches and self._dirty:
+                    self._save()
+
+    def _read(self) -> dict:
+
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            logger.warning("Ignoring unreadable metadata cache %s: %s", self.path, err)
+            return {}
+
+    def _load(self) -> dict:
+
+        if self._entries is None:
+            self._entries = self._read()
+
+        return self._entries
+
+    def _save(self):
+
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+            # Only one process saves at a time, and each starts from what's on disk so the
+            # entries other processes stored since this one read the index are kept.
+            with open(str(self.path) + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+                self._entries = _merge(self._read(), self._entries)
+
+                # Written to a temporary file and moved into place so a crash never leaves
+                # a half written index behind.
+                fd, tmp = tempfile.mkstemp(dir=str(self.path.parent), prefix=self.path.name, suffix=".tmp")
+                with os.fdopen(fd, "w") as f:
+                    json.dump(self._entries, f)
+                os.replace(tmp, self.path)
+
+            self._dirty = False
+        except OSError as err:
+            logger.warning("Could not write metadata cache %s: %s", self.path, err)
+
+
+def _merge(saved: dict, entries: dict) -> dict:
+    """
+    Merge this process's entries into the ones saved on disk.
+
+    When both have an entry for the same file, the one for its most recent version is
+    kept, and if they describe the same version their values are combined.
+    """
+
+    merged = dict(saved)
+    for key, entry in entries.items():
+        other = merged.get(key)
+        if other is None or other["mtime_ns"] < entry["mtime_ns"]:
+            merged[key] = entry
+        elif other["mtime_ns"] == entry["mtime_ns"] and other["size"] == entry["size"]:
+            merged[key] = dict(entry, values=dict(other["values"], **entry["values"]))
+
+    return merged
+
+
+# Shared by everything that reads metadata in one process
+_default_cache: Optional[MetadataCache] = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache() -> MetadataCache:
+    """Return the process wide cache stored at METADATA_CACHE_PATH."""
+
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = MetadataCache()
+
+    return _default_cache
@@ -0,0 +1,128 @@
+"""Rate, ETA and stall tracking for the ripping watchdog."""
+
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+# Progress records are written to the container log as `PROGRESS key=value ...` so they
+# can be picked out of the log and parsed with parse_progress_record().
+RECORD_PREFIX = "PROGRESS"
+
+
+class RipProgress:
+    """
+    Tracks how quickly tiffs are being ripped.
+
+    The rate is measured over a sliding window of recent updates, so it follows the
+    ripper slowing down as a recording goes on, and is used to estimate the time left
+    until `total` tiffs exist. The ripper counts as stalled once the number of tiffs
+    hasn't gone up for `stall_secs`, which means a ripper that hangs is caught long
+    before the overall time limit.
+
+    Args:
+        total:
+            Number of tiffs expected.
+        window_secs:
+            Length of the window the rate is measured over.
+        stall_secs:
+            Time without any new tiffs after which the ripper is considered stalled.
+        clock:
+            Function returning the current time in seconds.
+    """
+
+    def __init__(self, total: int, window_secs: float = 60, stall_secs: float = 600,
+                 clock: Callable[[], float] = time.monotonic):
+        self.total = total
+        self.window_secs = window_secs
+        self.stall_secs = stall_secs
+        self.clock = clock
+
+        self.count = 0
+        self.started = clock()
+        self.last_increase = self.started
+
+        self._samples = deque([(self.started, 0)])
+
+    def update(self, count: int):
+        """Record the current number of tiffs."""
+
+        now = self.clock()
+
+        if count > self.count:
+            self.last_increase = now
+        self.count = count
+
+        self._samples.append((now, count))
+
+        # Keep one sample older than the window so the rate covers the whole window
+        while len(self._samples) > 2 and self._samples[1][0] <= now - self.window_secs:
+            self._samples.popleft()
+
+    @property
+    def rate(self) -> float:
+        """Tiffs per second over the window."""
+
+        (first_time, first_count), (last_time, last_count) = self._samples[0], self._samples[-1]
+        if last_time <= first_time:
+            return 0.0
+
+        return (last_count - first_count) / (last_time - first_time)
+
+    @property
+    def eta_secs(self) -> Optional[float]:
+        """Estimated seconds until every tiff exists, or None while nothing is happening."""
+
+        rate = self.rate
+        if rate <= 0:
+            return None
+
+        return max(self.total - self.count, 0) / rate
+
+    @property
+    def percent(self) -> float:
+        if not self.total:
+            return 100.0
+
+        return 100.0 * self.count / self.total
+
+    @property
+    def stalled_secs(self) -> float:
+        """Seconds since the number of tiffs last went up."""
+
+        return self.clock() - self.last_increase
+
+    @property
+    def stalled(self) -> bool:
+        return self.count < self.total and self.stalled_secs >= self.stall_secs
+
+    def record(self) -> str:
+        """Format the current progress as a single parseable log line."""
+
+        eta = self.eta_secs
+
+        return "%s done=%d total=%d percent=%.1f rate=%.2f eta_secs=%s stalled_secs=%.0f" % (
+            RECORD_PREFIX,
+            self.count,
+            self.total,
+            self.percent,
+            self.rate,
+            "%.0f" % eta if eta is not None else "unknown",
+            self.stalled_secs,
+        )
+
+
+def parse_progress_record(line: str) -> Optional[Dict[str, str]]:
+    """
+    Pull the fields out of a progress record in a log line.
+
+    Returns:
+        Dictionary of the record's fields, or None if the line doesn't hold a record.
+    """
+
+    marker = line.find(RECORD_PREFIX + " ")
+    if marker < 0:
+        return None
+
+    fields = line[marker + len(RECORD_PREFIX):].split()
+
+    return dict(field.split("=", 1) for field in fields if "=" in field)
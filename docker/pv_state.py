@@ -0,0 +1,128 @@
+"""Index of every Prairie View state value in a .env file, built in one pass."""
+
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict
+
+import lxml.etree
+
+from metadata_cache import default_cache
+
+
+@dataclass
+class PVStateIndex:
+    """
+    The Prairie View state recorded in a .env file, looked up by key.
+
+    A .env file holds one <PVStateValue> per key. Simple states have a value of their
+    own, like framerate. Others hold a value per index, like the laser power or whether
+    each channel was recorded from, and a few hold values per index and subindex, like
+    the stage position per axis.
+
+    Attributes:
+        attributes:
+            Attributes of the root element, such as the Prairie View version and date.
+        values:
+            Value of each key that has a single value.
+        indexed:
+            Values of each indexed key, by index.
+        subindexed:
+            Values of each subindexed key, by index and then subindex.
+    """
+
+    attributes: Dict[str, str] = field(default_factory=dict)
+    values: Dict[str, str] = field(default_factory=dict)
+    indexed: Dict[str, Dict[str, str]] = field(default_factory=dict)
+    subindexed: Dict[str, Dict[str, Dict[str, str]]] = field(default_factory=dict)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.values or key in self.indexed or key in self.subindexed
+
+    def value(self, key: str, index=None, subindex=None) -> str:
+        """
+        Look up a state value as the string found in the file.
+
+        Args:
+            key:
+                Key of the PVStateValue.
+            index:
+                Index of the value for indexed and subindexed keys.
+            subindex:
+                Subindex of the value for subindexed keys.
+
+        Raises:
+            KeyError: if the file has no such value.
+        """
+
+        if index is None:
+            return self.values[key]
+        if subindex is None:
+            return self.indexed[key][str(index)]
+
+        return self.subindexed[key][str(index)][str(subindex)]
+
+    def _add(self, element: lxml.etree._Element):
+
+        key = element.get("key")
+
+        # Only the first value of a key counts, like searching the tree for it would give
+        if key is None or key in self:
+            return
+
+        if element.get("value") is not None:
+            self.values[key] = element.get("value")
+            return
+
+        for child in element:
+            if child.tag == "IndexedValue":
+                self.indexed.setdefault(key, {})[child.get("index")] = child.get("value")
+            elif child.tag == "SubindexedValues":
+                subvalues = self.subindexed.setdefault(key, {}).setdefault(child.get("index"), {})
+                for subchild in child:
+                    if subchild.tag == "SubindexedValue":
+                        subvalues[subchild.get("subindex")] = subchild.get("value")
+
+
+def read_pv_state(env_path: Path) -> PVStateIndex:
+    """
+    Index every state value in a .env file.
+
+    The file is streamed once with lxml, recovering from the badly formed XML Prairie
+    View sometimes writes, and each <PVStateValue> is added to the index as it's closed.
+    Any number of keys can be looked up afterwards without searching the tree again.
+
+    Args:
+        env_path:
+            Path to the recording's .env file.
+
+    Returns:
+        Index of the file's state values.
+    """
+
+    index = PVStateIndex()
+
+    events = lxml.etree.iterparse(str(env_path), events=("start", "end"), recover=True)
+
+    for event, element in events:
+        if event == "start":
+            # The root element is the first to start, and holds the version and date
+            if not index.attributes and element.getparent() is None:
+                index.attributes = dict(element.attrib)
+        elif element.tag == "PVStateValue":
+            index._add(element)
+            element.clear()
+
+    return index
+
+
+def cached_pv_state(env_path: Path) -> PVStateIndex:
+    """
+    Index a .env file's state values, reusing the index from the metadata cache if the file hasn't changed.
+
+    beyblade and the NWB utilities share the same cached index, so each .env file is
+    only parsed once however many values are looked up in it.
+    """
+
+    values = default_cache().get(env_path, "pv_state", lambda path: asdict(read_pv_state(path)))
+
+    return PVStateIndex(**values)
@@ -0,0 +1,532 @@
+"""
+Decode Bruker RAWDATA files directly into chunked HDF5 datasets, without the ripper.
+
+The ripper is a Windows executable that has to match the Prairie View version exactly
+and never exits cleanly. This reads the raw sample stream with NumPy instead. The layout
+of the stream is described by a RawLayout, built from the recording XML:
+
+    frame -> line -> pixel -> sample -> channel
+
+Each frame is `lines_per_frame` lines of `pixels_per_line` pixels. Every pixel holds
+`samples_per_pixel` consecutive samples, each of which has one value per channel, and
+the samples of a pixel are averaged. With bidirectional (resonant) scanning every other
+line is acquired right to left and is flipped. Samples are `dtype` values, and `offset`
+is subtracted from them.
+
+Bruker does not document the RAWDATA format, so every part of the layout can be
+overridden, and `--compare_tiffs` decodes a recording that has also been ripped and
+reports any frame that doesn't match the ripper's tiffs. Use it to confirm the layout
+for a given Prairie View version and scan mode before relying on decoded data.
+"""
+
+import argparse
+import logging
+import re
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import h5py
+import lxml.etree
+import numpy as np
+from imagecodecs import tiff_decode
+
+from recording_xml import summarize_recording
+from tiff_index import parse_tiff_name
+
+logger = logging.getLogger(__name__)
+
+# Number of frames decoded at once. Matches the chunk size used for the HDF5 datasets.
+BLOCK_FRAMES = 128
+
+# PVStateValues the raw layout is built from
+LAYOUT_KEYS = ("linesPerFrame", "pixelsPerLine", "samplesPerPixel", "activeMode")
+
+
+class DecodingError(Exception):
+    """Error raised if problems encountered while decoding raw data."""
+
+
+@dataclass
+class RawLayout:
+    """Description of how samples are laid out in a RAWDATA stream."""
+
+    lines_per_frame: int
+    pixels_per_line: int
+    channels: List[int]
+    samples_per_pixel: int = 1
+    bidirectional: bool = False
+    dtype: str = "<u2"
+    offset: int = 0
+    num_frames: Optional[int] = None
+
+    @property
+    def frame_samples(self) -> int:
+        """Number of values in the raw stream for one frame of every channel."""
+
+        return self.lines_per_frame * self.pixels_per_line * self.samples_per_pixel * len(self.channels)
+
+    @property
+    def frame_shape(self) -> tuple:
+        return (self.lines_per_frame, self.pixels_per_line)
+
+
+@dataclass
+class ComparisonReport:
+    """Result of comparing decoded frames against the ripper's tiffs."""
+
+    frames_compared: int = 0
+    max_abs_diff: int = 0
+    mismatched: List[tuple] = field(default_factory=list)
+    missing_tiffs: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return not self.mismatched and not self.missing_tiffs
+
+
+def _read_header(xml_path: Path, keys: Sequence[str]):
+    """
+    Read the first value of each non-indexed PVStateValue in `keys` and the channels of the first frame.
+
+    The settings come before the frames in the recording XML, so only the start of the
+    file is parsed, recovering from badly formed XML, however long the recording is.
+
+    Returns:
+        (states, channels), with channels None if the XML has no frames.
+    """
+
+    states = {}
+    events = lxml.etree.iterparse(str(xml_path), events=("end",), tag=("PVStateValue", "Frame"),
+                                  recover=True, huge_tree=True)
+
+    for _, element in events:
+        if element.tag == "Frame":
+            # Every frame lists one File per channel that was recorded
+            return states, sorted(int(file.attrib["channel"]) for file in element.iter("File"))
+
+        key = element.get("key")
+        if key in keys and key not in states and element.get("value") is not None:
+            states[key] = element.get("value")
+
+    return states, None
+
+
+def read_layout(xml_path: Path, **overrides) -> RawLayout:
+    """
+    Build the raw layout of a recording from its XML.
+
+    Args:
+        xml_path:
+            Path to the recording's main .xml file.
+        overrides:
+            RawLayout fields that should be used instead of the values in the XML.
+
+    Returns:
+        RawLayout of the recording.
+    """
+
+    states, channels = _read_header(xml_path, LAYOUT_KEYS)
+    if channels is None:
+        raise DecodingError("No frames found in %s" % xml_path)
+
+    lines = states.get("linesPerFrame")
+    pixels = states.get("pixelsPerLine")
+    if lines is None or pixels is None:
+        raise DecodingError("Could not find frame dimensions in %s" % xml_path)
+
+    samples = states.get("samplesPerPixel")
+    mode = states.get("activeMode", "")
+
+    # Frames are counted from a stream of the file rather than by loading all of it
+    num_frames = summarize_recording(xml_path).num_frames
+
+    layout = RawLayout(
+        lines_per_frame=int(lines),
+        pixels_per_line=int(pixels),
+        channels=channels,
+        samples_per_pixel=int(samples) if samples else 1,
+        bidirectional="Resonant" in mode,
+        num_frames=num_frames,
+    )
+
+    return replace(layout, **{key: value for key, value in overrides.items() if value is not None})
+
+
+def read_filelist(raw_dir: Path) -> List[Path]:
+    """
+    Get the RAWDATA files of a recording, in order.
+
+    The Filelist.txt that Prairie View writes alongside the raw data names its RAWDATA
+    files in acquisition order. If none are named there, the files are globbed and sorted.
+    """
+
+    filelists = sorted(raw_dir.glob("*Filelist.txt"))
+    if not filelists:
+        raise DecodingError("No *Filelist.txt files present in %s" % raw_dir)
+
+    rawdata = []
+    for filelist in filelists:
+        for line in filelist.read_text(errors="replace").splitlines():
+            for name in re.findall(r"[^\s\\/]*RAWDATA[^\s\\/]*", line):
+                path = raw_dir / name
+                if path.exists() and path not in rawdata:
+                    rawdata.append(path)
+
+    if not rawdata:
+        rawdata = sorted(raw_dir.glob("*RAWDATA*"))
+
+    if not rawdata:
+        raise DecodingError("No RAWDATA files present in %s" % raw_dir)
+
+    return rawdata
+
+
+def iter_raw_blocks(rawdata: Sequence[Path], layout: RawLayout,
+                    block_frames: int = BLOCK_FRAMES) -> Iterator[np.ndarray]:
+    """
+    Read the raw sample stream in blocks of whole frames.
+
+    Every file is memory mapped and blocks are returned as views of the mapping, so
+    nothing is copied until the block is decoded. A frame that is split between two
+    files is the only data that gets copied.
+
+    Yields:
+        Arrays of shape (frames, frame_samples) with at most `block_frames` frames.
+    """
+
+    frame_samples = layout.frame_samples
+    carry = np.empty(0, dtype=layout.dtype)
+
+    for path in rawdata:
+        if path.stat().st_size == 0:
+            continue
+
+        samples = np.memmap(path, dtype=layout.dtype, mode="r")
+        position = 0
+
+        # Finish the frame the previous file ended in
+        if len(carry):
+            needed = frame_samples - len(carry)
+            carry = np.concatenate([carry, samples[:needed]])
+            position = min(needed, len(samples))
+            if len(carry) < frame_samples:
+                continue
+            yield carry.reshape(1, frame_samples)
+            carry = np.empty(0, dtype=layout.dtype)
+
+        whole_frames = (len(samples) - position) // frame_samples
+        for start in range(0, whole_frames, block_frames):
+            count = min(block_frames, whole_frames - start)
+            begin = position + start * frame_samples
+            yield samples[begin:begin + count * frame_samples].reshape(count, frame_samples)
+
+        carry = np.array(samples[position + whole_frames * frame_samples:])
+
+    if len(carry):
+        logger.warning("Ignoring %d samples at the end of the raw data that don't fill a frame", len(carry))
+
+
+def decode_block(raw: np.ndarray, layout: RawLayout, dtype=np.uint16) -> np.ndarray:
+    """
+    Turn a block of raw frames into images.
+
+    Args:
+        raw:
+            Array of shape (frames, frame_samples) from iter_raw_blocks().
+        layout:
+            Layout of the raw stream.
+        dtype:
+            Data type of the returned images.
+
+    Returns:
+        Array of shape (frames, channels, lines, pixels).
+    """
+
+    samples = raw.reshape(len(raw), layout.lines_per_frame, layout.pixels_per_line,
+                          layout.samples_per_pixel, len(layout.channels))
+
+    # Average the samples of each pixel. Summing into a wider integer keeps this exact.
+    if layout.samples_per_pixel > 1:
+        pixels = samples.sum(axis=3, dtype=np.int64) // layout.samples_per_pixel
+    else:
+        pixels = samples[:, :, :, 0, :]
+
+    images = np.empty((len(raw), len(layout.channels), *layout.frame_shape), dtype=dtype)
+
+    if layout.offset:
+        images[...] = np.clip(np.moveaxis(pixels, -1, 1).astype(np.int64) - layout.offset,
+                              np.iinfo(dtype).min, np.iinfo(dtype).max)
+    else:
+        images[...] = np.moveaxis(pixels, -1, 1)
+
+    # Lines acquired right to left are stored in the order they were sampled
+    if layout.bidirectional:
+        images[:, :, 1::2, :] = images[:, :, 1::2, ::-1]
+
+    return images
+
+
+def iter_frames(raw_dir: Path, layout: RawLayout, block_frames: int = BLOCK_FRAMES) -> Iterator[np.ndarray]:
+    """Decode a recording block by block, yielding (frames, channels, lines, pixels) arrays."""
+
+    rawdata = read_filelist(raw_dir)
+
+    for raw in iter_raw_blocks(rawdata, layout, block_frames):
+        yield decode_block(raw, layout)
+
+
+def dataset_names(channels: Sequence[int], dataset_name: str = "2p") -> Dict[int, str]:
+    """
+    Name the dataset each channel is written to.
+
+    A single channel is written to `dataset_name`, the same as h5_conversion does.
+    With more than one channel, each gets its own dataset like 2p_Ch1.
+    """
+
+    if len(channels) == 1:
+        return {channels[0]: dataset_name}
+
+    return {channel: "%s_Ch%d" % (dataset_name, channel) for channel in channels}
+
+
+def raw_to_hdf5(raw_dir: Path, hdf5file: Path, layout: Optional[RawLayout] = None,
+                dataset_name: str = "2p", chunksize: int = BLOCK_FRAMES) -> int:
+    """
+    Decode a recording's RAWDATA straight into chunked HDF5 datasets.
+
+    Frames are decoded one chunk at a time and written as they're decoded, so memory use
+    is a few chunks regardless of recording length. Datasets are chunked by `chunksize`
+    frames and compressed with lzf, as h5_conversion.tiff2hdf5 does.
+
+    Args:
+        raw_dir:
+            Directory containing the RAWDATA, Filelist.txt and recording .xml files.
+        hdf5file:
+            Output HDF5 file path.
+        layout:
+            Layout of the raw stream. Read from the recording XML if not given.
+        dataset_name:
+            Name of the dataset, or prefix of the per-channel datasets.
+        chunksize:
+            Number of frames per HDF5 chunk.
+
+    Returns:
+        Number of frames written per channel.
+    """
+
+    start = perf_counter()
+
+    if layout is None:
+        layout = read_layout(raw_dir / (raw_dir.name + ".xml"))
+
+    names = dataset_names(layout.channels, dataset_name)
+    num_frames = 0
+
+    with h5py.File(hdf5file, "w") as hdf:
+        datasets = {
+            channel: hdf.create_dataset(
+                name,
+                shape=(0, *layout.frame_shape),
+                maxshape=(None, *layout.frame_shape),
+                dtype=np.uint16,
+                chunks=(chunksize, *layout.frame_shape),
+                compression="lzf",
+            )
+            for channel, name in names.items()
+        }
+
+        for images in iter_frames(raw_dir, layout, chunksize):
+            for index, channel in enumerate(layout.channels):
+                dataset = datasets[channel]
+                dataset.resize(num_frames + len(images), axis=0)
+                dataset[num_frames:] = images[:, index]
+            num_frames += len(images)
+
+    if layout.num_frames is not None and num_frames != layout.num_frames:
+        logger.warning("Decoded %d frames but the recording XML lists %d", num_frames, layout.num_frames)
+
+    logger.info("Decoded %d frames of %d channels from %s in %.1f seconds",
+                num_frames, len(layout.channels), raw_dir, perf_counter() - start)
+
+    return num_frames
+
+
+def compare_to_tiffs(raw_dir: Path, tiff_dir: Path, layout: Optional[RawLayout] = None,
+                     max_frames: Optional[int] = None) -> ComparisonReport:
+    """
+    Compare decoded frames against the tiffs the ripper produced for the same recording.
+
+    Args:
+        raw_dir:
+            Directory containing the raw data.
+        tiff_dir:
+            Directory containing the ripper's tiffs for the recording.
+        layout:
+            Layout of the raw stream. Read from the recording XML if not given.
+        max_frames:
+            Stop after comparing this many frames.
+
+    Returns:
+        Report of mismatched frames as (channel, frame index, max abs difference).
+    """
+
+    if layout is None:
+        layout = read_layout(raw_dir / (raw_dir.name + ".xml"))
+
+    # Tiffs of each channel in frame order, across cycles
+    tiffs = {channel: [] for channel in layout.channels}
+    for path in tiff_dir.glob("*.ome.tif"):
+        parsed = parse_tiff_name(path.name)
+        if parsed and parsed[1] in tiffs:
+            tiffs[parsed[1]].append((parsed[0], parsed[2], path))
+    for channel in tiffs:
+        tiffs[channel].sort()
+
+    report = ComparisonReport()
+    frame = 0
+
+    for images in iter_frames(raw_dir, layout):
+        for offset in range(len(images)):
+            if max_frames is not None and frame >= max_frames:
+                return report
+
+            for index, channel in enumerate(layout.channels):
+                if frame >= len(tiffs[channel]):
+                    report.missing_tiffs += 1
+                    continue
+
+                with open(tiffs[channel][frame][2], "rb") as fh:
+                    expected = tiff_decode(fh.read())
+
+                diff = int(np.abs(images[offset, index].astype(np.int64) - expected).max())
+                report.max_abs_diff = max(report.max_abs_diff, diff)
+                if diff:
+                    report.mismatched.append((channel, frame, diff))
+
+            report.frames_compared += 1
+            frame += 1
+
+    return report
+
+
+def write_synthetic_recording(raw_dir: Path, layout: RawLayout, num_frames: int,
+                              num_files: int = 3, seed: int = 0) -> np.ndarray:
+    """
+    Write a synthetic recording in the layout decoded by this module.
+
+    Writes RAWDATA files split at arbitrary points rather than frame boundaries, a
+    Filelist.txt naming them and a recording XML with the layout's settings, so the
+    whole decoding path can be exercised without a microscope.
+
+    Args:
+        raw_dir:
+            Directory to write into. Its name is used for the recording XML.
+        layout:
+            Layout to encode the frames with.
+        num_frames:
+            Number of frames to write.
+        num_files:
+            Number of RAWDATA files the stream is split across.
+        seed:
+            Seed for the random image contents.
+
+    Returns:
+        The encoded images, shape (frames, channels, lines, pixels).
+    """
+
+    raw_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    info = np.iinfo(np.dtype(layout.dtype))
+    high = min(info.max, np.iinfo(np.uint16).max) - layout.offset
+    images = rng.integers(0, high, (num_frames, len(layout.channels), *layout.frame_shape), dtype=np.int64)
+
+    # Encode: flip the lines scanned right to left, move channels last, repeat each pixel's
+    # value for every sample and add the offset back.
+    encoded = images.copy()
+    if layout.bidirectional:
+        encoded[:, :, 1::2, :] = encoded[:, :, 1::2, ::-1]
+    encoded = np.moveaxis(encoded, 1, -1)[:, :, :, np.newaxis, :]
+    encoded = np.repeat(encoded, layout.samples_per_pixel, axis=3) + layout.offset
+    stream = encoded.astype(layout.dtype).ravel()
+
+    # Split the stream at random sample positions
+    cuts = np.sort(rng.choice(np.arange(1, len(stream)), num_files - 1, replace=False))
+    names = []
+    for index, part in enumerate(np.split(stream, cuts), start=1):
+        name = "CYCLE_000001_RAWDATA_%06d" % index
+        part.tofile(raw_dir / name)
+        names.append(name)
+
+    (raw_dir / (raw_dir.name + "Filelist.txt")).write_text("\n".join(names) + "\n")
+
+    files = "".join('<File channel="%d" channelName="Ch%d" filename="f.ome.tif" />' % (channel, channel)
+                    for channel in layout.channels)
+    frames = "".join('<Frame index="%d" relativeTime="%f">%s</Frame>' % (index, index / 30, files)
+                     for index in range(1, num_frames + 1))
+    states = "".join('<PVStateValue key="%s" value="%s" />' % item for item in [
+        ("linesPerFrame", layout.lines_per_frame),
+        ("pixelsPerLine", layout.pixels_per_line),
+        ("samplesPerPixel", layout.samples_per_pixel),
+        ("activeMode", "ResonantGalvo" if layout.bidirectional else "Galvo"),
+    ])
+    (raw_dir / (raw_dir.name + ".xml")).write_text(
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<PVScan version="5.6.64.200"><PVStateShard>%s</PVStateShard>'
+        '<Sequence type="TSeries Timed Element" cycle="1">%s</Sequence></PVScan>' % (states, frames)
+    )
+
+    return images.astype(np.uint16)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Decode Bruker RAWDATA into HDF5 without the ripper.')
+    parser.add_argument('--directory',
+                        type=Path,
+                        required=True,
+                        help='Directory containing RAWDATA, Filelist.txt and the recording .xml.')
+    parser.add_argument('--output',
+                        type=Path,
+                        help='HDF5 file to write.')
+    parser.add_argument('--compare_tiffs',
+                        type=Path,
+                        help='Directory of tiffs from the ripper to compare decoded frames against.')
+    parser.add_argument('--max_frames',
+                        type=int,
+                        help='Number of frames to compare against the tiffs.')
+    parser.add_argument('--samples_per_pixel',
+                        type=int,
+                        help='Override the samples per pixel from the XML.')
+    parser.add_argument('--bidirectional',
+                        type=lambda value: value.lower() in ("1", "true", "yes"),
+                        help='Override whether every other line is flipped (true/false).')
+    parser.add_argument('--offset',
+                        type=int,
+                        help='Value subtracted from every sample.')
+    parser.add_argument('--dtype',
+                        type=str,
+                        help='NumPy dtype of the raw samples, ie <u2 or <i2.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s.%(msecs)03d %(module)s:%(lineno)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    layout = read_layout(args.directory / (args.directory.name + ".xml"),
+                         samples_per_pixel=args.samples_per_pixel,
+                         bidirectional=args.bidirectional,
+                         offset=args.offset,
+                         dtype=args.dtype)
+
+    logging.info("Raw layout: %s", layout)
+
+    if args.compare_tiffs:
+        report = compare_to_tiffs(args.directory, args.compare_tiffs, layout, args.max_frames)
+        logging.info("Compared %d frames: %d mismatched, %d tiffs missing, max difference %d",
+                     report.frames_compared, len(report.mismatched), report.missing_tiffs, report.max_abs_diff)
+        for channel, frame, diff in report.mismatched[:20]:
+            logging.info("  Ch%d frame %d differs by up to %d", channel, frame, diff)
+
+    if args.output:
+        raw_to_hdf5(args.directory, args.output, layout)
@@ -0,0 +1,140 @@
+"""Summarize Prairie View recording XMLs without loading them into memory."""
+
+from array import array
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import List, Optional
+
+import lxml.etree
+import numpy as np
+
+from metadata_cache import default_cache
+
+
+@dataclass
+class SequenceSummary:
+    """Frames recorded in one <Sequence>, which is one cycle of a T-series."""
+
+    cycle: int
+    type: str
+    num_frames: int = 0
+    last_index: int = 0
+
+
+@dataclass
+class RecordingSummary:
+    """The sequences of a recording and the frames recorded in each."""
+
+    sequences: List[SequenceSummary] = field(default_factory=list)
+
+    @property
+    def num_cycles(self) -> int:
+        return len(self.sequences)
+
+    @property
+    def num_frames(self) -> int:
+        return sum(sequence.num_frames for sequence in self.sequences)
+
+    @property
+    def frames_per_sequence(self) -> List[int]:
+        return [sequence.num_frames for sequence in self.sequences]
+
+
+def _clear(element: lxml.etree._Element):
+    """Free an element and the siblings already parsed before it."""
+
+    element.clear()
+    parent = element.getparent()
+    if parent is not None:
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+def summarize_recording(xml_path: Path) -> RecordingSummary:
+    """
+    Count the sequences and frames in a recording's XML file.
+
+    Long T-series have one <Frame> element per frame, so their XML files are hundreds
+    of MB. The file is parsed as a stream and each frame is freed once it has been
+    counted, so memory use doesn't grow with the length of the recording. Like
+    xml_parser(), badly formed XML is recovered from rather than raising.
+
+    Args:
+        xml_path:
+            Path to the recording's .xml file.
+
+    Returns:
+        Summary of the recording's sequences.
+    """
+
+    summary = RecordingSummary()
+    sequence = None
+    sequence_element = None
+
+    # Only end events are needed, since a frame's <Sequence> has already been started, and
+    # asking for nothing else keeps the parse quick.
+    events = lxml.etree.iterparse(str(xml_path), events=("end",), tag=("Sequence", "Frame"),
+                                  recover=True, huge_tree=True)
+
+    for _, element in events:
+        parent = element if element.tag == "Sequence" else element.getparent()
+
+        if parent is not sequence_element:
+            sequence_element = parent
+            sequence = SequenceSummary(cycle=int(parent.get("cycle", len(summary.sequences) + 1)),
+                                       type=parent.get("type", ""))
+            summary.sequences.append(sequence)
+
+        if element.tag == "Frame":
+            sequence.num_frames += 1
+            sequence.last_index = int(element.get("index", sequence.num_frames))
+        else:
+            sequence_element = None
+
+        _clear(element)
+
+    return summary
+
+
+def frame_times(xml_path: Path, cycle: Optional[int] = None, clock: str = "relativeTime") -> np.ndarray:
+    """
+    Read the time of every frame in a recording's XML file.
+
+    Each <Frame> records when it was acquired, so these times show dropped and irregular
+    frames that the nominal frame rate in the .env file hides. Like summarize_recording(),
+    the file is streamed and each frame freed once its time is read, so the only memory
+    that grows with the recording is the 8 bytes per frame of the returned array.
+
+    Args:
+        xml_path:
+            Path to the recording's .xml file.
+        cycle:
+            Only read the frames of this cycle. Frames of every cycle are read, in order, if None.
+        clock:
+            Frame attribute to read, "relativeTime" for seconds since the recording started
+            or "absoluteTime" for seconds since Prairie View's clock was started.
+
+    Returns:
+        Array of float64 times in seconds, one per frame. Frames without the attribute are NaN.
+    """
+
+    times = array("d")
+
+    events = lxml.etree.iterparse(str(xml_path), events=("end",), tag="Frame", recover=True, huge_tree=True)
+
+    for _, element in events:
+        if cycle is None or int(element.getparent().get("cycle", 1)) == cycle:
+            value = element.get(clock)
+            times.append(float(value) if value is not None else np.nan)
+
+        _clear(element)
+
+    return np.frombuffer(times, dtype=np.float64)
+
+
+def cached_recording_summary(xml_path: Path) -> RecordingSummary:
+    """Summarize a recording, reusing the summary in the metadata cache until the file changes."""
+
+    values = default_cache().get(xml_path, "recording_summary", lambda path: asdict(summarize_recording(path)))
+
+    return RecordingSummary([SequenceSummary(**sequence) for sequence in values["sequences"]])
@@ -12,24 +12,38 @@ import atexit
 import logging
 from pathlib import Path
 import platform
+import shlex
 import subprocess
 import time
 import os
-import shutil
-import pandas as pd
+from typing import List
+
+from frame_manifest import MANIFEST_NAME, write_manifest
+from permissions import FILE_MODE, normalize_permissions
+from progress import RipProgress
+from stream_pack import StreamingPacker
+from tiff_index import TiffIndex
+from transfer import move_back_files
+from verify_tiffs import verify_tiffs
+from voltage_events import VoltageRecordingTail, extract_events
+from watcher import RipWatcher
 
 logger = logging.getLogger(__name__)
 
-# Ripping process does not end cleanly, so the filesystem is polled to detect the
-# processing finishing.  The following variables relate to the timing of that polling
+# Ripping process does not end cleanly, so the output directory is watched to detect the
+# processing finishing.  The following variables relate to the timing of that watching
 # process.
 
 # Total wait time is very large in case of multiple channels being recorded
 # This is just in case the ripper is stuck hanging for some long period of time
 # so it can be automatically killed.
 RIP_TOTAL_WAIT_SECS = 7200  # Total time to wait for ripping before killing it.
-RIP_EXTRA_WAIT_SECS = 10  # Extra time to wait after ripping is detected to be done.
-RIP_POLL_SECS = 10  # Time to wait between polling the filesystem.
+RIP_CSV_WAIT_SECS = 600  # Time the voltage recording may go without growing before giving up on it.
+RIP_EXTRA_WAIT_SECS = 10  # Extra time to wait after ripping is detected to be done when scanning.
+RIP_POLL_SECS = 10  # Time between progress messages while waiting on the ripper.
+RIP_TAIL_SECS = 1  # Time between parsing new rows of the voltage recording while it's written.
+RIP_STALL_SECS = 600  # Time without any new tiffs after which the ripper is considered hung.
+RIP_RATE_WINDOW_SECS = 120  # Window the ripping rate and time remaining are estimated over.
 
 # Name of the ripping utility, spaces are removed because Python interprets a space
 # in the string as the end of a given command.
@@ -48,26 +62,38 @@ SCRATCH_DIRECTORY = Path("/temp/")
 # as /data/
 DATA_DIRECTORY = Path("/data/")
 
+# Logs are written to the pipeline's logs directory, mounted as /logs/ in the container
+LOG_DIRECTORY = Path("/logs/")
+
 
 class RippingError(Exception):
     """Error raised if problems encountered during data conversion."""
 
 
-def raw_to_tiff(raw_dir: Path, ripper_version: str, num_images: int):
+def raw_to_tiff(raw_dir: Path, ripper_version: str, num_images: int, stream_channel: int = None,
+                chunksize: int = 128, delete_packed: bool = False, stall_secs: float = RIP_STALL_SECS,
+                data_root: Path = DATA_DIRECTORY, scratch_dir: Path = SCRATCH_DIRECTORY,
+                ripper_dir: Path = RIPPER_DIRECTORY, ripper_command: List[str] = None,
+                checksum_manifest: bool = False, decode_verify: bool = False):
     """Convert Bruker RAW files to TIFF/.csv files using ripping utility specified with `ripper`.
     
     From the specified data directory, grabs the raw file lists, raw/unconverted data,
     and checks to ensure that no tiffs currently reside in output directory. Executes
     a subprocess that starts the ripper. The lab's naming convention has the Voltage Recording
-    converted first, so the output directory is polled for size of the .csv being built. When
-    the file size has remained the same between polls, the voltage conversion is detected as being
-    completed. It will immediately begin converting the imaging data into tiffs and poll the file
-    system for the number of tiffs in the output directory. Once the number of tiffs is the same
+    converted first, so the output directory is watched for the .csv being built. When the ripper
+    closes the .csv or starts writing tiffs, the voltage conversion is detected as being
+    completed. It will immediately begin converting the imaging data into tiffs and the watcher
+    counts the tiffs as they are closed in the output directory. Once the number of tiffs is the same
     as the expected number of images, the ripper detects that the conversion process is finished.
     This will kill the subprocess for ripping and start performing permission bit changes. Once this
     is completed, files will be moved or removed depending on their existence in the raw directory.
     Finally, after completion, the container will be destroyed.
 
+    If `stream_channel` is given, that channel's tiffs are packed into a chunked HDF5 file on
+    the scratch space while the ripper is still running, `chunksize` frames at a time, so the
+    H5 file is finished shortly after ripping is. With `delete_packed`, the packed tiffs are
+    removed as they are written so scratch only holds a few chunks of tiffs at a time.
+
     Args:
         raw_dir:
             Path to raw data that needs converting.
@@ -75,17 +101,39 @@ def raw_to_tiff(raw_dir: Path, ripper_version: str, num_images: int):
             Version of ripper to use, as in major.minor.64.minor (ie 5.6.64.200)
         num_images:
             Total number of images to poll for before killing the ripper.
+        stream_channel:
+            Channel to pack into HDF5 while ripping. No packing is done if None.
+        chunksize:
+            Number of frames per HDF5 chunk when streaming.
+        delete_packed:
+            Delete tiffs once they have been packed when streaming.
+        stall_secs:
+            Kill the ripper if no new tiffs have appeared for this many seconds.
+        data_root:
+            Directory holding `raw_dir`, /data/ inside the container.
+        scratch_dir:
+            Directory the ripper writes into, /temp/ inside the container.
+        ripper_dir:
+            Directory holding a directory of each ripper version.
+        ripper_command:
+            Command run in place of the ripper, such as fake_ripper.py for testing. The
+            ripper's arguments are appended to it.
+        checksum_manifest:
+            Record each tiff's crc32 in the frame manifest, which reads every tiff once more.
+        decode_verify:
+            Fully decode every tiff when verifying them, rather than only checking their
+            headers and sizes.
     
     """
 
     # Generate full path and name for the ripper being used
-    ripper = RIPPER_DIRECTORY / ripper_version / RIPPER_NAME
+    ripper = Path(ripper_dir) / ripper_version / RIPPER_NAME
 
     # Generate full data directory for the raw data
-    data_dir = DATA_DIRECTORY / raw_dir
+    data_dir = Path(data_root) / raw_dir
 
     # Generate temporary directory on the scratch space on the machine
-    tmp_tiff_dir = SCRATCH_DIRECTORY / raw_dir
+    tmp_tiff_dir = Path(scratch_dir) / raw_dir
 
     # Dat used for logger to state which path is being read from
     dat = str(data_dir)
@@ -100,59 +148,6 @@ def raw_to_tiff(raw_dir: Path, ripper_version: str, num_images: int):
     def get_rawdata():
         return list(sorted((data_dir).glob('*RAWDATA*')))
 
-    # Get the number of tiffs in the output directory
-    def get_tiffs():
-        return set((tmp_tiff_dir).glob('*.ome.tif'))
-
-    def copy_back_files():
-        """
-        Copies back metadata files that Bruker copied to output directory.
-        This helps preserve the input directory contents.
-        """
-        # Get list of paths in the output directory for files that are not tif files. These must be moved
-        # back to their original directories
-        paths_to_copy = [path for path in tmp_tiff_dir.iterdir() if not path.name.endswith("ome.tif")]
-        
-        # For each path in the list, if the path links to a file
-        for path in paths_to_copy:
-            if path.is_file():
-
-                # Assign a temporary data directory for the file using the directory it would have originated from
-                tmp_data_dir = data_dir / path.name
-
-                # If the file exists in the original directory, the file would have been copied and not moved
-                # by Bruker's ripper. Delete the file with unlink and log that it was done.
-                if tmp_data_dir.exists():
-                    logger.info("File was COPIED, not MOVED. Removing file...")
-                    path.unlink()
-                    logger.info("File deleted")
-                
-                # Otherwise, try moving the file and log any errors that occur in case an exception is thrown.
-                else:
-                    logger.info("Moving file: %s" % path)
-                    try:
-                        shutil.move(str(path), str(data_dir))
-                        logger.info("File moved to origin")
-                    except PermissionError:
-                        logger.warning("Error: ", PermissionError.strerror)
-                    except AttributeError:
-                        logger.warning("Error: Attribute Error, likely 'PosixPath' object has no attribute 'rstrip'")
-                        logger.warning("Check if paths were turned into strings in the shutil move call")
-                    except:
-                        logger.warning("Unknown error...")
-            
-            # If the path is a directory, it is likely a useless directory like the References directory which we don't
-            # require. Log that it was found and try removing it. If removal fails, log that an error occurred.
-            elif path.is_dir:
-                try:
-                    logger.info("Found directory, unlinking %s" % path)
-                    shutil.rmtree(path)
-                except OSError:
-                    logger.warning("Error: ", OSError.strerror)
-                except:
-                    logger.warning("Unknown directory removal error...")
-
-
     filelists = get_filelists()
 
     if not filelists:
@@ -163,8 +158,8 @@ def raw_to_tiff(raw_dir: Path, ripper_version: str, num_images: int):
         raise RippingError('No RAWDATA files present in %s' % raw_dir)
 
     # The output directory should not have any tiffs present. If so, raise an exception and exit.
-    tiffs = get_tiffs()
-    if tiffs:
+    tiffs = TiffIndex(tmp_tiff_dir)
+    if tiffs.scan():
         raise RippingError('Cannot rip because tiffs already exist in %s (%d found)' % (raw_dir, len(tiffs)))
 
     logger.info('Ripping from:\n %s\n %s', '\n '.join([str(f) for f in filelists]),
@@ -174,10 +169,12 @@ def raw_to_tiff(raw_dir: Path, ripper_version: str, num_images: int):
 
     # If using the ripper on a Linux system, run Wine for converting Windows calls to Unix calls on the fly
     system = platform.system()
-    if system == 'Linux':
-        cmd = ['wine']
+    if ripper_command:
+        cmd = list(ripper_command)
+    elif system == 'Linux':
+        cmd = ['wine', ripper]
     else:
-        cmd = []
+        cmd = [ripper]
 
     # Normally, the fname is passed to -AddRawFile.  But there is a bug in the software, so
     # we have to pop up one level and use -AddRawFileWithSubFolders.
@@ -193,204 +190,273 @@ def raw_to_tiff(raw_dir: Path, ripper_version: str, num_images: int):
     # 9. Convert, which will tell the ripper to actually start the conversion process.
 
     cmd += [
-        ripper,
         "-KeepRaw",
         "-DoNotRipToInputDirectory",
         "-IncludeSubFolders",
         "-AddRawFileWithSubFolders",
         str(data_dir),
         "-SetOutputDirectory",
-        str(SCRATCH_DIRECTORY),
+        str(scratch_dir),
         "-Convert"
     ]
 
-    # Run a subprocess to execute the ripping.  Note this is non-blocking because the
-    # ripper never exists.  (If we blocked waiting for it, we'd wait forever.)  Instead,
-    # we wait for the input files to be consumed and/or output files to be finished.
-    process = subprocess.Popen(cmd)
+    # Start watching the output directory before the ripper starts so that no files are
+    # missed. The watcher is notified as files are created and closed in the output
+    # directory, so completion is detected as soon as it happens instead of on the next poll.
+    # When streaming, every tiff the watcher sees closed is handed to the packer, which writes
+    # frames to the H5 file a chunk at a time as they become available.
+    if stream_channel is not None:
+        hdf5file = Path(str(tmp_tiff_dir) + ".hdf5")
+        logger.info("Streaming channel %d into: %s" % (stream_channel, hdf5file))
+        packer = StreamingPacker(hdf5file, tmp_tiff_dir, stream_channel, chunksize=chunksize,
+                                 delete_packed=delete_packed)
+        on_tiff = packer.add
+    else:
+        packer = None
+        on_tiff = None
 
-    logger.info("Ripping has started!")
+    watcher = RipWatcher(tmp_tiff_dir, num_images, on_tiff=on_tiff)
+    process = None
 
-    # Given how filenames are created/named from Prairie View and Bruker Control, the
-    # csv files are converted first. Because we started the ripper just before this point,
-    # a csv file should now be present in the tmp_tiff_dir. We can poll the size of this
-    # with os.stat(path).st_size after globbing it from the path
+    # The ripper never exits on its own, the watcher holds an inotify descriptor and the packer
+    # holds the HDF5 file open until it finishes. All three are cleaned up on every way out of
+    # ripping, whether the ripper stalls or times out or any step raises.
+    try:
+        watcher.start()
+
+        # Run a subprocess to execute the ripping.  Note this is non-blocking because the
+        # ripper never exists.  (If we blocked waiting for it, we'd wait forever.)  Instead,
+        # we wait for the input files to be consumed and/or output files to be finished.
+        process = subprocess.Popen(cmd)
+
+        # Register a cleanup function that will kill the ripping subprocess.  This handles the cases
+        # where someone hits Cntrl-C, or the main program exits for some other reason.  Without
+        # this cleanup function, the subprocess will just continue running in the background.
+        def cleanup():
+            timeout_sec = 5
+            p_sec = 0
+            for _ in range(timeout_sec):
+                if process.poll() == None:
+                    time.sleep(1)
+                    p_sec += 1
+            if p_sec >= timeout_sec:
+                process.kill()
+            logger.info('Cleaned up!')
 
-    # TODO: Ripping .csv and ripping tiffs should be their own functions inside this script
-    # TODO: Should make a check to see if there are voltage recordings to convert. If there are,
-    # the csv converter should be called. If not, it should be skipped.
+        atexit.register(cleanup)
+
+        logger.info("Ripping has started!")
 
-    # It takes a few seconds for the ripper to get started and create the csv file
-    # Sleep the program and get the csv file
-    time.sleep(20)
+        # Given how filenames are created/named from Prairie View and Bruker Control, the
+        # csv files are converted first. The watcher reports the csv as finished once the ripper
+        # closes it or moves on to writing tiffs. Rows are parsed as they are written in the
+        # meantime, so the events are ready right away.
 
-    behavior_glob = tmp_tiff_dir.glob("*")
+        # TODO: Ripping .csv and ripping tiffs should be their own functions inside this script
+        # TODO: Should make a check to see if there are voltage recordings to convert. If there are,
+        # the csv converter should be called. If not, it should be skipped.
+        behavior_csv, behavior_tail = follow_behavior_csv(watcher)
 
-    # There are no other ways to generate a .csv in this process, so the only .csv
-    # that's available is the correct one to poll
-    behavior_csv = [file for file in behavior_glob][0]
+        if behavior_csv is None:
+            raise RippingError('Voltage recording stopped growing for %s seconds before it was finished'
+                               % RIP_CSV_WAIT_SECS)
 
-    logger.info("Found .csv file for behavior: %s" % behavior_csv)
+        logger.info("Voltage Recording .csv size: %s" % os.stat(behavior_csv).st_size)
 
-    # Create a flag for ripping the csv file, used in the while loop next
-    ripping_csv = True
+        logger.info("Voltage .csv Ripping Complete!")
 
-    # Get the size of the csv file
-    behavior_csv_size = os.stat(behavior_csv).st_size
+        logger.info("Cleaning voltage recording into timestamps...")
 
-    logger.info("Voltage Recording .csv size: %s" % behavior_csv_size)
+        get_behavior_timestamps(behavior_csv, tail=behavior_tail, output_dir=data_root)
 
-    # While the converter is ripping the .csv file
-    while ripping_csv:
+        logger.info("Cleaned behavior file written!")
 
-        # Wait the RIP_POLL_SECS delay before moving foward with the check
-        time.sleep(RIP_POLL_SECS)
+        remaining_sec = RIP_TOTAL_WAIT_SECS
 
-        # Get the latest csv file size
-        new_behavior_csv_size = os.stat(behavior_csv).st_size
+        # Tracks how quickly tiffs are coming in to estimate the time left and to notice the ripper
+        # hanging, rather than waiting out the whole RIP_TOTAL_WAIT_SECS.
+        progress = RipProgress(num_images, window_secs=RIP_RATE_WINDOW_SECS, stall_secs=stall_secs)
 
-        logger.info("Voltage Recording .csv size: %s" % new_behavior_csv_size)
+        # Check at least as often as the stall timeout, so a stall is caught when it happens
+        poll_secs = min(RIP_POLL_SECS, stall_secs)
 
-        # Check if the current size is the same as the previous size
-        diff_csv_size = (behavior_csv_size != new_behavior_csv_size)
+        logger.info("Starting to rip tiff files...")
 
-        # If the sizes are different
-        if diff_csv_size:
+        while remaining_sec >= 0:
 
-            # The most recent size is assigned as the previous size
-            behavior_csv_size = new_behavior_csv_size
+            # Returns as soon as the last expected tiff is closed, otherwise after poll_secs
+            # so progress can be logged.
+            tiffs_done = watcher.wait_for_tiffs(min(poll_secs, remaining_sec))
+            remaining_sec -= poll_secs
 
-            logger.info("Still ripping voltage recording...")
-        
-        # If the sizes are NOT different, the ripper is done with the .csv!
-        # Exit the loop by setting ripping_csv to false
-        else:
+            progress.update(watcher.num_tiffs)
 
-            ripping_csv = False
-    
-    logger.info("Voltage .csv Ripping Complete!")
+            logger.info(progress.record())
+            logger.info('  Found this many tiff files: %s (%s)', watcher.num_tiffs,
+                        watcher.tiffs.channel_progress())
 
-    logger.info("Cleaning voltage recording into timestamps...")
+            if progress.stalled:
+                raise RippingError('Killed ripper because no new tiffs appeared for %d seconds (%d of %d ripped)'
+                                   % (progress.stalled_secs, watcher.num_tiffs, num_images))
 
-    get_behavior_timestamps(behavior_csv)
+            # If the number of tiffs converted is the same as the number of images expected, kill the
+            # ripper.
+            if tiffs_done:
+                logger.info('Detected ripping is complete')
+                watcher.close()
 
-    logger.info("Cleaned behavior file written!")
+                # Close events mean every tiff has been completely written. Only wait when the
+                # directory had to be scanned, since the last tiffs may still be open.
+                if not watcher.uses_inotify:
+                    time.sleep(RIP_EXTRA_WAIT_SECS)  # Wait before terminating ripper, just to be safe.
+                logger.info('Killing ripper')
+                process.kill()
+                logger.info('Ripper has been killed')
 
-    # Register a cleanup function that will kill the ripping subprocess.  This handles the cases
-    # where someone hits Cntrl-C, or the main program exits for some other reason.  Without
-    # this cleanup function, the subprocess will just continue running in the background.
-    def cleanup():
-        timeout_sec = 5
-        p_sec = 0
-        for _ in range(timeout_sec):
-            if process.poll() == None:
-                time.sleep(1)
-                p_sec += 1
-        if p_sec >= timeout_sec:
-            process.kill()
-        logger.info('Cleaned up!')
+                # Write out whatever frames are left over after the last full chunk
+                if packer is not None:
+                    num_packed = packer.finish()
+                    expected_packed = watcher.tiffs.channel_counts[stream_channel]
+                    if num_packed != expected_packed:
+                        raise RippingError('Packed %d frames but ripped %d for channel %d'
+                                           % (num_packed, expected_packed, stream_channel))
 
-    atexit.register(cleanup)
+                # A tiff the ripper was killed partway through still counts towards the total, so
+                # every tiff is checked to be complete before the raw data or the tiffs are touched.
+                # Tiffs already deleted after packing were decoded then, so they're skipped.
+                logger.info("Verifying %d tiffs%s", watcher.num_tiffs,
+                            " by decoding them" if decode_verify else "")
 
-    remaining_sec = RIP_TOTAL_WAIT_SECS
+                verification = verify_tiffs(tmp_tiff_dir, watcher.tiffs.names, decode=decode_verify,
+                                            missing_ok=delete_packed)
 
-    logger.info("Starting to rip tiff files...")
+                logger.info("Verified %d tiffs (%d skipped) in %.1f seconds, %.0f tiffs/s, %.0f MB/s",
+                            verification.checked, verification.skipped, verification.seconds,
+                            verification.files_per_sec, verification.mb_per_sec)
 
-    while remaining_sec >= 0:
-        logger.info('Watching for ripper to finish for %d more seconds', remaining_sec)
-        remaining_sec -= RIP_POLL_SECS
-        time.sleep(RIP_POLL_SECS)
+                for name, reason in verification.failed:
+                    logger.error("Tiff failed verification: %s: %s" % (name, reason))
 
-        # get_tiffs returns set, meaning unique instances of, tiff paths
-        tiffs = get_tiffs()
+                if not verification.ok:
+                    raise RippingError('%d of %d tiffs failed verification in %s'
+                                       % (len(verification.failed), watcher.num_tiffs, tmp_tiff_dir))
 
-        # The length of this set is the number of images that have been converted.
-        num_tiffs = len(tiffs)
+                # Change permissions of the data so any SNLKT member can use them. Assuming there's a
+                # need to change permissions is a safe bet because not everyone in the lab will have
+                # the 002 umask in their .login files. Directories become 775 and files 664.
+                logger.info("Changing permissions of %s" % tmp_tiff_dir)
 
-        logging.info('  Found this many tiff files: %s', len(tiffs))
+                permissions = normalize_permissions(tmp_tiff_dir)
 
-        # In order to use f string methods, we can't have empty brackets in the statement
-        # which the bash command requires for executing the permission commands
-        # Assuming there's a need to change permissions is a safe bet because not everyone in
-        # the lab will have the 002 umask in their .login files  So we create a variable brackets
-        # to use in the f string
+                logger.info("Permissions checked for %d entries, %d changed in %.1f seconds",
+                            permissions.checked, permissions.changed, permissions.seconds)
 
-        brackets = "{}"
+                for error in permissions.errors:
+                    logger.warning("Permissions change failed: %s" % error)
 
-        # If the number of tiffs converted is the same as the number of images expected, kill the
-        # ripper.
-        if num_tiffs == num_images:
-            logger.info('Detected ripping is complete')
-            time.sleep(RIP_EXTRA_WAIT_SECS)  # Wait before terminating ripper, just to be safe.
-            logger.info('Killing ripper')
-            process.kill()
-            logger.info('Ripper has been killed')
+                logger.info("Copying events file and metadata back to raw_data directory...")
 
-            # Change permissions of the data so any SNLKT member can use them
-            logger.info("Changing permissions of directory...")
+                transfer = move_back_files(tmp_tiff_dir, data_dir)
 
-            # Code 775 allows the owner and members of the group all permissions: read, write, and execute
-            # Others are only allowed to read the directories
-            dir_permissions_command = [f"find {tmp_tiff_dir} -type d -exec chmod 775 {brackets} +"]
+                logger.info("Moved %d files, removed %d already present and %d directories in %.1f seconds",
+                            len(transfer.moved), len(transfer.deduplicated), len(transfer.removed_dirs),
+                            transfer.seconds)
 
-            try:
-                # Run the permissions change as a subprocess that uses the available Linux shell
-                dir_permissions_status = subprocess.run(dir_permissions_command, capture_output=True, shell=True)
-            
-            except:
-                logger.warning("Permissions subprocess failed: Directories")
+                for name, reason in transfer.failed:
+                    logger.warning("Could not move %s back: %s" % (name, reason))
 
-            # A return code of 0 indicates that the subprocess completed without any errors. Log the success.
-            if dir_permissions_status.returncode == 0:
-                logger.info("Permissions for directory changed successfully")
-            
-            # Any other code indicates something went wrong. Log that and record the error that was encountered...
-            else:
-                logger.warning("Permissions change failed")
-                logger.info(dir_permissions_status.stderr.decode())
+                # Record every frame's tiff once, from the watcher's index, so later stages can open
+                # the recording without listing tens of thousands of files. Written after the
+                # metadata is moved back so it stays with the tiffs. The recording XML gives the
+                # number of frames every cycle should have.
+                recording_xml = data_dir / (data_dir.name + ".xml")
+                if not recording_xml.exists():
+                    logger.warning("No recording XML at %s, the frame manifest won't have expected frame counts"
+                                   % recording_xml)
+                    recording_xml = None
 
+                manifest = write_manifest(tmp_tiff_dir, watcher.tiffs.names, checksum=checksum_manifest,
+                                          recording_xml=recording_xml,
+                                          packed=packer.deleted_sizes if packer is not None else None)
+                os.chmod(tmp_tiff_dir / MANIFEST_NAME, FILE_MODE)
 
-            logger.info("Changing permissions of files in %s" % tmp_tiff_dir)
+                logger.info("Wrote frame manifest of %d tiffs for channels %s", len(manifest), manifest.channels)
 
-            # Code 664 allows owner and members of the group permissions to: read, write. Execute permissions are
-            # unnecessary for these files because they are not executable (meaning you can't "execute" a .ome.tif)
-            # Others can read the file but do nothing else.
-            file_permissions_command = [f"find {tmp_tiff_dir} -type f -exec chmod 664 {brackets} +"]
+                # Lastly, we want the folder to have "_tiffs" appended to it for clarity and for copying later
+                # to the server.
+                tmp_tiff_dir.rename(str(tmp_tiff_dir) + "_tiffs")
 
-            try:
 
-                # Run the permissions change as a subprocess that uses the available Linux shell
-                file_permissions_status = subprocess.run(file_permissions_command, capture_output=True, shell=True)
+                return
 
-            except:
-                logger.warning("Permissions subprocess failed: Files")
+        raise RippingError('Killed ripper because it did not finish within %s seconds' % RIP_TOTAL_WAIT_SECS)
+    finally:
+        if process is not None and process.poll() is None:
+            logger.info('Killing ripper')
+            process.kill()
+        watcher.close()
+        if packer is not None:
+            packer.close()
 
-            if file_permissions_status.returncode == 0:
-                logger.info("Permissions for file changed successfully")
-            
-            else:
-                logger.warning("Permissions change failed: Files")
-                logger.info(file_permissions_status.stderr.decode())
 
-            try:
-                logger.info("Copying events file and metadata back to raw_data directory...")
-                copy_back_files()
-            
-            except:
-                logger.warning("Unknown error")
+def follow_behavior_csv(watcher: RipWatcher, thresholds: dict = None):
+    """
+    Parse the voltage recording while the ripper writes it.
+
+    Waits for the watcher to report the voltage recording .csv as finished. Once the .csv
+    has been created, the rows appended to it are parsed every RIP_TAIL_SECS, so the events
+    are almost entirely extracted by the time the ripper moves on to the imaging data.
+    Long recordings can take a long time to convert, so the wait only gives up once the
+    .csv hasn't grown for RIP_CSV_WAIT_SECS.
+
+    Args:
+        watcher:
+            Watcher for the ripper's output directory.
+        thresholds:
+            Voltage threshold for any channel that shouldn't use the default of 2V, keyed by channel name
 
-            
-            # Lastly, we want the folder to have "_tiffs" appended to it for clarity and for copying later
-            # to the server.
-            tmp_tiff_dir.rename(str(tmp_tiff_dir) + "_tiffs")
+    Returns:
+        behavior_csv:
+            Path to the finished .csv, or None if it stopped growing for RIP_CSV_WAIT_SECS
+            without being finished
+        behavior_tail:
+            Tail parser holding the events parsed so far, or None if the .csv was never found
+    """
+
+    behavior_tail = None
+    csv_size = None
+    deadline = time.monotonic() + RIP_CSV_WAIT_SECS
+
+    while not watcher.csv_closed:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None, behavior_tail
+
+        watcher.pump(min(RIP_TAIL_SECS, remaining))
 
+        if watcher.csv_path is not None:
+            if behavior_tail is None:
+                behavior_tail = VoltageRecordingTail(watcher.csv_path, thresholds)
+            num_rows = behavior_tail.read()
 
-            return
+            try:
+                size = os.stat(watcher.csv_path).st_size
+            except FileNotFoundError:
+                size = None
+
+            # The ripper is still converting as long as the .csv keeps growing
+            if num_rows or size != csv_size:
+                csv_size = size
+                deadline = time.monotonic() + RIP_CSV_WAIT_SECS
+
+    if behavior_tail is None:
+        behavior_tail = VoltageRecordingTail(watcher.csv_path, thresholds)
 
-    raise RippingError('Killed ripper because it did not finish within %s seconds' % RIP_TOTAL_WAIT_SECS)
+    return watcher.csv_path, behavior_tail
 
 
-def get_behavior_timestamps(behavior_csv: Path):
+def get_behavior_timestamps(behavior_csv: Path, thresholds: dict = None, tail: VoltageRecordingTail = None,
+                            output_dir: Path = DATA_DIRECTORY):
     """
     Cleans raw .csv file into timestamps.
 
@@ -402,47 +468,30 @@ def get_behavior_timestamps(behavior_csv: Path):
     Args:
         behavior_csv:
             Path to converted .csv file that has been converted and written to the machine's scratch space
+        thresholds:
+            Voltage threshold for any channel that shouldn't use the default of 2V, keyed by channel name
+        tail:
+            Tail parser that has been following the .csv while it was written. Only the rows it hasn't
+            parsed yet are read if given.
+        output_dir:
+            Directory the timestamps are written to.
 
     """
 
     # Output timestamps to the input directory and append _events to the filename
-    output_filename = DATA_DIRECTORY / "_".join([behavior_csv.stem, "events.csv"])
+    output_filename = Path(output_dir) / "_".join([behavior_csv.stem, "events.csv"])
 
     logger.info("Writing cleaned behavior file to: %s" % str(output_filename))
 
-    # Read in the csv file and strip the columns of beginning space that Prairie View gives for some reason
-    raw_behavior_df = pd.read_csv(behavior_csv, index_col="Time(ms)").rename(columns=lambda col:col.strip())
-
-    # Anything below 2V in these files is certainly noise; remove them with this filter
-    raw_behavior_df = raw_behavior_df > 2
-
-    # Assign the datatypes to integer values, take the difference between neighboring values, and fill
-    # any NaN values with 0s, although there shouldn't be any
-    raw_behavior_df = raw_behavior_df.astype(int).diff().fillna(0)
-
-    behavior_keys = []
-
-    clean_behavior_dict = {}
-
-    # Grab columns and create on/off keys for writing out timestamps later
-    for key in raw_behavior_df.columns:
-
-        behavior_keys.append("_".join([key, "on"]))
-        behavior_keys.append("_".join([key, "off"]))
-
-    # For each key, append values where there's a value of 1, meaning ON, to the ON keys
-    # and where there's a value of -1 append to the OFF keys.
-    for key in behavior_keys:
-        if "on" in key:
-            clean_behavior_dict[key] = raw_behavior_df.query(key.split("_")[0] + " == 1").index.tolist()
-        else:
-            clean_behavior_dict[key] = raw_behavior_df.query(key.split("_")[0] + " == -1").index.tolist()
-
-    # Create new dataframe from the dictionary and transpose from rows to columns so .csv is written correctly
-    output_dataframe = pd.DataFrame.from_dict(clean_behavior_dict, orient="index").transpose()
+    # Rising and falling edges for every channel are found in one vectorized pass over the
+    # recording, producing one column of ON times and one of OFF times per channel.
+    if tail is not None:
+        output_dataframe = tail.finish()
+    else:
+        output_dataframe = extract_events(behavior_csv, thresholds)
 
     output_dataframe.to_csv(output_filename)
-            
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Preprocess 2-photon raw data into individual tiffs.')
@@ -458,6 +507,45 @@ if __name__ == "__main__":
                         type=int,
                         required=True,
                         help='Total number of images to be converted for the recording.')
+    parser.add_argument('--stream_channel',
+                        type=int,
+                        help='Channel to pack into an HDF5 file while ripping.')
+    parser.add_argument('--chunksize',
+                        type=int,
+                        default=128,
+                        help='Number of frames per HDF5 chunk when streaming.')
+    parser.add_argument('--delete_packed',
+                        action='store_true',
+                        help='Delete tiffs once they have been packed into the HDF5 file.')
+    parser.add_argument('--stall_secs',
+                        type=float,
+                        default=RIP_STALL_SECS,
+                        help='Kill the ripper if no new tiffs appear for this many seconds.')
+    parser.add_argument('--data_root',
+                        type=Path,
+                        default=DATA_DIRECTORY,
+                        help='Directory holding the directory to rip, when not running in the container.')
+    parser.add_argument('--scratch_dir',
+                        type=Path,
+                        default=SCRATCH_DIRECTORY,
+                        help='Directory to rip into, when not running in the container.')
+    parser.add_argument('--ripper_dir',
+                        type=Path,
+                        default=RIPPER_DIRECTORY,
+                        help='Directory of ripper versions, when not running in the container.')
+    parser.add_argument('--ripper_command',
+                        type=shlex.split,
+                        help='Command to run in place of the ripper, such as "python fake_ripper.py --rate 50".')
+    parser.add_argument('--log_dir',
+                        type=Path,
+                        default=LOG_DIRECTORY,
+                        help='Directory the log file is written to.')
+    parser.add_argument('--checksum_manifest',
+                        action='store_true',
+                        help='Record the crc32 of every tiff in the frame manifest.')
+    parser.add_argument('--decode_verify',
+                        action='store_true',
+                        help='Fully decode every tiff when verifying them after ripping.')
     parser.add_argument('--log_file',
                         type=str,
                         required=True,
@@ -465,11 +553,14 @@ if __name__ == "__main__":
                         help='Name of logfile for container.')
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO,
-                    filename="/logs/" + args.log,
+                    filename=str(args.log_dir / args.log),
                     format='%(asctime)s.%(msecs)03d %(module)s:%(lineno)s %(levelname)s %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 
 
     logging.info("Container starting for %s" % args.directory)
 
-    raw_to_tiff(args.directory, args.ripper_version, args.num_images)
+    raw_to_tiff(args.directory, args.ripper_version, args.num_images, args.stream_channel,
+                args.chunksize, args.delete_packed, args.stall_secs, args.data_root, args.scratch_dir,
+                args.ripper_dir, args.ripper_command, args.checksum_manifest,
+                args.decode_verify)
@@ -19,4 +19,5 @@ export WINEARCH="win64"
 
 cp -r /home/wineuser/.wine "${WINEPREFIX}"
 
-${CMDPREFIX} -a python3 /apps/rip.py --directory $1 --ripper_version $2 --log_file $3 --num_images $4
+# Any arguments after the first four, such as --stream_channel, are passed on to rip.py
+${CMDPREFIX} -a python3 /apps/rip.py --directory $1 --ripper_version $2 --log_file $3 --num_images $4 "${@:5}"
@@ -0,0 +1,260 @@
+"""Run ripping containers without overcommitting the node they run on."""
+
+import logging
+import os
+import shutil
+import subprocess
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# Time between checks on running jobs and free resources.
+SCHEDULER_POLL_SECS = 5
+
+# Exit status recorded for a job that couldn't be started at all.
+LAUNCH_FAILED = -1
+
+# Fraction of the node's cores and memory that jobs may reserve, leaving the rest for
+# the system and anyone else logged in.
+RESOURCE_FRACTION = 0.9
+
+GIB = 1024 ** 3
+
+
+@dataclass
+class Job:
+    """
+    A command to run along with the resources it needs.
+
+    Jobs that don't run a command set `launch` instead, a function that starts the job
+    and returns an object whose poll() returns None while it runs and then its exit
+    status, like a subprocess.Popen. A job that couldn't be started finishes straight
+    away with a returncode of LAUNCH_FAILED and the reason in `message`.
+    """
+
+    name: str
+    cmd: Optional[Union[str, List[str]]] = None
+    cpus: float = 4
+    memory_bytes: int = 10 * GIB
+    scratch_bytes: int = 0
+    launch: Optional[Callable[[], Any]] = None
+
+    process: Optional[Any] = None
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    returncode: Optional[int] = None
+    message: str = ""
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.returncode is None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.returncode == 0
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.started is None:
+            return None
+
+        return (self.finished or time.monotonic()) - self.started
+
+
+def available_memory() -> int:
+    """Return the memory available for new processes in bytes, from /proc/meminfo."""
+
+    with open("/proc/meminfo") as meminfo:
+        for line in meminfo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+
+    raise OSError("MemAvailable not found in /proc/meminfo")
+
+
+def total_memory() -> int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+class JobScheduler:
+    """
+    Starts queued jobs as the node's cores, memory and scratch space allow.
+
+    Every job declares the cores and memory it's limited to and the scratch space it
+    will write. A job is only started once its cores and memory fit alongside what the
+    running jobs have reserved, the memory is actually free right now, and the scratch
+    space left after the running jobs finish writing is enough. Jobs are started in the
+    order they were submitted and waited on until they exit, reporting when each starts
+    and finishes and its exit status.
+
+    Args:
+        scratch_dir:
+            Scratch directory the jobs write to.
+        max_jobs:
+            Upper limit on the number of jobs running at once, regardless of resources.
+        poll_secs:
+            Time between checks on running jobs.
+        shell:
+            Run job commands through the shell.
+        on_start:
+            Called with each job once it has been started.
+        on_finish:
+            Called with each job once it has exited.
+        new_session:
+            Start each job in its own session, so a Ctrl-C in the terminal doesn't reach
+            it and running jobs can be drained instead.
+    """
+
+    def __init__(self, scratch_dir: Path, max_jobs: Optional[int] = None,
+                 poll_secs: float = SCHEDULER_POLL_SECS, shell: bool = False,
+                 on_start: Optional[Callable[[Job], None]] = None,
+                 on_finish: Optional[Callable[[Job], None]] = None, new_session: bool = False):
+        self.scratch_dir = Path(scratch_dir)
+        self.max_jobs = max_jobs
+        self.poll_secs = poll_secs
+        self.shell = shell
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.new_session = new_session
+
+        self.total_cpus = (os.cpu_count() or 1) * RESOURCE_FRACTION
+        self.total_memory = total_memory() * RESOURCE_FRACTION
+
+        self.queued = []
+        self.running = []
+        self.done = []
+
+    def submit(self, job: Job):
+        """Queue a job to be started once resources allow."""
+
+        self.queued.append(job)
+        logger.info("Queued %s (%d queued)", job.name, len(self.queued))
+
+    def run(self) -> List[Job]:
+        """
+        Run every queued job, returning once all of them have finished.
+
+        Returns:
+            The finished jobs, in the order they finished.
+        """
+
+        while self.queued or self.running:
+            self.poll()
+            if self.queued or self.running:
+                time.sleep(self.poll_secs)
+
+        self.report()
+
+        return self.done
+
+    def drain(self) -> List[Job]:
+        """
+        Wait for the running jobs to finish without starting any more.
+
+        Returns:
+            The queued jobs that were never started.
+        """
+
+        dropped, self.queued = self.queued, []
+        if dropped:
+            logger.info("Dropping %d queued jobs, waiting on %d running", len(dropped), len(self.running))
+
+        self.run()
+
+        return dropped
+
+    def poll(self):
+        """Collect finished jobs and start queued ones that now fit."""
+
+        for job in list(self.running):
+            returncode = job.process.poll()
+            if returncode is None:
+                continue
+
+            job.returncode = returncode
+            job.finished = time.monotonic()
+            self.running.remove(job)
+            self.done.append(job)
+
+            status = "finished" if job.succeeded else "FAILED with exit status %d" % returncode
+            logger.info("%s %s after %.0f seconds", job.name, status, job.duration)
+
+            if self.on_finish is not None:
+                self.on_finish(job)
+
+        while self.queued and self._fits(self.queued[0]):
+            self._start(self.queued.pop(0))
+
+    def report(self):
+        """Log a summary of every finished job."""
+
+        failed = [job for job in self.done if not job.succeeded]
+
+        logger.info("%d jobs finished, %d failed", len(self.done), len(failed))
+        for job in self.done:
+            logger.info("  %-50s exit %-4s %6.0f s", job.name, job.returncode, job.duration)
+
+    def _fits(self, job: Job) -> bool:
+
+        if self.max_jobs is not None and len(self.running) >= self.max_jobs:
+            return False
+
+        # Nothing else is running, so waiting won't free anything up. Start the job and let
+        # it fail on its own if the node really is too small for it.
+        if not self.running:
+            return True
+
+        reserved_cpus = sum(running.cpus for running in self.running)
+        if reserved_cpus + job.cpus > self.total_cpus:
+            return False
+
+        reserved_memory = sum(running.memory_bytes for running in self.running)
+        if reserved_memory + job.memory_bytes > self.total_memory:
+            return False
+
+        if available_memory() < job.memory_bytes:
+            return False
+
+        # Running jobs may not have written everything yet, so their full scratch use is
+        # set aside.
+        reserved_scratch = sum(running.scratch_bytes for running in self.running)
+        if shutil.disk_usage(self.scratch_dir).free - reserved_scratch < job.scratch_bytes:
+            return False
+
+        return True
+
+    def _start(self, job: Job):
+
+        if not self.running and shutil.disk_usage(self.scratch_dir).free < job.scratch_bytes:
+            logger.warning("Starting %s without enough scratch space for it", job.name)
+
+        job.started = time.monotonic()
+
+        # The job has already left the queue, so a failure to start it is recorded as the
+        # job failing rather than stopping every other job with it.
+        try:
+            if job.launch is not None:
+                job.process = job.launch()
+            else:
+                job.process = subprocess.Popen(job.cmd, shell=self.shell, start_new_session=self.new_session)
+        except Exception as err:
+            job.returncode = LAUNCH_FAILED
+            job.message = "could not be started: %s" % err
+            job.finished = time.monotonic()
+            self.done.append(job)
+
+            logger.error("%s %s", job.name, job.message)
+
+            if self.on_finish is not None:
+                self.on_finish(job)
+            return
+
+        self.running.append(job)
+
+        logger.info("Started %s (%d running, %d queued)", job.name, len(self.running), len(self.queued))
+
+        if self.on_start is not None:
+            self.on_start(job)
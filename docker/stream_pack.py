@@ -0,0 +1,214 @@
+"""Pack tiffs into a chunked HDF5 dataset while the ripper is still writing them."""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import h5py
+import numpy as np
+from imagecodecs import tiff_decode
+
+from tiff_index import parse_tiff_name
+
+logger = logging.getLogger(__name__)
+
+# Number of threads used for decoding the tiffs of a chunk. tiff_decode releases the
+# GIL, so these decode in parallel.
+DECODE_THREADS = 4
+
+
+def imread(filename: Path) -> np.ndarray:
+    """Return the image in a TIFF file as a numpy array."""
+
+    with open(filename, 'rb') as fh:
+        data = fh.read()
+
+    return tiff_decode(data)
+
+
+class StreamingPacker:
+    """
+    Writes a channel's frames into a chunked HDF5 dataset as their tiffs are closed.
+
+    Ripping and packing used to happen one after the other, with h5_conversion only
+    starting once every tiff was on scratch. Instead, each finished tiff is handed to
+    add() and, as soon as the next `chunksize` frames in order are available, they're
+    decoded and appended to the dataset as one chunk. A chunk is only packed once the
+    frame after it has shown up too, which guarantees the ripper is done writing the
+    chunk's last tiff even when the directory is being scanned rather than watched.
+    Packed tiffs can optionally be deleted so scratch only ever holds a few chunks.
+
+    The dataset matches the one written by h5_conversion.tiff2hdf5: frames are stacked
+    along the first axis, chunked by `chunksize` frames and compressed with lzf.
+
+    Args:
+        hdf5file:
+            Output HDF5 file path (ie /temp/recording.hdf5)
+        tiff_dir:
+            Directory the ripper is writing tiffs into.
+        channel:
+            Channel whose frames are packed.
+        dataset_name:
+            Name that should be assigned to the key mapping the 2-photon dataset
+        chunksize:
+            Number of frames per HDF5 chunk and per packing batch.
+        delete_packed:
+            Delete tiffs once their frames are written to the dataset.
+    """
+
+    def __init__(self, hdf5file: Path, tiff_dir: Path, channel: int = 2, dataset_name: str = "2p",
+                 chunksize: int = 128, delete_packed: bool = False):
+        self.hdf5file = Path(hdf5file)
+        self.tiff_dir = Path(tiff_dir)
+        self.channel = channel
+        self.dataset_name = dataset_name
+        self.chunksize = chunksize
+        self.delete_packed = delete_packed
+
+        self.num_packed = 0
+
+        # Size of every tiff deleted once packed, by name, so they can still be listed in the
+        # frame manifest
+        self.deleted_sizes = {}
+
+        # Tiffs waiting to be packed, keyed by (cycle, frame) so they sort in order
+        self._pending = {}
+        self._next = None
+        self._hdf = None
+        self._dataset = None
+        self._pool = ThreadPoolExecutor(DECODE_THREADS)
+
+    def add(self, name: str):
+        """
+        Register a finished tiff and pack any chunks that are now complete.
+
+        Args:
+            name:
+                File name of the tiff in `tiff_dir`.
+        """
+
+        parsed = parse_tiff_name(name)
+        if parsed is None:
+            return
+
+        cycle, channel, frame = parsed
+        if channel != self.channel:
+            return
+
+        self._pending[(cycle, frame)] = name
+
+        # Until the first chunk is written, the earliest frame seen so far is the start
+        if self.num_packed == 0:
+            self._next = min(self._pending)
+
+        while self._chunk_ready():
+            self._pack(self._take(self.chunksize))
+
+    def finish(self) -> int:
+        """
+        Pack every remaining frame and close the HDF5 file.
+
+        Returns:
+            Total number of frames written to the dataset.
+        """
+
+        while self._pending:
+            self._pack(self._take(self.chunksize, in_order=False))
+
+        if self._hdf is not None:
+            self._hdf.close()
+            self._hdf = None
+
+        self._pool.shutdown()
+
+        logger.info("Packed %d frames of channel %d into %s", self.num_packed, self.channel, self.hdf5file)
+
+        return self.num_packed
+
+    def close(self):
+        """
+        Close the HDF5 file without packing the frames still pending.
+
+        Used when ripping fails, so the file isn't left open. Does nothing once finish()
+        has been called.
+        """
+
+        if self._hdf is not None:
+            self._hdf.close()
+            self._hdf = None
+            logger.info("Closed %s after packing %d frames of channel %d", self.hdf5file, self.num_packed,
+                        self.channel)
+
+        self._pool.shutdown()
+
+    def _successor(self, key):
+        """Return the key of the frame that follows `key` if it has arrived."""
+
+        cycle, frame = key
+        if (cycle, frame + 1) in self._pending:
+            return (cycle, frame + 1)
+
+        # The ripper writes cycles in order, so once the next cycle has started the
+        # current one is complete.
+        if (cycle + 1, 1) in self._pending:
+            return (cycle + 1, 1)
+
+        return None
+
+    def _chunk_ready(self) -> bool:
+        """Check whether the next `chunksize` frames and the one after them are available."""
+
+        if len(self._pending) <= self.chunksize or self._next not in self._pending:
+            return False
+
+        key = self._next
+        for _ in range(self.chunksize):
+            key = self._successor(key)
+            if key is None:
+                return False
+
+        return True
+
+    def _take(self, count: int, in_order: bool = True) -> list:
+        """Remove up to `count` frames from the pending frames, in frame order."""
+
+        if in_order:
+            keys = [self._next]
+            while len(keys) < count:
+                keys.append(self._successor(keys[-1]))
+            self._next = self._successor(keys[-1])
+        else:
+            keys = sorted(self._pending)[:count]
+
+        return [self._pending.pop(key) for key in keys]
+
+    def _pack(self, names: list):
+        """Decode a batch of tiffs and append them to the dataset."""
+
+        paths = [self.tiff_dir / name for name in names]
+        frames = np.stack(list(self._pool.map(imread, paths)))
+
+        if self._dataset is None:
+            self._create_dataset(frames)
+
+        start = self._dataset.shape[0]
+        self._dataset.resize(start + len(frames), axis=0)
+        self._dataset[start:] = frames
+        self.num_packed += len(frames)
+
+        if self.delete_packed:
+            for path in paths:
+                self.deleted_sizes[path.name] = path.stat().st_size
+                path.unlink()
+
+    def _create_dataset(self, frames: np.ndarray):
+
+        self._hdf = h5py.File(self.hdf5file, 'w')
+        self._dataset = self._hdf.create_dataset(
+            self.dataset_name,
+            shape=(0, *frames.shape[1:]),
+            maxshape=(None, *frames.shape[1:]),
+            dtype=frames.dtype,
+            chunks=(self.chunksize, *frames.shape[1:]),
+            compression="lzf",
+        )
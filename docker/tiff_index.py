@@ -0,0 +1,138 @@
+"""Incremental index of the tiffs written into a ripper output directory."""
+
+import os
+import re
+import time
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+# Prairie View names every tiff as <recording>_Cycle#####_Ch#_######.ome.tif
+TIFF_PATTERN = re.compile(r"_Cycle(\d+)_Ch(\d+)_(\d+)\.ome\.tif$")
+
+# Directory mtimes come from a coarse clock, so a file created right after a scan can
+# leave the mtime unchanged. Mtimes this recent are never trusted to skip a scan.
+MTIME_SETTLE_NS = 1_000_000_000
+
+
+def parse_tiff_name(name: str) -> Optional[Tuple[int, int, int]]:
+    """
+    Get the cycle, channel and frame numbers from a Prairie View tiff name.
+
+    Returns:
+        (cycle, channel, frame), or None if the name doesn't follow Prairie View's naming.
+    """
+
+    match = TIFF_PATTERN.search(name)
+    if match is None:
+        return None
+
+    return int(match.group(1)), int(match.group(2)), int(match.group(3))
+
+
+class TiffIndex:
+    """
+    Keeps track of which tiffs are present in a directory without re-globbing it.
+
+    Names are stored as plain strings and each new name is parsed once for its cycle,
+    channel and frame, so counts per channel and per cycle are kept up to date as files
+    are added. Entries can be added one at a time as the watcher hears about them, or
+    picked up by scan(), which skips the directory listing entirely when the directory
+    hasn't changed since the last scan.
+
+    Args:
+        directory:
+            Directory containing the tiffs.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.names = set()
+        self.channel_counts = Counter()
+        self.cycle_counts = Counter()
+
+        self._mtime_ns = None
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.names
+
+    def add(self, name: str) -> bool:
+        """
+        Add a tiff to the index.
+
+        Args:
+            name:
+                File name of the tiff, without its directory.
+
+        Returns:
+            Whether the tiff was new to the index.
+        """
+
+        if name in self.names:
+            return False
+
+        self.names.add(name)
+
+        # Tiffs that don't follow Prairie View's naming are still counted in the total
+        parsed = parse_tiff_name(name)
+        if parsed:
+            cycle, channel, _ = parsed
+            self.cycle_counts[cycle] += 1
+            self.channel_counts[channel] += 1
+
+        return True
+
+    def scan(self) -> List[str]:
+        """
+        Add any tiffs in the directory that aren't indexed yet.
+
+        Returns:
+            Names of the tiffs added by the scan.
+        """
+
+        try:
+            mtime_ns = os.stat(self.directory).st_mtime_ns
+        except FileNotFoundError:
+            return []
+
+        # Creating a file updates the directory's mtime, so if it hasn't changed there is
+        # nothing new to list.
+        if mtime_ns == self._mtime_ns:
+            return []
+
+        if time.time_ns() - mtime_ns > MTIME_SETTLE_NS:
+            self._mtime_ns = mtime_ns
+        else:
+            self._mtime_ns = None
+
+        added = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith(".ome.tif") and self.add(entry.name):
+                    added.append(entry.name)
+
+        return added
+
+    def channel_progress(self, expected: Optional[int] = None) -> str:
+        """
+        Summarize the number of tiffs per channel for logging.
+
+        Args:
+            expected:
+                Number of tiffs expected per channel, shown next to each count if given.
+        """
+
+        if not self.channel_counts:
+            return "no channels yet"
+
+        counts = []
+        for channel in sorted(self.channel_counts):
+            count = "Ch%d: %d" % (channel, self.channel_counts[channel])
+            if expected:
+                count += "/%d" % expected
+            counts.append(count)
+
+        return ", ".join(counts)
@@ -3,6 +3,8 @@ import imagecodecs
 import dask.array
 from pathlib import Path
 
+from frame_manifest import FrameManifest
+
 
 def tiffs2zarr(filenames, zarrurl, chunksize, **kwargs):
     """Write images from sequence of TIFF files as zarr."""
@@ -22,4 +24,12 @@ def tiffs2zarr(filenames, zarrurl, chunksize, **kwargs):
 
 tiff_path = Path("/scratch/snlkt_specialk_demo/CSE020/20211105_CSE020_plane1_-587.325_raw-013_tiffs")
 
-tiffs2zarr(sorted(tiff_path.glob('*Ch2*.tif')), "/scratch/20211105_CSE020_no_subtraction/data.zarr", 128)
\ No newline at end of file
+# The frame manifest already lists channel 2's tiffs in frame order
+manifest = FrameManifest.open(tiff_path)
+if manifest.is_packed(2):
+    raise FileNotFoundError("Channel 2 of %s was already packed into HDF5 and its tiffs deleted" % tiff_path)
+
+for cycle, missing in manifest.missing_frames(2).items():
+    print("Cycle %d is missing %d frames, first missing is %d" % (cycle, len(missing), missing[0]))
+
+tiffs2zarr(manifest.paths(channel=2), "/scratch/20211105_CSE020_no_subtraction/data.zarr", 128)
\ No newline at end of file
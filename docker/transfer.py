@@ -0,0 +1,161 @@
+"""Move files the ripper left in its output directory back to the raw data directory."""
+
+import hashlib
+import logging
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Copies across the scratch/server mount boundary are bound by the network, so a few
+# files are copied at once.
+TRANSFER_THREADS = 4
+
+# Size of the blocks files are read in when computing checksums.
+CHECKSUM_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+@dataclass
+class TransferReport:
+    """Summary of moving files back to the raw data directory."""
+
+    moved: List[str] = field(default_factory=list)
+    deduplicated: List[str] = field(default_factory=list)
+    removed_dirs: List[str] = field(default_factory=list)
+    failed: List[Tuple[str, str]] = field(default_factory=list)
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
+def file_checksum(path: Path) -> str:
+    """Return the BLAKE2b checksum of a file, read in blocks."""
+
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def same_contents(first: Path, second: Path) -> bool:
+    """Check two files have the same size and checksum."""
+
+    if os.stat(first).st_size != os.stat(second).st_size:
+        return False
+
+    return file_checksum(first) == file_checksum(second)
+
+
+def _move_file(source: Path, destination_dir: Path, same_device: bool) -> Tuple[str, str]:
+    """
+    Move one file into `destination_dir`.
+
+    Returns:
+        (outcome, reason) where outcome is "moved", "deduplicated" or "failed".
+    """
+
+    destination = destination_dir / source.name
+
+    try:
+        # If the file exists in the original directory, the file would have been copied and not
+        # moved by Bruker's ripper. The copy on scratch is only removed once it's known to match.
+        if destination.exists():
+            if not same_contents(source, destination):
+                return "failed", "differs from the file already in %s" % destination_dir
+            source.unlink()
+            return "deduplicated", ""
+
+        # Within one filesystem a rename is instant and atomic
+        if same_device:
+            os.rename(source, destination)
+            return "moved", ""
+
+        # Otherwise copy to a temporary name, check the copy and only then put it in place
+        # and remove the original, so a failure never leaves a partial file behind. The copy
+        # keeps the original's modification time and mode, just as a rename would.
+        partial = destination_dir / ("." + source.name + ".partial")
+        try:
+            shutil.copy2(source, partial)
+            if not same_contents(source, partial):
+                return "failed", "copy does not match the original"
+            os.replace(partial, destination)
+        finally:
+            if partial.exists():
+                partial.unlink()
+
+        source.unlink()
+        return "moved", ""
+
+    except OSError as err:
+        return "failed", err.strerror or str(err)
+
+
+def move_back_files(source_dir: Path, destination_dir: Path, skip_suffix: str = ".ome.tif",
+                    threads: int = TRANSFER_THREADS) -> TransferReport:
+    """
+    Moves back metadata files that Bruker copied to the output directory.
+
+    This helps preserve the input directory contents. Files are renamed when both
+    directories are on the same device. Across devices, such as from scratch to the
+    server, they are copied by a pool of threads and each copy's size and checksum are
+    verified before the original is deleted. Files Bruker copied rather than moved are
+    deleted from the output directory once they're verified to match. Directories, like
+    the References directory, aren't needed and are removed.
+
+    Args:
+        source_dir:
+            Output directory of the ripper.
+        destination_dir:
+            Raw data directory the files came from.
+        skip_suffix:
+            Files ending with this are left where they are.
+        threads:
+            Number of files copied at once across devices.
+
+    Returns:
+        Report of the files moved, deduplicated and failed.
+    """
+
+    start = perf_counter()
+    report = TransferReport()
+
+    same_device = os.stat(source_dir).st_dev == os.stat(destination_dir).st_dev
+
+    files = []
+    for entry in os.scandir(source_dir):
+        if entry.name.endswith(skip_suffix):
+            continue
+
+        if entry.is_dir(follow_symlinks=False):
+            try:
+                logger.info("Found directory, removing %s" % entry.path)
+                shutil.rmtree(entry.path)
+                report.removed_dirs.append(entry.name)
+            except OSError as err:
+                report.failed.append((entry.name, err.strerror or str(err)))
+        elif entry.is_file(follow_symlinks=False):
+            files.append(Path(entry.path))
+
+    with ThreadPoolExecutor(threads) as pool:
+        outcomes = pool.map(lambda source: _move_file(source, destination_dir, same_device), files)
+
+        for source, (outcome, reason) in zip(files, outcomes):
+            if outcome == "moved":
+                report.moved.append(source.name)
+            elif outcome == "deduplicated":
+                report.deduplicated.append(source.name)
+            else:
+                report.failed.append((source.name, reason))
+
+    report.seconds = perf_counter() - start
+
+    return report
@@ -0,0 +1,215 @@
+"""Check ripped tiffs are complete before anything is done with the ripper's output."""
+
+import logging
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter
+from typing import Iterable, List, Optional, Tuple
+
+from imagecodecs import tiff_decode
+
+logger = logging.getLogger(__name__)
+
+# Reading headers is a few small reads per file and decoding is done by imagecodecs,
+# which releases the GIL, so both run well in a pool of threads.
+VERIFY_THREADS = 8
+
+# Tags giving where a tiff's image data is and how long it is, for strips and for tiles
+DATA_TAGS = {273: "offsets", 279: "counts", 324: "offsets", 325: "counts"}
+
+# Struct formats of the integer field types the data tags use: SHORT, LONG and LONG8
+FIELD_FORMATS = {3: "H", 4: "I", 16: "Q"}
+
+
+@dataclass
+class VerificationReport:
+    """Summary of verifying the tiffs in a directory."""
+
+    checked: int = 0
+    skipped: int = 0
+    bytes_checked: int = 0
+    decoded: bool = False
+    failed: List[Tuple[str, str]] = field(default_factory=list)
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+    @property
+    def files_per_sec(self) -> float:
+        return self.checked / self.seconds if self.seconds else 0.0
+
+    @property
+    def mb_per_sec(self) -> float:
+        return self.bytes_checked / self.seconds / 1e6 if self.seconds else 0.0
+
+
+class TiffError(Exception):
+    """Raised when a tiff's structure doesn't hold together."""
+
+
+def _read_exactly(f, offset: int, size: int) -> bytes:
+
+    f.seek(offset)
+    data = f.read(size)
+    if len(data) != size:
+        raise TiffError("truncated at byte %d, wanted %d more bytes" % (offset + len(data), size - len(data)))
+
+    return data
+
+
+def check_tiff_structure(path: Path) -> int:
+    """
+    Check a tiff's header, first image file directory and image data all fit in the file.
+
+    A tiff cut short by killing the ripper mid-write either fails to parse or has its
+    image data running past the end of the file. Only the header, the directory and the
+    data offsets are read, not the image itself.
+
+    Returns:
+        Size of the file in bytes.
+
+    Raises:
+        TiffError: if the file isn't a complete tiff.
+    """
+
+    size = os.stat(path).st_size
+    if size == 0:
+        raise TiffError("empty file")
+
+    with open(path, "rb") as f:
+        header = _read_exactly(f, 0, 8)
+
+        if header[:2] == b"II":
+            order = "<"
+        elif header[:2] == b"MM":
+            order = ">"
+        else:
+            raise TiffError("not a tiff, starts with %r" % header[:4])
+
+        version = struct.unpack(order + "H", header[2:4])[0]
+        if version == 42:
+            ifd_offset = struct.unpack(order + "I", header[4:8])[0]
+            count_format, entry_format, entry_size, inline_size = "H", "HHII", 12, 4
+        elif version == 43:
+            ifd_offset = struct.unpack(order + "Q", _read_exactly(f, 8, 8))[0]
+            count_format, entry_format, entry_size, inline_size = "Q", "HHQQ", 20, 8
+        else:
+            raise TiffError("unknown tiff version %d" % version)
+
+        if not 8 <= ifd_offset < size:
+            raise TiffError("directory offset %d is outside the file" % ifd_offset)
+
+        count_size = struct.calcsize(count_format)
+        num_entries = struct.unpack(order + count_format, _read_exactly(f, ifd_offset, count_size))[0]
+        entries = _read_exactly(f, ifd_offset + count_size, num_entries * entry_size)
+
+        data = {"offsets": None, "counts": None}
+        for i in range(num_entries):
+            raw = entries[i * entry_size:(i + 1) * entry_size]
+            tag, field_type, count, value = struct.unpack(order + entry_format, raw)
+
+            if tag not in DATA_TAGS or field_type not in FIELD_FORMATS:
+                continue
+
+            value_format = order + FIELD_FORMATS[field_type] * count
+            value_size = struct.calcsize(value_format)
+            if value_size <= inline_size:
+                values = struct.unpack(value_format, raw[-inline_size:][:value_size])
+            else:
+                values = struct.unpack(value_format, _read_exactly(f, value, value_size))
+
+            data[DATA_TAGS[tag]] = values
+
+    if data["offsets"] is None or data["counts"] is None:
+        raise TiffError("no image data offsets in the first directory")
+
+    end = max(offset + count for offset, count in zip(data["offsets"], data["counts"]))
+    if end > size:
+        raise TiffError("image data ends at byte %d but the file is %d bytes" % (end, size))
+
+    return size
+
+
+def _verify_one(path: Path, decode: bool, missing_ok: bool) -> Tuple[Optional[int], str]:
+    """
+    Verify one tiff.
+
+    Returns:
+        (size, reason), with size None if the tiff was skipped or failed, and the reason
+        it failed.
+    """
+
+    try:
+        size = check_tiff_structure(path)
+
+        if decode:
+            with open(path, "rb") as fh:
+                tiff_decode(fh.read())
+
+        return size, ""
+
+    except FileNotFoundError:
+        return None, "" if missing_ok else "file is missing"
+    except TiffError as err:
+        return None, str(err)
+    except OSError as err:
+        return None, err.strerror or str(err)
+    except Exception as err:
+        # Decoding errors come from imagecodecs with their own exception types
+        return None, "could not decode: %s" % err
+
+
+def verify_tiffs(directory: Path, names: Iterable[str], decode: bool = False, missing_ok: bool = False,
+                 threads: int = VERIFY_THREADS) -> VerificationReport:
+    """
+    Verify every tiff in a ripper output directory is complete.
+
+    Counting tiffs only shows the ripper got to the last one. A tiff left zero bytes or
+    half written when the ripper was killed still counts, so every tiff's header and
+    image data offsets are checked against its size by a pool of threads. With `decode`,
+    every tiff is also fully decoded with imagecodecs.tiff_decode, which catches
+    corrupted image data too at the cost of reading everything.
+
+    Args:
+        directory:
+            Directory containing the tiffs.
+        names:
+            File names of the tiffs to verify, without their directory.
+        decode:
+            Also decode every tiff.
+        missing_ok:
+            Skip tiffs that no longer exist, such as ones deleted once packed into HDF5,
+            rather than failing them.
+        threads:
+            Number of tiffs verified at once.
+
+    Returns:
+        Report of the tiffs checked, skipped and failed, and how quickly they were checked.
+    """
+
+    start = perf_counter()
+    report = VerificationReport(decoded=decode)
+
+    directory = Path(directory)
+    names = sorted(names)
+
+    with ThreadPoolExecutor(threads) as pool:
+        outcomes = pool.map(lambda name: _verify_one(directory / name, decode, missing_ok), names)
+
+        for name, (size, reason) in zip(names, outcomes):
+            if size is not None:
+                report.checked += 1
+                report.bytes_checked += size
+            elif reason:
+                report.failed.append((name, reason))
+            else:
+                report.skipped += 1
+
+    report.seconds = perf_counter() - start
+
+    return report
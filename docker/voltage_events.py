@@ -0,0 +1,405 @@
+"""Edge detection for turning Prairie View voltage recordings into event timestamps."""
+
+import io
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Anything at or below 2V in the voltage recordings is certainly noise. Channels can be
+# given their own threshold, otherwise this one is used.
+DEFAULT_THRESHOLD_VOLTS = 2
+
+# Name of the time column Prairie View writes in the voltage recording csv.
+TIME_COLUMN = "Time(ms)"
+
+# Number of samples read from the voltage recording csv at a time. With a handful of
+# channels, a block takes up tens of MB no matter how long the recording is.
+BLOCK_ROWS = 1_000_000
+
+
+def channel_thresholds(channels: Sequence[str], thresholds: Optional[Dict[str, float]] = None) -> np.ndarray:
+    """
+    Build an array of per-channel thresholds.
+
+    Args:
+        channels:
+            Names of the channels in the recording, in column order.
+        thresholds:
+            Threshold in volts for any channel that shouldn't use DEFAULT_THRESHOLD_VOLTS.
+
+    Returns:
+        Array with one threshold per channel.
+    """
+
+    thresholds = thresholds or {}
+
+    unknown = set(thresholds) - set(channels)
+    if unknown:
+        raise KeyError("Thresholds given for channels not in the recording: %s" % sorted(unknown))
+
+    return np.array([thresholds.get(channel, DEFAULT_THRESHOLD_VOLTS) for channel in channels], dtype=np.float64)
+
+
+class EdgeDetector:
+    """
+    Finds when every channel turns on and off, one block of samples at a time.
+
+    A channel is on while its voltage is above its threshold. The samples of all channels
+    in a block are thresholded and differenced together, so each sample is only looked at
+    once no matter how many channels there are. An edge is stamped with the time of the
+    first sample after the change, the same as the pandas `diff()` this replaces.
+
+    The on/off state of the last sample of each block is carried over to the next one, so
+    an edge that falls between two blocks is found just as if the recording had been
+    processed in one piece. This lets a recording be read in fixed-size blocks with
+    constant memory, or parsed as it is being written.
+
+    Args:
+        thresholds:
+            Threshold for each channel, shape (channels,).
+    """
+
+    def __init__(self, thresholds: np.ndarray):
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.num_samples = 0
+
+        self._last = None
+        self._rising = [[] for _ in self.thresholds]
+        self._falling = [[] for _ in self.thresholds]
+
+    def update(self, times: np.ndarray, values: np.ndarray):
+        """
+        Find the edges in the next block of samples.
+
+        Args:
+            times:
+                Time of each sample, shape (samples,).
+            values:
+                Voltages of every channel, shape (samples, channels).
+        """
+
+        if len(times) == 0:
+            return
+
+        # int8 keeps the differenced array an eighth of the size of the float64 samples
+        above = (values > self.thresholds).view(np.int8)
+
+        # The previous block's last sample goes in front of this block so edges between the
+        # blocks are found. The very first sample has nothing before it and can't be an edge.
+        if self._last is None:
+            changes = np.diff(above, axis=0)
+            offset = 1
+        else:
+            changes = np.diff(above, axis=0, prepend=self._last)
+            offset = 0
+
+        self._last = above[-1:].copy()
+        self.num_samples += len(times)
+
+        # Walking the transpose groups the changes by channel, with the samples of each
+        # channel still in time order.
+        channel_idx, sample_idx = np.nonzero(changes.T)
+        directions = changes[sample_idx, channel_idx]
+        edge_times = times[sample_idx + offset]
+
+        # Changes are sorted by channel, so each channel's edges are one contiguous slice
+        bounds = np.searchsorted(channel_idx, np.arange(len(self.thresholds) + 1))
+
+        for channel in range(len(self.thresholds)):
+            start, stop = bounds[channel], bounds[channel + 1]
+            if start == stop:
+                continue
+            channel_times = edge_times[start:stop]
+            channel_directions = directions[start:stop]
+            self._rising[channel].append(channel_times[channel_directions == 1])
+            self._falling[channel].append(channel_times[channel_directions == -1])
+
+    def edges(self) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+        """
+        Return the edges found so far.
+
+        Returns:
+            rising:
+                Per channel, times the channel turned on.
+            falling:
+                Per channel, times the channel turned off.
+        """
+
+        rising = [_concatenate(blocks) for blocks in self._rising]
+        falling = [_concatenate(blocks) for blocks in self._falling]
+
+        return rising, falling
+
+
+def _concatenate(blocks: List[np.ndarray]) -> np.ndarray:
+
+    if not blocks:
+        return np.array([], dtype=np.float64)
+
+    return np.concatenate(blocks)
+
+
+def detect_edges(times: np.ndarray, values: np.ndarray,
+                 thresholds: np.ndarray) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """
+    Find when every channel turns on and off in a single pass over the samples.
+
+    Args:
+        times:
+            Time of each sample, shape (samples,).
+        values:
+            Voltages of every channel, shape (samples, channels).
+        thresholds:
+            Threshold for each channel, shape (channels,).
+
+    Returns:
+        rising:
+            Per channel, times the channel turned on.
+        falling:
+            Per channel, times the channel turned off.
+    """
+
+    detector = EdgeDetector(thresholds)
+    detector.update(times, values)
+
+    return detector.edges()
+
+
+def edges_to_dataframe(channels: Sequence[str], rising: List[np.ndarray],
+                       falling: List[np.ndarray]) -> pd.DataFrame:
+    """
+    Arrange edge times into the wide `<channel>_on`/`<channel>_off` events table.
+
+    Columns have different lengths, so shorter ones are padded with NaN.
+    """
+
+    events = {}
+    for channel, on, off in zip(channels, rising, falling):
+        events["_".join([channel, "on"])] = on.tolist()
+        events["_".join([channel, "off"])] = off.tolist()
+
+    # Create new dataframe from the dictionary and transpose from rows to columns so .csv is written correctly
+    return pd.DataFrame.from_dict(events, orient="index").transpose()
+
+
+def read_events(events_csv: Path) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Read an events table written by get_behavior_timestamps back into edge arrays.
+
+    Returns:
+        For each channel, the times it turned on and the times it turned off, in ms.
+    """
+
+    events = pd.read_csv(events_csv, index_col=0)
+
+    edges = {}
+    for column in events.columns:
+        channel, _, edge = column.rpartition("_")
+        on, off = edges.get(channel, (None, None))
+
+        # Shorter columns are padded with NaN at the end
+        times = events[column].dropna().to_numpy(dtype=np.float64)
+        edges[channel] = (times, off) if edge == "on" else (on, times)
+
+    return {channel: (_or_empty(on), _or_empty(off)) for channel, (on, off) in edges.items()}
+
+
+def _or_empty(times: Optional[np.ndarray]) -> np.ndarray:
+
+    return times if times is not None else np.array([], dtype=np.float64)
+
+
+def edge_intervals(rising: np.ndarray, falling: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pair each time a channel turned on with the time it next turned off.
+
+    A channel's edges alternate, so once a channel that was already on when the recording
+    started has had its first falling edge dropped, the nth rising edge pairs with the
+    nth falling edge. A channel still on when the recording ended has no falling edge
+    for its last rising edge, which is dropped too.
+
+    Returns:
+        start:
+            Times each interval started.
+        stop:
+            Times each interval stopped.
+    """
+
+    if len(falling) and (not len(rising) or falling[0] < rising[0]):
+        falling = falling[1:]
+
+    num_intervals = min(len(rising), len(falling))
+
+    return rising[:num_intervals], falling[:num_intervals]
+
+
+def read_voltage_recording(behavior_csv: Path) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    Read a whole voltage recording csv into arrays.
+
+    Returns:
+        channels:
+            Channel names, stripped of the leading space Prairie View gives them.
+        times:
+            Time of each sample in ms.
+        values:
+            C-contiguous array of voltages, shape (samples, channels).
+    """
+
+    raw_behavior_df = pd.read_csv(behavior_csv, index_col=TIME_COLUMN).rename(columns=lambda col: col.strip())
+
+    return _block_arrays(raw_behavior_df)
+
+
+def _block_arrays(block: pd.DataFrame) -> Tuple[List[str], np.ndarray, np.ndarray]:
+
+    channels = list(block.columns)
+    times = block.index.to_numpy()
+    values = np.ascontiguousarray(block.to_numpy())
+
+    return channels, times, values
+
+
+def extract_events(behavior_csv: Path, thresholds: Optional[Dict[str, float]] = None,
+                   block_rows: int = BLOCK_ROWS) -> pd.DataFrame:
+    """
+    Read a voltage recording csv and return its events table.
+
+    The csv is read `block_rows` samples at a time and each block is passed through an
+    EdgeDetector, so memory use doesn't grow with the length of the recording. The edges
+    are identical to reading the whole file at once.
+
+    Args:
+        behavior_csv:
+            Path to the voltage recording csv written by the ripper.
+        thresholds:
+            Threshold in volts for any channel that shouldn't use DEFAULT_THRESHOLD_VOLTS.
+        block_rows:
+            Number of samples read from the csv at a time.
+    """
+
+    channels = None
+    detector = None
+
+    with pd.read_csv(behavior_csv, index_col=TIME_COLUMN, chunksize=block_rows) as reader:
+        for block in reader:
+            block_channels, times, values = _block_arrays(block.rename(columns=lambda col: col.strip()))
+
+            if detector is None:
+                channels = block_channels
+                detector = EdgeDetector(channel_thresholds(channels, thresholds))
+
+            detector.update(times, values)
+
+    # A recording without any samples still has its channels in the header
+    if detector is None:
+        channels, _, _ = read_voltage_recording(behavior_csv)
+        detector = EdgeDetector(channel_thresholds(channels, thresholds))
+
+    rising, falling = detector.edges()
+
+    return edges_to_dataframe(channels, rising, falling)
+
+
+class VoltageRecordingTail:
+    """
+    Parses a voltage recording csv while the ripper is still writing it.
+
+    Each call to read() picks up the complete rows appended since the last call and
+    passes them through an EdgeDetector, so by the time the ripper finishes the csv
+    only the last few rows are left to parse. Rows are parsed together with the csv's
+    header line, exactly as extract_events would parse them, so the events are the same.
+
+    Args:
+        behavior_csv:
+            Path to the voltage recording csv being written by the ripper.
+        thresholds:
+            Threshold in volts for any channel that shouldn't use DEFAULT_THRESHOLD_VOLTS.
+        block_bytes:
+            Most bytes of the csv parsed at once, bounding memory when catching up.
+    """
+
+    def __init__(self, behavior_csv: Path, thresholds: Optional[Dict[str, float]] = None,
+                 block_bytes: int = 64 * 1024 * 1024):
+        self.behavior_csv = Path(behavior_csv)
+        self.thresholds = thresholds
+        self.block_bytes = block_bytes
+
+        self.channels = None
+        self.detector = None
+
+        self._file = open(self.behavior_csv, "rb")
+        self._header = None
+        self._partial = b""
+
+    def read(self) -> int:
+        """
+        Parse the complete rows written since the last read.
+
+        Returns:
+            Number of samples parsed.
+        """
+
+        num_samples = 0
+
+        while True:
+            data = self._file.read(self.block_bytes)
+            if not data:
+                return num_samples
+
+            data = self._partial + data
+
+            # Only parse up to the last full line; the rest is kept for the next read
+            end = data.rfind(b"\n") + 1
+            self._partial = data[end:]
+            num_samples += self._parse(data[:end])
+
+    def finish(self) -> pd.DataFrame:
+        """
+        Parse everything left in the finished csv and return its events table.
+        """
+
+        self.read()
+
+        # The last row might not end with a newline
+        if self._partial:
+            self._parse(self._partial, final=True)
+            self._partial = b""
+
+        self._file.close()
+
+        # A recording without any samples still has its channels in the header
+        if self.detector is None:
+            return extract_events(self.behavior_csv, self.thresholds)
+
+        rising, falling = self.detector.edges()
+
+        return edges_to_dataframe(self.channels, rising, falling)
+
+    def _parse(self, rows: bytes, final: bool = False) -> int:
+
+        if self._header is None:
+            end = rows.find(b"\n") + 1
+            if end == 0:
+                # Only part of the header has been written so far
+                if not final:
+                    self._partial = rows + self._partial
+                    return 0
+                end = len(rows)
+            self._header, rows = rows[:end], rows[end:]
+
+        if not rows:
+            return 0
+
+        block = pd.read_csv(io.BytesIO(self._header + rows), index_col=TIME_COLUMN)
+        channels, times, values = _block_arrays(block.rename(columns=lambda col: col.strip()))
+
+        if self.detector is None:
+            self.channels = channels
+            self.detector = EdgeDetector(channel_thresholds(channels, self.thresholds))
+
+        self.detector.update(times, values)
+
+        return len(times)
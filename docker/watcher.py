@@ -0,0 +1,370 @@
+"""Filesystem watching for detecting when the Bruker ripper has finished writing files."""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Tuple
+
+from tiff_index import TiffIndex
+
+logger = logging.getLogger(__name__)
+
+# Event bits from <sys/inotify.h>. Only the events the ripper watcher cares about are
+# listed here.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+# Flags for inotify_init1()
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Each event read from the inotify file descriptor starts with this header and is
+# followed by a null padded name of `len` bytes.
+_EVENT_HEADER = struct.Struct("iIII")
+
+# How often the filesystem is scanned when inotify is not available, for example when
+# the scratch space is a network mount that doesn't deliver events.
+FALLBACK_POLL_SECS = 1
+
+# When scanning, the csv is considered done once its size hasn't changed for this long.
+CSV_STABLE_SECS = 10
+
+# Extensions of the files the ripper writes out that are watched for.
+TIFF_SUFFIX = ".ome.tif"
+CSV_SUFFIX = ".csv"
+
+
+class Inotify:
+    """
+    Minimal ctypes wrapper around the Linux inotify API.
+
+    The container only ships with pandas, so rather than adding a dependency for a
+    handful of system calls, libc is called directly.
+    """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._add_watch.restype = ctypes.c_int
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path: Path, mask: int) -> int:
+        """Watch `path` for the events in `mask`, returning the watch descriptor."""
+
+        wd = self._add_watch(self.fd, os.fsencode(str(path)), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+
+        return wd
+
+    def read_events(self, timeout: float) -> List[Tuple[int, int, str]]:
+        """
+        Read pending events, waiting up to `timeout` seconds for the first one.
+
+        Returns:
+            events:
+                List of (watch descriptor, mask, name) tuples.
+        """
+
+        readable, _, _ = select.select([self.fd], [], [], max(timeout, 0))
+        if not readable:
+            return []
+
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def inotify_available() -> bool:
+    """Return whether inotify can be used on this system."""
+
+    try:
+        Inotify().close()
+    except (OSError, AttributeError):
+        return False
+
+    return True
+
+
+class RipWatcher:
+    """
+    Watches the ripper's output directory for the voltage csv and the converted tiffs.
+
+    The ripper never exits cleanly, so completion has to be detected from the files it
+    writes. With inotify, the voltage recording is done as soon as its .csv is closed
+    after writing (or the first tiff shows up, since the csv is always converted first)
+    and the imaging data is done as soon as `num_images` tiffs have been closed. The
+    output directory doesn't exist before the ripper starts, so its parent is watched
+    until it gets created.
+
+    If inotify isn't available, the directory is scanned every FALLBACK_POLL_SECS
+    instead. In that mode the csv is done when its size stops changing and the tiffs
+    are done when `num_images` of them exist, although the last ones may still be open.
+
+    Args:
+        output_dir:
+            Directory the ripper writes the csv and tiffs into.
+        num_images:
+            Total number of tiffs expected from the ripper.
+        use_inotify:
+            Use inotify if available. Set False to force scanning.
+        on_tiff:
+            Optional function called with the name of each tiff as it is found to be
+            finished.
+    """
+
+    def __init__(self, output_dir: Path, num_images: int, use_inotify: bool = True,
+                 on_tiff: Optional[Callable[[str], None]] = None):
+        self.output_dir = Path(output_dir)
+        self.num_images = num_images
+        self.on_tiff = on_tiff
+
+        self.csv_path = None
+        self.csv_closed = False
+        self.tiffs = TiffIndex(self.output_dir)
+
+        self._inotify = None
+        self._parent_wd = None
+        self._dir_wd = None
+        self._last_scan = 0.0
+        self._csv_size = None
+        self._csv_size_changed = 0.0
+
+        if use_inotify:
+            try:
+                self._inotify = Inotify()
+            except (OSError, AttributeError) as err:
+                logger.warning("inotify unavailable, falling back to scanning: %s", err)
+
+    @property
+    def uses_inotify(self) -> bool:
+        return self._inotify is not None
+
+    @property
+    def num_tiffs(self) -> int:
+        return len(self.tiffs)
+
+    @property
+    def tiffs_done(self) -> bool:
+        return self.num_tiffs >= self.num_images
+
+    def start(self):
+        """
+        Begin watching. Call this before starting the ripper so no events are missed.
+        """
+
+        if self.uses_inotify:
+            self._parent_wd = self._inotify.add_watch(self.output_dir.parent, IN_CREATE | IN_MOVED_TO)
+            self._watch_output_dir()
+
+        logger.info("Watching %s (%s)", self.output_dir, "inotify" if self.uses_inotify else "scanning")
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def wait_for_csv(self, timeout: float) -> Optional[Path]:
+        """
+        Wait up to `timeout` seconds for the voltage recording csv to be finished.
+
+        Returns:
+            Path to the csv if it finished, otherwise None.
+        """
+
+        if self.wait_until(lambda: self.csv_closed, timeout):
+            return self.csv_path
+
+        return None
+
+    def wait_for_tiffs(self, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for all expected tiffs, returning if they're done."""
+
+        return self.wait_until(lambda: self.tiffs_done, timeout)
+
+    def wait_until(self, predicate: Callable[[], bool], timeout: float) -> bool:
+        """Process filesystem changes until `predicate` is true or `timeout` passes."""
+
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.pump(remaining)
+
+        return True
+
+    def pump(self, timeout: float):
+        """Process filesystem changes, blocking for up to `timeout` seconds."""
+
+        if self.uses_inotify:
+            for wd, mask, name in self._inotify.read_events(timeout):
+                self._handle_event(wd, mask, name)
+        else:
+            # Scanning a directory of tens of thousands of files isn't free, so only
+            # do it every FALLBACK_POLL_SECS.
+            wait = self._last_scan + FALLBACK_POLL_SECS - time.monotonic()
+            if wait > 0:
+                time.sleep(min(wait, timeout))
+                if wait > timeout:
+                    return
+            self._scan()
+
+    def _watch_output_dir(self):
+        """Add a watch on the output directory if it exists and pick up anything already in it."""
+
+        if self._dir_wd is not None:
+            return
+
+        try:
+            self._dir_wd = self._inotify.add_watch(self.output_dir, IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO)
+        except FileNotFoundError:
+            return
+
+        logger.info("Output directory created: %s", self.output_dir)
+
+        # Files may have been written between the directory being created and the watch
+        # being added. Those are picked up here. The ripper writes one tiff at a time, so
+        # anything already present is treated as closed.
+        for entry in os.scandir(self.output_dir):
+            if entry.name.endswith(CSV_SUFFIX):
+                self._found_csv(entry.name)
+            elif entry.name.endswith(TIFF_SUFFIX):
+                self._found_tiff(entry.name, closed=True)
+
+    def _handle_event(self, wd: int, mask: int, name: str):
+
+        if mask & IN_Q_OVERFLOW:
+            # The kernel dropped events; rebuild the state from the directory itself.
+            logger.warning("inotify queue overflowed, rescanning %s", self.output_dir)
+            self._scan()
+            return
+
+        if wd == self._parent_wd:
+            if name == self.output_dir.name and mask & IN_ISDIR:
+                self._watch_output_dir()
+            return
+
+        if wd != self._dir_wd or mask & IN_ISDIR:
+            return
+
+        closed = bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))
+
+        if name.endswith(CSV_SUFFIX):
+            self._found_csv(name)
+            if closed and not self.csv_closed:
+                self.csv_closed = True
+                logger.info("Voltage recording closed: %s", self.csv_path)
+
+        elif name.endswith(TIFF_SUFFIX):
+            self._found_tiff(name, closed)
+
+    def _found_csv(self, name: str):
+
+        if self.csv_path is None:
+            self.csv_path = self.output_dir / name
+            logger.info("Found .csv file for behavior: %s", self.csv_path)
+
+    def _found_tiff(self, name: str, closed: bool):
+
+        self._tiffs_started()
+
+        if closed and self.tiffs.add(name):
+            if self.on_tiff is not None:
+                self.on_tiff(name)
+            if self.tiffs_done:
+                logger.info("All %d tiffs closed", self.num_images)
+
+    def _tiffs_started(self):
+
+        # The csv is always converted before the imaging data, so once a tiff shows up
+        # the csv is complete.
+        if self.csv_path is not None and not self.csv_closed:
+            self.csv_closed = True
+            logger.info("Voltage recording complete, ripper moved on to tiffs")
+
+    def _scan(self):
+        """Update the watcher's state by scanning the output directory."""
+
+        self._last_scan = time.monotonic()
+
+        if self.csv_path is None or not self.csv_closed:
+            self._scan_csv()
+
+        # Without close events, existing tiffs are the best that can be done. The index
+        # only lists the directory when it has changed and only parses new names.
+        added = self.tiffs.scan()
+        if added:
+            self._tiffs_started()
+            if self.on_tiff is not None:
+                for name in sorted(added):
+                    self.on_tiff(name)
+            if self.tiffs_done:
+                logger.info("All %d tiffs found", self.num_images)
+
+    def _scan_csv(self):
+        """Find the voltage recording csv and check whether its size has settled."""
+
+        try:
+            entries = [entry for entry in os.scandir(self.output_dir) if entry.name.endswith(CSV_SUFFIX)]
+        except FileNotFoundError:
+            return
+
+        if not entries:
+            return
+
+        self._found_csv(entries[0].name)
+
+        try:
+            csv_size = entries[0].stat().st_size
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            return
+
+        # The csv is done when its size hasn't changed for CSV_STABLE_SECS
+        if csv_size != self._csv_size:
+            self._csv_size = csv_size
+            self._csv_size_changed = self._last_scan
+        elif self._last_scan - self._csv_size_changed >= CSV_STABLE_SECS:
+            self.csv_closed = True
+            logger.info("Voltage recording size stable at %s bytes", csv_size)
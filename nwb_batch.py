@@ -0,0 +1,341 @@
+# Bruker 2-Photon NWB Batch Builder
+# Builds NWB files for many sessions at once with nwb_utils.build_nwb_file(),
+# for backfilling a cohort's NWB files rather than building them one at a
+# time after each session.
+#
+# Sessions are listed in a YAML file, one entry per session:
+#
+# - experimenter: jdelahanty
+#   team: specialk_cs
+#   project: cs
+#   subject_id: CSE020
+#   imaging_plane: "-587.325"
+#   project_yml: /snlkt/data/_DATA/specialk_cs/cs.yml
+#   subject_yml: /snlkt/data/_DATA/specialk_cs/subjects/CSE020.yml
+#   surgery_yml: /snlkt/data/_DATA/specialk_cs/surgeries/CSE020.yml
+#   session_path: /snlkt/data/_DATA/specialk_cs/2p/nwb/CSE020
+#   session_id: BASELINE
+#   tiff_dir: /snlkt/data/_DATA/specialk_cs/2p/raw/CSE020/20211105/20211105_CSE020_plane1_-587.325_raw-013_tiffs
+#
+# env_path, session_id, tiff_dir and channel are optional. Without env_path,
+# the .env file is taken from the raw data directory next to tiff_dir.
+#
+# Usage:
+#     python nwb_batch.py sessions.yml --processes 8
+
+# Import argparse for the command line interface
+import argparse
+
+# Import logging for reporting progress of the batch
+import logging
+
+# Import multiprocessing for starting fresh worker processes
+import multiprocessing
+
+# Import traceback for recording why a session failed
+import traceback
+
+# Import ProcessPoolExecutor for building sessions' NWB files in parallel
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Import dataclasses for describing sessions and their results
+from dataclasses import dataclass
+
+# Import pathlib for path manipulation
+from pathlib import Path
+
+# Import perf_counter for timing each session
+from time import perf_counter
+
+# Import typing for typehints in documentation
+from typing import List, Optional
+
+# Import YAML for reading the session list and metadata files
+from ruamel.yaml import YAML
+
+logger = logging.getLogger(__name__)
+
+# Each worker streams a session's frames while decoding them with a few
+# threads, so a handful of sessions at once keeps the node busy.
+NWB_BATCH_PROCESSES = 4
+
+# Keys every session in the session list must have
+REQUIRED_KEYS = ["experimenter", "team", "project", "subject_id", "imaging_plane",
+                 "project_yml", "subject_yml", "surgery_yml", "session_path"]
+
+
+@dataclass
+class NWBSession:
+    """One session to build an NWB file for, as listed in the session list."""
+
+    experimenter: str
+    team: str
+    project: str
+    subject_id: str
+    imaging_plane: str
+    project_yml: Path
+    subject_yml: Path
+    surgery_yml: Path
+    session_path: Path
+    session_id: Optional[str] = None
+    tiff_dir: Optional[Path] = None
+    env_path: Optional[Path] = None
+    channel: int = 2
+
+    @property
+    def name(self) -> str:
+        if self.tiff_dir is not None:
+            return Path(self.tiff_dir).name
+
+        return "_".join([self.subject_id, self.imaging_plane, self.session_id or ""])
+
+
+@dataclass
+class SessionResult:
+    """Outcome of building one session's NWB file."""
+
+    name: str
+    seconds: float
+    nwb_path: Optional[Path] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class YamlCache:
+    """
+    Loads each YAML file once, however many sessions use it.
+
+    A cohort's sessions share one project file and each subject's sessions
+    share their subject and surgery files, so a batch only reads a few files
+    for many sessions. The files are loaded in the main process and the
+    loaded metadata is handed to the workers.
+    """
+
+    def __init__(self):
+        self._yaml = YAML(typ="safe")
+        self._loaded = {}
+
+    def get(self, path: Path) -> dict:
+
+        key = Path(path).resolve()
+        if key not in self._loaded:
+            with open(key) as f:
+                self._loaded[key] = self._yaml.load(f)
+
+        return self._loaded[key]
+
+    def __len__(self) -> int:
+        return len(self._loaded)
+
+
+def load_sessions(sessions_file: Path) -> List[NWBSession]:
+    """
+    Read the list of sessions to build NWB files for.
+
+    Args:
+        sessions_file:
+            YAML file listing one mapping per session
+
+    Returns:
+        Sessions in the order listed
+
+    Raises:
+        ValueError: if a session is missing required keys
+    """
+
+    with open(sessions_file) as f:
+        entries = YAML(typ="safe").load(f) or []
+
+    sessions = []
+    for number, entry in enumerate(entries, start=1):
+        missing = [key for key in REQUIRED_KEYS if key not in entry]
+        if missing:
+            raise ValueError("Session %d in %s is missing %s" % (number, sessions_file, ", ".join(missing)))
+
+        values = dict(entry)
+        for key in ("project_yml", "subject_yml", "surgery_yml", "session_path", "tiff_dir", "env_path"):
+            if values.get(key) is not None:
+                values[key] = Path(values[key])
+        for key in ("imaging_plane", "subject_id", "session_id"):
+            if values.get(key) is not None:
+                values[key] = str(values[key])
+
+        sessions.append(NWBSession(**values))
+
+    return sessions
+
+
+def check_session_ids(sessions: List[NWBSession]):
+    """
+    Make sure sessions written to the same place don't need their IDs worked out.
+
+    nwb_utils.gen_session_id() names a session by counting the files already
+    in its session path, which gives the wrong answer when several of that
+    subject's sessions are being written at the same time.
+
+    Raises:
+        ValueError: if sessions sharing a session path don't all have a session_id
+    """
+
+    by_path = {}
+    for session in sessions:
+        by_path.setdefault(Path(session.session_path).resolve(), []).append(session)
+
+    for session_path, shared in by_path.items():
+        if len(shared) > 1 and any(session.session_id is None for session in shared):
+            raise ValueError("%d sessions are written to %s, give each of them a session_id"
+                             % (len(shared), session_path))
+
+
+def find_session_env(session: NWBSession) -> Optional[Path]:
+    """
+    Find a session's .env file in the raw data directory next to its tiffs.
+
+    Looking in the one directory avoids searching the team's whole microscopy
+    tree for each session.
+    """
+
+    if session.env_path is not None:
+        return session.env_path
+
+    if session.tiff_dir is None:
+        return None
+
+    # Imported here so the main process doesn't need to import pyNWB
+    from nwb_utils import find_raw_dir
+
+    env_files = sorted(find_raw_dir(session.tiff_dir).glob("*.env"))
+    if len(env_files) != 1:
+        raise FileNotFoundError("Expected 1 .env file next to %s, found %d" % (session.tiff_dir, len(env_files)))
+
+    return env_files[0]
+
+
+def build_session(session: NWBSession, project_metadata: dict, subject_metadata: dict,
+                  surgery_metadata: dict) -> SessionResult:
+    """
+    Build one session's NWB file, recording how long it took or why it failed.
+
+    Run in a worker process. Exceptions are caught so that one bad session
+    doesn't stop the rest of the batch.
+    """
+
+    start = perf_counter()
+
+    try:
+        from nwb_utils import build_nwb_file
+
+        nwb_path = build_nwb_file(
+            session.experimenter,
+            session.team,
+            session.project,
+            session.subject_id,
+            session.imaging_plane,
+            subject_metadata,
+            project_metadata,
+            surgery_metadata,
+            session.session_path,
+            tiff_dir=session.tiff_dir,
+            channel=session.channel,
+            env_path=find_session_env(session),
+            session_id=session.session_id
+        )
+
+        return SessionResult(session.name, perf_counter() - start, nwb_path=nwb_path)
+
+    except Exception:
+        return SessionResult(session.name, perf_counter() - start, error=traceback.format_exc())
+
+
+def build_nwb_files(sessions: List[NWBSession], processes: int = NWB_BATCH_PROCESSES,
+                    cache: Optional[YamlCache] = None) -> List[SessionResult]:
+    """
+    Build NWB files for many sessions in a pool of worker processes.
+
+    Each project, subject and surgery file is loaded once through the cache
+    and each session's metadata is sent to a worker with it. Workers are
+    started with the spawn method so each gets a fresh interpreter and HDF5
+    library.
+
+    Args:
+        sessions:
+            Sessions to build NWB files for
+        processes:
+            Number of sessions built at once
+        cache:
+            Cache of loaded YAML files, shared with earlier batches if given
+
+    Returns:
+        Result of each session, in the order they finished
+    """
+
+    check_session_ids(sessions)
+
+    cache = cache or YamlCache()
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(processes, mp_context=context) as pool:
+        futures = {}
+        for session in sessions:
+            future = pool.submit(
+                build_session,
+                session,
+                cache.get(session.project_yml),
+                cache.get(session.subject_yml),
+                cache.get(session.surgery_yml)
+            )
+            futures[future] = session
+
+        logger.info("Building %d NWB files with %d processes, %d metadata files loaded",
+                    len(sessions), processes, len(cache))
+
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+
+            if result.ok:
+                logger.info("Wrote %s in %.1f s: %s", result.name, result.seconds, result.nwb_path)
+            else:
+                logger.error("%s FAILED after %.1f s:\n%s", result.name, result.seconds, result.error)
+
+    return results
+
+
+def report(results: List[SessionResult], seconds: float):
+    """Log the time each session took and which ones failed."""
+
+    failed = [result for result in results if not result.ok]
+
+    logger.info("%d NWB files built, %d failed, in %.1f s", len(results) - len(failed), len(failed), seconds)
+    for result in sorted(results, key=lambda result: result.name):
+        status = "ok" if result.ok else "FAILED: " + result.error.strip().splitlines()[-1]
+        logger.info("  %-60s %7.1f s  %s", result.name, result.seconds, status)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Build NWB files for a list of sessions in parallel.")
+    parser.add_argument("sessions",
+                        type=Path,
+                        help="YAML file listing the sessions to build NWB files for.")
+    parser.add_argument("--processes",
+                        type=int,
+                        default=NWB_BATCH_PROCESSES,
+                        help="Number of sessions built at once.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+
+    start = perf_counter()
+    results = build_nwb_files(load_sessions(args.sessions), args.processes)
+    report(results, perf_counter() - start)
+
+    if any(not result.ok for result in results):
+        raise SystemExit(1)
@@ -24,22 +24,45 @@ import uuid
 # Import pathlib for path manipulation and creation
 from pathlib import Path
 
-# Import xml.etree for parsing data from Bruker .env files
-import xml.etree.ElementTree as ET
+# Import sys for finding the pipeline's modules in docker/
+import sys
 
-# Import lxml.etree to parse badly formed Bruker .env files
-import lxml.etree
+# Import ThreadPoolExecutor for decoding tiffs in parallel while streaming them
+from concurrent.futures import ThreadPoolExecutor
+
+# Import numpy for the arrays of frames streamed into the NWB file
+import numpy as np
+
+# Import tiff_decode to decode tiffs with libtiff, which releases Python's GIL
+from imagecodecs import tiff_decode
 
 # Import YAML for gathering metadata about project
 from ruamel.yaml import YAML
 
 # Import Tuple typing for typehints in documentation
-from typing import Tuple, Union
+from typing import Optional, Tuple
 
 # Import necessary pyNWB modules for writing out base NWB file to disk
 from pynwb import NWBFile, TimeSeries, NWBHDF5IO
 from pynwb.file import Subject
 from pynwb.ophys import OpticalChannel, ImagingPlane, TwoPhotonSeries
+from pynwb.epoch import TimeIntervals
+
+# Import hdmf's chunk iterator and HDF5 dataset options for streaming imaging
+# data into the NWB file as it's written
+from hdmf.data_utils import GenericDataChunkIterator
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+
+# Import hdmf's table columns for building interval tables a column at a time
+from hdmf.common import ElementIdentifiers, VectorData
+
+# Metadata parsing is shared with the ripping pipeline, whose modules are in docker/
+sys.path.insert(0, str(Path(__file__).resolve().parent / "docker"))
+
+from frame_manifest import FrameManifest
+from pv_state import PVStateIndex, cached_pv_state
+from recording_xml import frame_times
+from voltage_events import edge_intervals, read_events
 
 # NWB Metadata Requirements: Prairie View Keys
 # Environment keys at Root node of .env file
@@ -62,7 +85,9 @@ env_basepath = "E:/teams/"
 
 def build_nwb_file(experimenter: str, team: str, project: str, 
                    subject_id: str, imaging_plane: str, subject_metadata: dict,
-                   project_metadata: dict, surgery_metadata: dict, session_path: Path):
+                   project_metadata: dict, surgery_metadata: dict, session_path: Path,
+                   tiff_dir: Path = None, channel: int = 2, env_path: Path = None,
+                   session_id: str = None) -> Path:
     """
     Builds base NWB file with relevant metadata for session.
 
@@ -90,13 +115,28 @@ def build_nwb_file(experimenter: str, team: str, project: str,
             types of indicators used and positions of those injections/implants.
         session_path:
             Path to write NWB file to and use to determine which session was run
+        tiff_dir:
+            Directory of the session's ripped tiffs. If given, the frames are
+            streamed into a TwoPhotonSeries as the NWB file is written.
+        channel:
+            Channel whose frames are written to the TwoPhotonSeries
+        env_path:
+            Path to the session's Prairie View .env file. If not given, it's
+            found in today's microscopy directory for the team on BRUKER.
+        session_id:
+            Session ID for the NWB file. If not given, it's determined from the
+            sessions already in session_path.
+
+    Returns:
+        Path to the NWB file written
     """
 
     # Get the formatted session_id and newly created session path
-    session_id = gen_session_id(session_path, project)
+    if session_id is None:
+        session_id = gen_session_id(session_path, project)
 
     # Parse Bruker's metadata for NWB file
-    bruker_metadata = get_bruker_metadata(team, imaging_plane)
+    bruker_metadata = get_bruker_metadata(team, imaging_plane, env_path)
 
     # Build the base NWB file
     nwbfile = gen_base_nwbfile(
@@ -115,19 +155,28 @@ def build_nwb_file(experimenter: str, team: str, project: str,
         surgery_metadata
         )
 
+    # Add the imaging data itself. Frames are only read from the tiffs once
+    # the file is written, a few chunks at a time.
+    if tiff_dir is not None:
+        nwbfile = append_imaging_data(nwbfile, bruker_metadata, tiff_dir, channel,
+                                      recording_xml=find_recording_xml(tiff_dir))
+
     nwbfile = append_subject_info(nwbfile, subject_metadata)
 
-    # TODO: Implement append_behavior_info
-    # nwbfile = append_behavior_info(nwbfile)
+    # Add the behavior events that were extracted from the voltage recording
+    # while ripping, if they can be found
+    events_csv = find_events_csv(tiff_dir) if tiff_dir is not None else None
+    if events_csv is not None:
+        nwbfile = append_behavior_info(nwbfile, read_events(events_csv))
 
     print(nwbfile)
 
     # Write the NWB files to disk
-    write_nwb_file(nwbfile, session_path, subject_id, session_id)
+    return write_nwb_file(nwbfile, session_path, subject_id, session_id)
 
 
 def write_nwb_file(nwbfile: NWBFile, session_path: Path, subject_id: str,
-                   session_id: str):
+                   session_id: str) -> Path:
     """
     Writes base NWB file to disk
 
@@ -159,8 +208,10 @@ def write_nwb_file(nwbfile: NWBFile, session_path: Path, subject_id: str,
     io.write(nwbfile)
     io.close()
 
+    return nwb_path
 
-def get_bruker_metadata(team: str, imaging_plane: str) -> dict:
+
+def get_bruker_metadata(team: str, imaging_plane: str, env_path: Path = None) -> dict:
     """
     Parses Prairie View .env file for NWB metadata.
 
@@ -172,11 +223,48 @@ def get_bruker_metadata(team: str, imaging_plane: str) -> dict:
             Team value from metadata_args["team"]
         imaging_plane:
             Plane 2P images were acquired at, the Z-axis value
+        env_path:
+            Path to the .env file, when it's already known. Skips searching
+            today's microscopy directory for it.
 
     Returns:
         bruker_metadata
     """
 
+    if env_path is None:
+        env_path = find_bruker_env(team, imaging_plane)
+
+    # Every state value in the .env file is indexed in a single pass and kept in the
+    # metadata cache, shared with beyblade, so the file is only parsed again once it
+    # changes. Values are the strings found in the file.
+    bruker_metadata = get_pv_states(
+        pv_state_idx_keys,
+        pv_state_noidx_keys,
+        cached_pv_state(env_path)
+    )
+
+    # Get start time from .env file and convert to datetime object.  Then add
+    # the local timezone information for NWB standard.
+    bruker_metadata["date"] = dt_parser.parse(bruker_metadata["date"])
+    bruker_metadata["date"] = bruker_metadata["date"].replace(tzinfo=tzlocal())
+
+    return bruker_metadata
+
+
+def find_bruker_env(team: str, imaging_plane: str) -> Path:
+    """
+    Finds the .env file of today's recording of an imaging plane on BRUKER.
+
+    Args:
+        team:
+            Team value from metadata_args["team"]
+        imaging_plane:
+            Plane 2P images were acquired at, the Z-axis value
+
+    Returns:
+        Path to the .env file
+    """
+
     # Build base path for microscopy session
     base_env_path = env_basepath + team + "/microscopy/"
 
@@ -197,56 +285,27 @@ def get_bruker_metadata(team: str, imaging_plane: str) -> dict:
     # There will only be one .env file for the globbed files, so grab it's path
     bruker_env_path = bruker_env_glob[0]
 
-    # Parse the Bruker metadata .env, which is formatted as XML, and get the
-    # "root" of the XML tree
-    try:
-
-        metadata_root = ET.parse(bruker_env_path).getroot()
-        
-        # Get Prairie View states out of the XML with get_pv_states
-        bruker_metadata = get_pv_states(
-            pv_state_idx_keys,
-            pv_state_noidx_keys,
-            metadata_root
-            )
-
-    # Due to some idiosyncracies in Prairie View's output of the .env file as
-    # version 1.0 but the Microsoft .NET implementation which builds the file
-    # includes characters that aren't supported until 1.1, the standard XML
-    # library fails to interpret some of the characters. Software like MATLAB
-    # is still reliant upon v1.1 and I'm guessing that Python's native parser
-    # is also. If there's a ParseError, raised when there's invalid characters
-    # in XML, use the lxml Parser which can escape badly formed text with the
-    # recover=True option.
-    except ET.ParseError:
-        
-        metadata_parser = lxml.etree.XMLParser(recover=True)
-        metadata_root = lxml.etree.parse(str(bruker_env_path), metadata_parser).getroot()
-        bruker_metadata = get_pv_states(
-            pv_state_idx_keys,
-            pv_state_noidx_keys,
-            metadata_root
-        )
+    return bruker_env_path
 
-    return bruker_metadata
 
 def get_pv_states(pv_idx_keys: dict, pv_noidx_keys: list,
-                  metadata_root: Union[ET.ElementTree, lxml.etree._ElementTree]) -> dict:
+                  pv_state: PVStateIndex) -> dict:
     """
     Parse Bruker .env file for NWB standard metadata.
 
     Gets values from Bruker .env file based on selected keys relevant for NWB
-    standard.  Parses file for both indexed and non-indexed values using relevant
-    parser in the case of bad XML from Prairie View.  
+    standard.  Looks up both indexed and non-indexed values in the index of the
+    file's state values, which was built with lxml in case of bad XML from
+    Prairie View.  Values, including the date, are returned as the strings
+    found in the file.
 
     Args:
         pv_idx_keys:
             Indexed keys in the .env file
         pv_noidx_keys:
             Keys that are directly accessible in PVStateValues
-        metadata_root:
-            Parsed XML root from .env tree with xml.etree.ElementTree or via lxml
-            in the case of badly formed XML from Prairie View
+        pv_state:
+            Index of every state value in the .env file from read_pv_state()
 
     Returns:
         bruker_metadata
@@ -254,22 +313,17 @@ def get_pv_states(pv_idx_keys: dict, pv_noidx_keys: list,
 
     # Use dictionary comprehension for environment values in Root of .env to
     # start the bruker_metadata dictionary
-    bruker_metadata = {key: value for key, value in metadata_root.items()}
-
-    # Get start time from .env file and convert to datetime object.  Then add
-    # the local timezone information for NWB standard.
-    bruker_metadata["date"] = dt_parser.parse(bruker_metadata["date"])
-    bruker_metadata["date"] = bruker_metadata["date"].replace(tzinfo=tzlocal())
+    bruker_metadata = {key: value for key, value in pv_state.attributes.items()}
 
     # Get metadata that requires indexed values
-    pv_idx_metadata = get_idx_states(pv_idx_keys, metadata_root)
+    pv_idx_metadata = get_idx_states(pv_idx_keys, pv_state)
 
     # Append the indexed metadata to bruker_metadata
     for key, value in pv_idx_metadata.items():
         bruker_metadata[key] = value
 
     # Get metadata that does NOT require indexed values
-    pv_noidx_metadata = get_noidx_states(pv_noidx_keys, metadata_root)
+    pv_noidx_metadata = get_noidx_states(pv_noidx_keys, pv_state)
 
     # Append non-indexed metadata to bruker_metadata
     for key, value in pv_noidx_metadata.items():
@@ -278,57 +332,44 @@ def get_pv_states(pv_idx_keys: dict, pv_noidx_keys: list,
     return bruker_metadata
 
 
-def get_idx_states(pv_idx_keys: dict, metadata_root: ET) -> dict:
+def get_idx_states(pv_idx_keys: dict, pv_state: PVStateIndex) -> dict:
     """
     Gets indexed values from Prairie View .env file.
 
     Args:
         pv_idx_keys:
             Indexed keys in the .env file
-        metadata_root:
-            Parsed XML root from .env tree
+        pv_state:
+            Index of every state value in the .env file
 
     Returns:
         pv_idx_metadata
     """
 
-    # Build empty metadata dictionary to append metadata to
-    pv_idx_metadata = {}
-
-    # For each key and index requested in the pv_idx_keys, build an xpath for
-    # the values and search the metadata root for it.  Finally, append those
-    # values to the dictionary.
-    for key, idx in pv_idx_keys.items():
-        xpath = f".//PVStateValue[@key='{key}']/IndexedValue[@index='{idx}']"
-        element = metadata_root.find(xpath)
-        pv_idx_metadata[key] = element.attrib["value"]
+    # Look up each key and index requested in the pv_idx_keys and append
+    # those values to the dictionary.
+    pv_idx_metadata = {key: pv_state.value(key, idx) for key, idx in pv_idx_keys.items()}
 
     return pv_idx_metadata
 
 
-def get_noidx_states(pv_noidx_keys, metadata_root) -> dict:
+def get_noidx_states(pv_noidx_keys: list, pv_state: PVStateIndex) -> dict:
     """
     Gets non-indexed values from Prairie View .env file.
 
     Args:
         pv_noidx_keys:
             Keys that are directly accessible in PVStateValues
-        metadata_root:
-            Parsed XML root from .env tree
+        pv_state:
+            Index of every state value in the .env file
 
     Returns:
         pv_noidx_metadata
     """
 
-    # Build empty metadata dictionary to append metadata to
-    pv_noidx_metadata = {}
-
-    # For the keys in pv_noidx_keys, build an xpath for each one and search the
-    # metadata root for it.  Finally, append those values to the dictionary.
-    for key in pv_noidx_keys:
-        xpath = f".//PVStateValue[@key='{key}']"
-        element = metadata_root.find(xpath)
-        pv_noidx_metadata[key] = element.attrib["value"]
+    # Look up each key in pv_noidx_keys and append those values to the
+    # dictionary.
+    pv_noidx_metadata = {key: pv_state.value(key) for key in pv_noidx_keys}
 
     return pv_noidx_metadata
 
@@ -459,6 +500,300 @@ def append_imaging_info(nwbfile: NWBFile, project_metadata: dict,
     return nwbfile
 
 
+class TiffFrameIterator(GenericDataChunkIterator):
+    """
+    Iterates over a channel's ripped tiffs as chunks of frames for NWB.
+
+    hdmf asks for one buffer of frames at a time while the NWB file is being
+    written, so only a buffer's worth of frames is ever held in memory no
+    matter how long the recording is. Each buffer's tiffs are decoded in
+    parallel. Frames are transposed from the tiffs' (y, x) to the (x, y)
+    order NWB expects. The decoding threads are shut down once every frame
+    has been read, or by calling close() if the write stops early.
+
+    Args:
+        tiff_paths:
+            Paths of the tiffs in frame order
+        chunk_frames:
+            Number of frames in each chunk of the NWB dataset
+        buffer_frames:
+            Number of frames read at once, a multiple of chunk_frames
+        threads:
+            Number of tiffs decoded at once
+    """
+
+    def __init__(self, tiff_paths: list, chunk_frames: int = 128,
+                 buffer_frames: int = 256, threads: int = 4):
+
+        self.tiff_paths = list(tiff_paths)
+        if not self.tiff_paths:
+            raise ValueError("No tiffs to write, the recording has no frames")
+
+        # Every frame is the same shape and type as the first one
+        first_frame = self._read_frame(self.tiff_paths[0])
+        self._frame_shape = first_frame.shape
+        self._dtype = first_frame.dtype
+
+        self._pool = ThreadPoolExecutor(threads)
+
+        # Short recordings are a single chunk and buffer
+        num_frames = len(self.tiff_paths)
+        super().__init__(
+            chunk_shape=(min(chunk_frames, num_frames), *self._frame_shape),
+            buffer_shape=(min(buffer_frames, num_frames), *self._frame_shape)
+        )
+
+    @staticmethod
+    def _read_frame(tiff_path: Path) -> np.ndarray:
+        with open(tiff_path, "rb") as tiff:
+            return tiff_decode(tiff.read()).T
+
+    def _get_data(self, selection: tuple) -> np.ndarray:
+        tiff_paths = self.tiff_paths[selection[0]]
+
+        # Frames are decoded straight into the buffer so it's the only copy
+        frames = np.empty((len(tiff_paths), *self._frame_shape), dtype=self._dtype)
+
+        def read_into(index: int):
+            frames[index] = self._read_frame(tiff_paths[index])
+
+        list(self._pool.map(read_into, range(len(tiff_paths))))
+
+        return frames[(slice(None), *selection[1:])]
+
+    def __next__(self):
+        try:
+            return super().__next__()
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        """Shut down the threads decoding the tiffs."""
+        self._pool.shutdown()
+
+    def _get_maxshape(self) -> tuple:
+        return (len(self.tiff_paths), *self._frame_shape)
+
+    def _get_dtype(self) -> np.dtype:
+        return self._dtype
+
+
+def find_recording_xml(tiff_dir: Path) -> Optional[Path]:
+    """
+    Finds the recording's .xml file for a directory of ripped tiffs.
+
+    Once ripping is finished, the metadata files are moved back to the raw
+    data directory, which sits next to the tiff directory and has the same
+    name without "_tiffs". Prairie View names the .xml after the recording.
+
+    Args:
+        tiff_dir:
+            Directory of the session's ripped tiffs
+
+    Returns:
+        Path to the recording's .xml file, or None if it can't be found
+    """
+
+    raw_dir = find_raw_dir(tiff_dir)
+
+    recording_xml = raw_dir / (raw_dir.name + ".xml")
+
+    return recording_xml if recording_xml.exists() else None
+
+
+def find_events_csv(tiff_dir: Path) -> Optional[Path]:
+    """
+    Finds the behavior events file for a directory of ripped tiffs.
+
+    rip.py writes the events extracted from the voltage recording to its
+    data root, the directory holding the raw data directory, named after the
+    voltage recording with "_events" appended. The voltage recording itself is
+    moved back into the raw data directory once ripping is finished, so its
+    name picks out this recording's events from every other recording's
+    events in the same directory.
+
+    Args:
+        tiff_dir:
+            Directory of the session's ripped tiffs
+
+    Returns:
+        Path to the events .csv file, or None if it can't be found
+    """
+
+    raw_dir = find_raw_dir(tiff_dir)
+
+    for voltage_csv in sorted(raw_dir.glob("*.csv")):
+        if voltage_csv.name.endswith("_events.csv"):
+            continue
+
+        events_name = voltage_csv.stem + "_events.csv"
+        for directory in (raw_dir.parent, raw_dir):
+            if (directory / events_name).exists():
+                return directory / events_name
+
+    return None
+
+
+def find_raw_dir(tiff_dir: Path) -> Path:
+    """
+    Finds the raw data directory a directory of ripped tiffs came from.
+
+    Ripped tiffs are put in a directory with the raw data directory's name and
+    "_tiffs" appended, next to the raw data directory.
+
+    Args:
+        tiff_dir:
+            Directory of the session's ripped tiffs
+
+    Returns:
+        Path to the raw data directory
+    """
+
+    tiff_dir = Path(tiff_dir)
+
+    if tiff_dir.name.endswith("_tiffs"):
+        return tiff_dir.with_name(tiff_dir.name[:-len("_tiffs")])
+
+    return tiff_dir
+
+
+def append_imaging_data(nwbfile: NWBFile, bruker_metadata: dict, tiff_dir: Path,
+                        channel: int = 2, chunk_frames: int = 128,
+                        buffer_frames: int = 256, compression: str = "gzip",
+                        compression_opts: int = 4, recording_xml: Path = None) -> NWBFile:
+    """
+    Appends a channel's ripped frames to the NWB file as a TwoPhotonSeries.
+
+    The frames aren't read here. The series is given a TiffFrameIterator
+    wrapped in H5DataIO, so they're decoded and compressed into the file a
+    buffer at a time when the NWB file is written, without building the whole
+    recording in memory or an intermediate HDF5 file first.
+
+    Args:
+        nwbfile:
+            NWB File with imaging information from append_imaging_info
+        bruker_metadata:
+            Metadata for microscopy session from Prairie View .env file
+        tiff_dir:
+            Directory of the session's ripped tiffs
+        channel:
+            Channel whose frames are written to the series
+        chunk_frames:
+            Number of frames in each chunk of the dataset in the NWB file
+        buffer_frames:
+            Number of frames read from the tiffs at a time
+        compression:
+            HDF5 compression filter for the dataset, such as "gzip" or "lzf"
+        compression_opts:
+            Compression level for gzip, ignored by other filters
+        recording_xml:
+            Recording's .xml file. If given, each frame's time in it is used as
+            the series' timestamps. Otherwise the frames are assumed to be evenly
+            spaced at the .env file's frame rate.
+
+    Returns:
+        NWBFile:
+            NWB File with the imaging data appended.
+    """
+
+    # The frame manifest lists the channel's tiffs in frame order without
+    # listing the directory
+    manifest = FrameManifest.open(tiff_dir)
+    tiff_paths = manifest.paths(channel=channel)
+
+    # The tiffs are gone once they've been packed into HDF5 with --delete_packed
+    if not tiff_paths or manifest.is_packed(channel):
+        raise FileNotFoundError(
+            "No tiffs for channel " + str(channel) + " in " + str(tiff_dir)
+            + ", they may have been deleted after being packed into HDF5"
+        )
+
+    frames = TiffFrameIterator(tiff_paths, chunk_frames=chunk_frames,
+                               buffer_frames=buffer_frames)
+
+    data = H5DataIO(
+        data=frames,
+        compression=compression,
+        compression_opts=compression_opts if compression == "gzip" else None
+    )
+
+    # Each frame's time since the recording started is read from the recording's
+    # .xml file, so dropped or irregular frames are timestamped exactly. If the
+    # times don't line up with the tiffs, fall back to the nominal frame rate.
+    timing = {"rate": float(bruker_metadata["framerate"]), "starting_time": 0.0}
+
+    if recording_xml is not None:
+        timestamps = frame_times(recording_xml)
+
+        if len(timestamps) == len(tiff_paths) and not np.isnan(timestamps).any():
+            timing = {"timestamps": timestamps}
+        else:
+            print("Recording XML has " + str(len(timestamps)) + " frame times for "
+                  + str(len(tiff_paths)) + " frames, using the nominal frame rate")
+
+    two_photon_series = TwoPhotonSeries(
+        name="TwoPhotonSeries",
+        description="Channel " + str(channel) + " frames ripped from " + Path(tiff_dir).name,
+        data=data,
+        imaging_plane=nwbfile.get_imaging_plane(),
+        unit="normalized amplitude",
+        **timing
+    )
+
+    nwbfile.add_acquisition(two_photon_series)
+
+    return nwbfile
+
+
+def append_behavior_info(nwbfile: NWBFile, events: dict) -> NWBFile:
+    """
+    Appends behavior events to the NWB file as interval tables.
+
+    Each channel of the voltage recording, like the licks or the speaker,
+    becomes a TimeIntervals table with one row for each time the channel was
+    on. Tables are built from whole columns of start and stop times rather
+    than adding intervals one row at a time, so sessions with hundreds of
+    thousands of events are added in one step per channel.
+
+    Args:
+        nwbfile:
+            NWB File to add the behavior events to
+        events:
+            For each channel, the times in ms it turned on and off, as given by
+            voltage_events.read_events() or the edge detector directly
+
+    Returns:
+        NWBFile:
+            NWB File with behavior events appended.
+    """
+
+    for channel, (rising, falling) in events.items():
+
+        start, stop = edge_intervals(rising, falling)
+
+        # Channels that were never on, like a speaker that wasn't used, are left out
+        if len(start) == 0:
+            continue
+
+        # The voltage recording is timed in ms, NWB is timed in seconds
+        intervals = TimeIntervals(
+            name=channel,
+            description="Times the " + channel + " channel of the voltage recording was on",
+            id=ElementIdentifiers(name="id", data=np.arange(len(start))),
+            columns=[
+                VectorData(name="start_time", description="Start time of the event in seconds",
+                           data=start / 1000),
+                VectorData(name="stop_time", description="Stop time of the event in seconds",
+                           data=stop / 1000),
+            ]
+        )
+
+        nwbfile.add_time_intervals(intervals)
+
+    return nwbfile
+
+
 def gen_session_id(session_path: Path, project: str) -> Tuple[str, Path]:
     """
     Generates session ID for NWB files.
@@ -570,8 +905,9 @@ def append_subject_info(nwbfile: NWBFile, subject_metadata: dict) -> NWBFile:
         NWB file with subject information added
     """
 
-    today = datetime.today()
-    today = today.strftime("%Y%m%d")
+    # The weight is looked up for the day of the session, which is today
+    # unless NWB files are being built for earlier sessions
+    session_date = nwbfile.session_start_time.strftime("%Y%m%d")
 
     date_of_birth = dt_parser.parse(subject_metadata["dob"])
     date_of_birth = date_of_birth.replace(tzinfo=tzlocal())
@@ -584,7 +920,7 @@ def append_subject_info(nwbfile: NWBFile, subject_metadata: dict) -> NWBFile:
         sex=subject_metadata["sex"],
         species=subject_metadata["species"],
         strain=subject_metadata["strain"],
-        weight=subject_metadata["weights"][today]
+        weight=subject_metadata["weights"][session_date]
     )
 
     return nwbfile
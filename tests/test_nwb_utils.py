@@ -0,0 +1,183 @@
+"""
+Tests building an NWB file from a recording laid out the way rip.py leaves it.
+
+Run from the repository root with:
+    python -m pytest tests
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+pynwb = pytest.importorskip("pynwb")
+tifffile = pytest.importorskip("tifffile")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "docker"))
+
+import metadata_cache
+import nwb_utils
+from frame_manifest import write_manifest
+from rip import get_behavior_timestamps
+
+RECORDING = "20211105_CSE020_plane1_-587.325_raw-013"
+NUM_FRAMES = 40
+FRAME_PERIOD_SECS = 0.033
+
+ENV = """<?xml version="1.0" encoding="utf-8"?>
+<Environment version="5.6.64.200" date="11/5/2021 10:21:36 AM" notes="">
+  <PVStateShard>
+    <PVStateValue key="activeMode" value="ResonantGalvo" />
+    <PVStateValue key="framerate" value="30.3" />
+    <PVStateValue key="laserPower"><IndexedValue index="0" value="40" /></PVStateValue>
+    <PVStateValue key="laserWavelength"><IndexedValue index="0" value="920" /></PVStateValue>
+    <PVStateValue key="pmtGain"><IndexedValue index="0" value="600" /></PVStateValue>
+  </PVStateShard>
+</Environment>
+"""
+
+PROJECT = {
+    "session_description": "test session",
+    "lab": "Tye Lab",
+    "institution": "Salk Institute",
+    "experiment_description": "test experiment",
+    "microscope_name": "Bruker Ultima",
+    "microscope_description": "2P microscope",
+    "microscope_manufacturer": "Bruker",
+    "laser_name": "Chameleon",
+    "laser_description": "laser",
+    "camera_name": "camera",
+    "camera_description": "camera",
+    "camera_manufacturer": "FLIR",
+}
+
+SUBJECT = {
+    "subject_id": "CSE020",
+    "dob": "20210701",
+    "description": "test subject",
+    "genotype": "C57BL/6J",
+    "sex": "M",
+    "species": "Mus musculus",
+    "strain": "C57BL/6J",
+    "weights": {"20211105": "25"},
+}
+
+SURGERY = {
+    "brain_injections": {
+        "gcamp": {
+            "fluorophore": "GCaMP6f",
+            "description": "indicator",
+            "fluorophore_emission_lambda": 513.0,
+            "target": "BLA",
+            "ap": -1.6,
+            "ml": 3.3,
+        }
+    }
+}
+
+
+def write_voltage_csv(path: Path, pulses_ms):
+    """Write a voltage recording whose lick channel is high during each (on, off) pulse."""
+
+    times = np.arange(0, 2000, dtype=np.float64)
+    lick = np.zeros_like(times)
+    for on, off in pulses_ms:
+        lick[(times >= on) & (times < off)] = 5.0
+
+    with open(path, "w") as f:
+        f.write("Time(ms), lick, speaker\n")
+        for time, value in zip(times, lick):
+            f.write("%s,%s,0.0\n" % (time, value))
+
+
+def write_recording(data_root: Path, name: str, pulses_ms) -> Path:
+    """
+    Lay a recording out the way rip.py leaves it in its data root.
+
+    The raw directory holds the metadata and the voltage recording moved back into it,
+    the events are written next to the raw directory and the tiffs, with their frame
+    manifest, are in the _tiffs directory.
+    """
+
+    raw_dir = data_root / name
+    raw_dir.mkdir(parents=True)
+    (raw_dir / (name + ".env")).write_text(ENV)
+
+    frames = "".join('<Frame index="%d" relativeTime="%s" />' % (index, (index - 1) * FRAME_PERIOD_SECS)
+                     for index in range(1, NUM_FRAMES + 1))
+    (raw_dir / (name + ".xml")).write_text(
+        '<?xml version="1.0" encoding="utf-8"?><PVScan version="5.6.64.200">'
+        '<Sequence type="TSeries Timed Element" cycle="1">%s</Sequence></PVScan>' % frames
+    )
+
+    voltage_csv = raw_dir / (name + "_Cycle00001_VoltageRecording_001.csv")
+    write_voltage_csv(voltage_csv, pulses_ms)
+    get_behavior_timestamps(voltage_csv, output_dir=data_root)
+
+    tiff_dir = data_root / (name + "_tiffs")
+    tiff_dir.mkdir()
+    names = []
+    for index in range(1, NUM_FRAMES + 1):
+        tiff_name = "%s_Cycle00001_Ch2_%06d.ome.tif" % (name, index)
+        tifffile.imwrite(tiff_dir / tiff_name, np.full((8, 16), index, dtype=np.uint16))
+        names.append(tiff_name)
+    write_manifest(tiff_dir, names, recording_xml=raw_dir / (name + ".xml"))
+
+    return tiff_dir
+
+
+@pytest.fixture
+def imaging_plane_names(monkeypatch):
+    """
+    Newer hdmf releases reject ':' in object names, which the imaging plane's name
+    contains, so it's replaced when the installed release would reject it.
+    """
+
+    create_imaging_plane = pynwb.NWBFile.create_imaging_plane
+
+    def create(self, *args, **kwargs):
+        try:
+            return create_imaging_plane(self, *args, **kwargs)
+        except ValueError:
+            kwargs["name"] = kwargs["name"].replace(":", "")
+            return create_imaging_plane(self, *args, **kwargs)
+
+    monkeypatch.setattr(pynwb.NWBFile, "create_imaging_plane", create)
+
+
+def test_find_events_csv_matches_recording(tmp_path):
+    # Another recording's events in the same data root sort before this one's
+    write_recording(tmp_path, "20211105_CSE020_plane1_-500.000_raw-012", [(100, 200)])
+    tiff_dir = write_recording(tmp_path, RECORDING, [(300, 400), (900, 1000)])
+
+    events_csv = nwb_utils.find_events_csv(tiff_dir)
+
+    assert events_csv == tmp_path / (RECORDING + "_Cycle00001_VoltageRecording_001_events.csv")
+
+
+def test_build_nwb_file_from_rip_output(tmp_path, monkeypatch, imaging_plane_names):
+    # Keep the parsed .env out of the user's metadata cache
+    monkeypatch.setattr(metadata_cache, "_default_cache", metadata_cache.MetadataCache(tmp_path / "index.json"))
+
+    data_root = tmp_path / "raw"
+    tiff_dir = write_recording(data_root, RECORDING, [(300, 400), (900, 1000)])
+    session_path = tmp_path / "nwb"
+    session_path.mkdir()
+
+    nwb_path = nwb_utils.build_nwb_file(
+        "jdelahanty", "specialk_cs", "cs", "CSE020", "-587.325", SUBJECT, PROJECT, SURGERY, session_path,
+        tiff_dir=tiff_dir, env_path=data_root / RECORDING / (RECORDING + ".env"), session_id="BASELINE"
+    )
+
+    with pynwb.NWBHDF5IO(str(nwb_path), "r") as io:
+        nwbfile = io.read()
+
+        series = nwbfile.acquisition["TwoPhotonSeries"]
+        assert series.data.shape == (NUM_FRAMES, 16, 8)
+        assert series.data[NUM_FRAMES - 1, 0, 0] == NUM_FRAMES
+
+        licks = nwbfile.intervals["lick"].to_dataframe()
+        np.testing.assert_allclose(licks["start_time"], [0.3, 0.9])
+        np.testing.assert_allclose(licks["stop_time"], [0.4, 1.0])